@@ -0,0 +1,142 @@
+# answer_cache.py
+#
+# 最初のターンでよく聞かれる質問 (機種の仕様など) の回答キャッシュ。
+# - キーは「静的プレフィックス (システムプロンプト + 履歴) のハッシュ」「正規化したユーザ発言」「会社」
+#   「選択中ユーザの情報 (user_context) のハッシュ」。回答は同じユーザの中でだけ使い回し、
+#   そのユーザの車両 (getMachineInfo) や担当者を使った回答が同じ会社の別ユーザに返らないようにする
+# - 履歴が短いとき (既定: 履歴なし = 最初のターン) だけ使う
+# - TTL + LRU (manual_cache.TTLCache)。system_prompt.txt やデータファイルが変わったら全件破棄する
+# - notifyStaff など副作用のある tool を呼んだターンの回答は保存しない (キャッシュから返すと通知が飛ばないため)
+# - エラー応答 ([OpenAI API Error] など) も保存しない
+#
+# 環境変数:
+#   ANSWER_CACHE_TTL_SEC               0 以下で無効 (既定: 0 = 無効)
+#   ANSWER_CACHE_MAX_ENTRIES           最大件数 (既定: 500)
+#   ANSWER_CACHE_MAX_HISTORY_MESSAGES  これ以下の履歴件数のときだけ使う (既定: 0)
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+import metrics
+from data_repository import repository
+from deadline import TRUNCATED_NOTE
+from manual_cache import TTLCache, normalize_text
+from prompt_builder import system_prompt_cache
+
+ANSWER_CACHE_TTL_SEC = float(os.environ.get("ANSWER_CACHE_TTL_SEC", "0"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_MAX_HISTORY_MESSAGES = int(os.environ.get("ANSWER_CACHE_MAX_HISTORY_MESSAGES", "0"))
+
+# 呼ぶと外部に副作用が残る tool。これを使ったターンはキャッシュしない
+SIDE_EFFECT_TOOLS = {"notifyStaff"}
+# generate_bot_reply がエラー時に返す文字列の先頭
+ERROR_REPLY_PREFIXES = ("[OpenAI API Error]", "[Error]", "[Empty response]", "[Timeout]")
+
+
+def tools_used(conversation: List[Dict]) -> Set[str]:
+    """generate_bot_reply 実行後の conversation から、このターンで呼ばれた tool 名を集める。"""
+    last_user = max((i for i, m in enumerate(conversation) if m.get("role") == "user"), default=-1)
+    names = set()
+    for m in conversation[last_user + 1:]:
+        for tc in m.get("tool_calls") or []:
+            names.add(tc.get("function", {}).get("name", ""))
+    return names
+
+
+def is_error_reply(reply: str) -> bool:
+    # 締め切りで途中まで返した回答 (TRUNCATED_NOTE 付き) も保存しない
+    return not reply or reply.startswith(ERROR_REPLY_PREFIXES) or reply.endswith(TRUNCATED_NOTE)
+
+
+class AnswerCache:
+    """
+    回答キャッシュ本体。
+      key = answer_cache.key_for(messages, user_context, company_id, user_msg, history_len)
+      reply = answer_cache.get(key)      # key が None (対象外) なら常に None
+      answer_cache.put(key, reply, conversation)  # 保存してよい回答だけ保存する
+    """
+
+    def __init__(self, ttl_seconds: float = ANSWER_CACHE_TTL_SEC,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 max_history_messages: int = ANSWER_CACHE_MAX_HISTORY_MESSAGES):
+        self.max_history_messages = max_history_messages
+        self._cache = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._data_version = None
+        self._version_lock = threading.Lock()
+        self._counters = {"skipped": 0, "stored": 0, "rejected": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache.ttl_seconds > 0
+
+    def _current_version(self):
+        return (system_prompt_cache.version, repository.snapshot().version)
+
+    def _check_version(self):
+        """システムプロンプトやデータファイルが変わっていたら全件破棄する。"""
+        version = self._current_version()
+        if version == self._data_version:
+            return
+        with self._version_lock:
+            if version != self._data_version:
+                if self._data_version is not None:
+                    self._cache.clear()
+                    self._counters["invalidations"] += 1
+                self._data_version = version
+
+    def key_for(self, messages: List[Dict], user_context: str, company_id: Optional[str],
+                user_msg: str, history_len: int) -> Optional[str]:
+        """
+        キャッシュキーを返す。対象外 (無効/履歴が長い/空の発言) のときは None。
+        messages は build_conversation の結果。末尾のユーザ情報と今回の発言を除いた部分を静的プレフィックスとする。
+        """
+        if not self.enabled or not user_msg.strip():
+            return None
+        if history_len > self.max_history_messages:
+            self._counters["skipped"] += 1
+            metrics.answer_cache_total.inc(result="skipped")
+            return None
+        prefix = messages[:-1]
+        if user_context and prefix and prefix[-1].get("content") == user_context:
+            prefix = prefix[:-1]
+        digest = hashlib.sha256()
+        # 版もキーに含め、生成中にファイルが更新された場合の回答が新しい版で使われないようにする
+        digest.update(repr(self._current_version()).encode("utf-8") + b"\0")
+        digest.update(json.dumps(prefix, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+        digest.update(b"\0" + normalize_text(user_msg).encode("utf-8"))
+        digest.update(b"\0" + (company_id or "").encode("utf-8"))
+        digest.update(b"\0" + (user_context or "").encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+        self._check_version()
+        reply = self._cache.get(key)
+        metrics.answer_cache_total.inc(result="miss" if reply is None else "hit")
+        return reply
+
+    def put(self, key: Optional[str], reply: str, conversation: Iterable[Dict]) -> bool:
+        """保存してよい回答なら保存して True を返す。"""
+        if key is None:
+            return False
+        if is_error_reply(reply) or tools_used(list(conversation)) & SIDE_EFFECT_TOOLS:
+            self._counters["rejected"] += 1
+            return False
+        self._check_version()
+        self._cache.put(key, reply)
+        self._counters["stored"] += 1
+        return True
+
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        stats.update(self._counters)
+        stats["enabled"] = self.enabled
+        stats["maxHistoryMessages"] = self.max_history_messages
+        return stats
+
+
+# アプリ全体で共有するインスタンス
+answer_cache = AnswerCache()
@@ -1,11 +1,16 @@
 # api_functions.py
-import requests
 import json
 import os
 from datetime import datetime
 from typing import List, Dict
-from dotenv import load_dotenv
 
+import deadline
+import metrics
+from data_repository import repository
+from http_client import PooledHttpClient, CircuitBreaker, CircuitOpenError
+from manual_cache import TTLCache, manual_cache_key
+from manual_index import manual_index
+from staff_inbox import inbox_writer
 
 
 # ==========================
@@ -34,7 +39,7 @@ def save_json_file(file_path: str, data):
 def getMachineInfo(model: str, serial: str) -> List[Dict]:
     """
     指定したmodel, serialに該当する車両を探す。
-    customer_machine_list.jsonを読み込み、複数該当がある場合はすべて返す。
+    customer_machine_list.json のインデックス(data_repository)を引き、複数該当がある場合はすべて返す。
     戻り値は以下の形式のリスト（複数要素がある可能性もある）。
         [
           {
@@ -53,9 +58,6 @@ def getMachineInfo(model: str, serial: str) -> List[Dict]:
         ]
     ※ 今回のサンプルでは、緯度・経度など仮データを適当に埋めています。
     """
-    # JSONからデータ読込
-    machine_list = load_json_file("customer_machine_list.json")
-
     # 結果用リスト
     results = []
 
@@ -70,24 +72,22 @@ def getMachineInfo(model: str, serial: str) -> List[Dict]:
         "C005": "茨城県水戸市XXX"
     }
 
-    for company_data in machine_list:
-        company_id = company_data["companyId"]
-        for mach in company_data["machines"]:
-            if mach["model"] == model and mach["serial"] == serial:
-                # ダミー情報をセット
-                item = {
-                    "latitude": 35.0,       # ダミー
-                    "longitude": 139.0,     # ダミー
-                    "address": dummy_addresses.get(company_id, "所在地不明"),
-                    "customerName": "不明", # 後で users.json と突合するなら実装してもOK
-                    "customerId": company_id,
-                    "machineId": mach["machineId"],
-                    "dealerCode": "D001",   # ダミー
-                    "dealerName": "Sample Dealer",
-                    "contactPersonId": "S999",      # ダミー
-                    "contactPersonName": "Contact Person Dummy"
-                }
-                results.append(item)
+    # 共有リポジトリの (model, serial) インデックスで検索 (ファイルの再読込はしない)
+    for company_id, mach in repository.find_machines(model, serial):
+        # ダミー情報をセット
+        item = {
+            "latitude": 35.0,       # ダミー
+            "longitude": 139.0,     # ダミー
+            "address": dummy_addresses.get(company_id, "所在地不明"),
+            "customerName": "不明", # 後で users.json と突合するなら実装してもOK
+            "customerId": company_id,
+            "machineId": mach["machineId"],
+            "dealerCode": "D001",   # ダミー
+            "dealerName": "Sample Dealer",
+            "contactPersonId": "S999",      # ダミー
+            "contactPersonName": "Contact Person Dummy"
+        }
+        results.append(item)
 
     if not results:
         return { "found": False, "message": "No such machine in the list" }
@@ -97,7 +97,7 @@ def getMachineInfo(model: str, serial: str) -> List[Dict]:
 
 
 # =====================================================================
-# 5) notifyStaff: スタッフにメッセージを通知し、JSONファイルに追記する
+# 5) notifyStaff: スタッフにメッセージを通知し、受信箱ファイルに追記する
 # =====================================================================
 def notifyStaff(userId: str,
                 title: str,
@@ -109,33 +109,41 @@ def notifyStaff(userId: str,
                 recipientUserIds: List[str]) -> Dict:
     """
     担当者(複数)に対して通知を行う想定。
-    - staff_inbox_{staffId}.json というファイルを用意し、メッセージを追記していく。
+    - staff_inbox_{staffId}.jsonl に1メッセージ1行で追記していく (staff_inbox.py)。
+    - 書き込みは writer スレッドが宛先ごとにまとめて行い、fsync 完了を待って返る。
     - 成功/失敗のみを返すシンプルな設計。
+      待ちきれなかった場合も書き込みは後で行われるので、失敗にせず pending として返す
+      (失敗と返すとモデルやユーザが再送し、通知が二重になる)。
     """
     now_str = datetime.utcnow().isoformat()
 
-    for staff_id in recipientUserIds:
-        # ファイル名: staff_inbox_S001.json のように
-        inbox_filename = f"staff_inbox_{staff_id}.json"
-
-        # すでにファイルがあれば読み込み、なければ空リスト
-        current_inbox = load_json_file(inbox_filename)
-
-        # 新しいメッセージアイテム
-        new_message = {
-            "timestamp": now_str,
-            "title": title,
-            "messageContent": messageContent,
-            "customerId": customerId,
-            "customerName": customerName,
-            "customerUserId": customerUserId,
-            "customerUserName": customerUserName,
-            "fromUserId": userId
+    # 新しいメッセージアイテム
+    new_message = {
+        "timestamp": now_str,
+        "title": title,
+        "messageContent": messageContent,
+        "customerId": customerId,
+        "customerName": customerName,
+        "customerUserId": customerUserId,
+        "customerUserName": customerUserName,
+        "fromUserId": userId
+    }
+
+    try:
+        written = inbox_writer.write(recipientUserIds, new_message)
+    except (ValueError, OSError) as e:
+        return {
+            "success": False,
+            "errorMessage": str(e)
         }
-        current_inbox.append(new_message)
 
-        # ファイルに書き戻し
-        save_json_file(inbox_filename, current_inbox)
+    if not written:
+        return {
+            "success": True,
+            "pending": True,
+            "errorMessage": "",
+            "message": "通知を受け付けました (書き込みは処理中です)。通知は届くので、再送しないでください。"
+        }
 
     return {
         "success": True,
@@ -143,21 +151,113 @@ def notifyStaff(userId: str,
     }
 
 SUBSCRIPTION_KEY = "3da1878c519c497182eb50578a3eaeed"
-SEARCH_API_URL = "https://aibot-apim-uat-jpe.azure-api.net/satori-uat/DocumentQueryWithAnswer"
+# 検証環境やベンチマーク (fake_services.py) では SEARCH_API_URL で差し替える
+SEARCH_API_URL = os.environ.get(
+    "SEARCH_API_URL", "https://aibot-apim-uat-jpe.azure-api.net/satori-uat/DocumentQueryWithAnswer")
+
+# マニュアル検索API用の共有クライアント (keep-alive / 再試行 / サーキットブレーカー)
+search_client = PooledHttpClient(
+    name="searchManual",
+    pool_size=int(os.environ.get("SEARCH_POOL_SIZE", "10")),
+    connect_timeout=float(os.environ.get("SEARCH_CONNECT_TIMEOUT", "3.05")),
+    read_timeout=float(os.environ.get("SEARCH_READ_TIMEOUT", "30")),
+    max_retries=int(os.environ.get("SEARCH_MAX_RETRIES", "2")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.environ.get("SEARCH_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.environ.get("SEARCH_BREAKER_RESET_SEC", "30"))
+    )
+)
+
+# 検索結果キャッシュ (TTL/LRU + 同一問い合わせの合流)
+MANUAL_CACHE_TTL_SEC = float(os.environ.get("MANUAL_CACHE_TTL_SEC", "3600"))
+manual_cache = TTLCache(
+    max_entries=int(os.environ.get("MANUAL_CACHE_MAX_ENTRIES", "1000")),
+    ttl_seconds=MANUAL_CACHE_TTL_SEC
+)
 
 def searchManual(model: str, serial: str, documentType: str, query: str):
     """
     取扱説明書 or ショップマニュアルを検索する本実装。
+    正規化した (model, documentType, query) が同じ問い合わせはキャッシュから返す。
     """
     if documentType in ["取扱説明書", "取説", "operation manual (jpn)"]:
         documentType = "Operation and maintenance manual"
     elif documentType in ["ショップマニュアル", "分解組立手順", "shop manual (jpn)"]:
         documentType = "Shop Manual"
 
-    url = "https://aibot-apim-uat-jpe.azure-api.net/satori-uat/DocumentQueryWithAnswer"
+    if MANUAL_CACHE_TTL_SEC <= 0:
+        return _search_manual(model, documentType, query)
+
+    return manual_cache.get_or_compute(
+        manual_cache_key(model, documentType, query),
+        lambda: _search_manual(model, documentType, query),
+        # エラー応答と、リモート障害時の代替結果はキャッシュしない
+        should_cache=lambda result: "error" not in result and "remoteError" not in result
+    )
+
+# ローカル索引 (manual_index.py) の検索設定
+MANUAL_LOCAL_ENABLED = os.environ.get("MANUAL_LOCAL_ENABLED", "1") != "0"
+MANUAL_LOCAL_BUDGET_MS = float(os.environ.get("MANUAL_LOCAL_BUDGET_MS", "100"))
+MANUAL_LOCAL_MIN_CONFIDENCE = float(os.environ.get("MANUAL_LOCAL_MIN_CONFIDENCE", "0.6"))
+MANUAL_LOCAL_TOP_K = int(os.environ.get("MANUAL_LOCAL_TOP_K", "3"))
+MANUAL_SECTION_MAX_CHARS = int(os.environ.get("MANUAL_SECTION_MAX_CHARS", "1200"))
+
+def _search_manual(model: str, documentType: str, query: str):
+    """
+    まずローカル索引を検索し、確信度が十分ならその結果を返す。
+    索引が無い/確信度が低い/時間内に終わらない場合はリモートAPIに問い合わせ、
+    リモートが失敗したときはローカルの結果があればそれを返す。
+    """
+    local = None
+    if MANUAL_LOCAL_ENABLED:
+        with metrics.span("manual_local_search"):
+            local = manual_index.search(query, documentType, model, MANUAL_LOCAL_TOP_K,
+                                        MANUAL_LOCAL_BUDGET_MS / 1000)
+    if local is not None and local.is_confident(MANUAL_LOCAL_MIN_CONFIDENCE):
+        metrics.manual_search_total.inc(route="local")
+        return _local_search_result(local)
+
+    remote = _search_manual_remote(documentType, query)
+    if "error" in remote and local is not None and local.sections:
+        metrics.manual_search_total.inc(route="local_fallback")
+        result = _local_search_result(local)
+        result["remoteError"] = remote.get("errorCode", "")
+        result["note"] = "リモート検索に失敗したため、ローカル索引で最も近い箇所を返しています。質問に直接答えていない場合があります。"
+        return result
+
+    if not MANUAL_LOCAL_ENABLED:
+        route = "remote_disabled"
+    elif local is None:
+        route = "remote_no_index"
+    elif local.budget_exceeded:
+        route = "remote_budget"
+    else:
+        route = "remote_low_confidence"
+    metrics.manual_search_total.inc(route=route)
+    return remote
+
+def _local_search_result(local) -> Dict:
+    """ローカル検索の結果を tool の戻り値にする (openAiAnswer の代わりに該当箇所の抜粋を返す)。"""
+    sections = []
+    for section in local.sections:
+        text = section["text"]
+        if len(text) > MANUAL_SECTION_MAX_CHARS:
+            text = text[:MANUAL_SECTION_MAX_CHARS] + "…"
+        sections.append({"title": section["title"], "text": text, "document": section["source"],
+                         "score": section["score"]})
+    return {
+        "openAiAnswer": "",
+        "source": "localIndex",
+        "confidence": local.confidence,
+        "sections": sections
+    }
+
+def _search_manual_remote(documentType: str, query: str):
+    """DocumentQueryWithAnswer API に問い合わせる。"""
+    import requests  # 起動を速くするため、最初の問い合わせで読み込む (http_client と同じ)
     headers = {
         "Content-Type": "application/json",
-        "Ocp-Apim-Subscription-Key": "3da1878c519c497182eb50578a3eaeed"
+        "Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY
     }
     body = {
         "Query": query,
@@ -168,9 +268,8 @@ def searchManual(model: str, serial: str, documentType: str, query: str):
     }
 
     try:
-        response = requests.post(url, json=body, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        # ターンの締め切り (tool のスレッドにも引き継がれている) の範囲で問い合わせる
+        data = search_client.post_json(SEARCH_API_URL, body, headers=headers, deadline=deadline.current())
         topN = data.get("topNResults", {})
         openAiAnswer = topN.get("openAiAnswer", "")
 
@@ -179,8 +278,18 @@ def searchManual(model: str, serial: str, documentType: str, query: str):
             "raw": data
         }
 
+    except CircuitOpenError as e:
+        # 検索基盤が不調: 呼び出さずに即失敗し、モデルが説明できる構造化エラーを返す
+        return {
+            "openAiAnswer": "",
+            "error": str(e),
+            "errorCode": "SEARCH_UNAVAILABLE",
+            "retryAfterSec": round(e.retry_after),
+            "message": "マニュアル検索サービスが一時的に利用できません。時間をおいて再度お試しいただくようご案内してください。"
+        }
     except requests.RequestException as e:
         return {
             "openAiAnswer": "",
-            "error": str(e)
+            "error": str(e),
+            "errorCode": "SEARCH_FAILED"
         }
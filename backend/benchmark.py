@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# benchmark.py
+#
+# オフラインで動く負荷試験とマイクロベンチマーク。
+# OpenAI と DocumentQueryWithAnswer は fake_services.py のローカルサーバに差し替えるので、
+# 本物のキーやネットワークは不要。デプロイ前に性能の劣化を見つけるために使う。
+#
+#   負荷試験: Flask アプリをプロセス内で起動し、仮想ユーザが
+#             login → users → select-user → chat (N ターン) を同時に実行する。
+#             エンドポイントごとの p50/p95/p99 とスループットを出す。
+#     python benchmark.py load --users 20 --turns 5 --latency 0.3 --tool-mode machine [--stream]
+#
+#   マイクロベンチマーク: 合成した 1万〜100万台の車両データで
+#             getMachineInfo / GET /api/users / プロンプト組み立て を計る。
+#     python benchmark.py micro --fleet 10000,100000,1000000
+#
+#   起動時間: 新しいプロセスごとに run.py の import 時間と、最初のリクエスト (チャット1ターン) の
+#             レイテンシを計る。warmup を無効にした cold と、/api/ops/ready を待ってからの warm を比べる。
+#     python benchmark.py startup --runs 5
+#
+#   劣化の検出: --output で結果を JSON に保存し、次回 --baseline に渡すと
+#             p95 が --tolerance (既定 25%) を超えて悪化した項目があれば終了コード 1 で終わる。
+#     python benchmark.py load --output bench_base.json
+#     python benchmark.py load --baseline bench_base.json
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from fake_services import FakeServicesProcess, TOOL_MODES
+
+MODELS = ["PC200-8", "PC300-7", "PC210-10", "PC138US", "PC78US", "WA380", "WA470", "D61PX", "D155AX",
+          "HD785", "HM400", "GD675", "PC1250", "PC490LC", "WA100", "PW148", "PC30MR", "WA200", "D37EX", "HB365"]
+
+
+# ==========================================
+# 1) 集計
+# ==========================================
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近接順位法のパーセンタイル (sorted_values は昇順)。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: List[float], errors: int = 0, elapsed: Optional[float] = None) -> Dict:
+    """秒単位のレイテンシ列を ms 単位の統計にまとめる。"""
+    values = sorted(latencies)
+    result = {
+        "count": len(values),
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+    if elapsed:
+        result["per_sec"] = round(len(values) / elapsed, 2)
+    return result
+
+
+def print_table(title: str, results: Dict[str, Dict]):
+    print(f"\n== {title} ==")
+    print(f"{'name':<40} {'count':>8} {'err':>5} {'p50ms':>10} {'p95ms':>10} {'p99ms':>10} {'per_sec':>10}")
+    for name, r in results.items():
+        if "count" not in r:
+            continue
+        print(f"{name:<40} {r['count']:>8} {r['errors']:>5} {r['p50_ms']:>10.3f} {r['p95_ms']:>10.3f} "
+              f"{r['p99_ms']:>10.3f} {r.get('per_sec', ''):>10}")
+
+
+def compare_with_baseline(results: Dict[str, Dict], baseline_path: str, tolerance: float) -> List[str]:
+    """baseline より p95 が tolerance を超えて悪化した項目を返す。"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f).get("results", {})
+    regressions = []
+    for name, base in baseline.items():
+        current = results.get(name)
+        if not current or "p95_ms" not in base or base["p95_ms"] <= 0:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+    return regressions
+
+
+# ==========================================
+# 2) 負荷試験
+# ==========================================
+def _configure_app_env(openai_url: str, search_url: str, workdir: str):
+    """run.py を import する前に、外部サービスの向き先と出力先を設定する。"""
+    os.environ["OPENAI_BASE_URL"] = openai_url
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-dummy")
+    os.environ["SEARCH_API_URL"] = search_url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("LOG_LEVELS", "werkzeug=WARNING")
+    os.environ.setdefault("INBOX_DIR", workdir)
+
+
+class LoadRecorder:
+    """仮想ユーザの計測結果を集める。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, name: str, seconds: float, ok: bool):
+        with self._lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+
+def _timed(recorder: LoadRecorder, name: str, call: Callable):
+    started = time.perf_counter()
+    try:
+        response = call()
+        ok = response.status_code < 400
+    except Exception:
+        response, ok = None, False
+    recorder.record(name, time.perf_counter() - started, ok)
+    return response if ok else None
+
+
+def _chat_stream(session, base_url: str, payload: Dict, recorder: LoadRecorder):
+    """SSE を最後まで読み、最初の delta までの時間と全体の時間を記録する。"""
+    started = time.perf_counter()
+    first_delta = None
+    ok = False
+    try:
+        with session.post(f"{base_url}/api/chat/stream", json=payload, stream=True, timeout=120) as r:
+            for line in r.iter_lines(decode_unicode=True):
+                if first_delta is None and line == "event: delta":
+                    first_delta = time.perf_counter() - started
+                elif line == "event: done":
+                    ok = r.status_code == 200
+    except Exception:
+        ok = False
+    recorder.record("POST /api/chat/stream", time.perf_counter() - started, ok)
+    if first_delta is not None:
+        recorder.record("POST /api/chat/stream (first delta)", first_delta, True)
+
+
+def _chat_job(session, base_url: str, payload: Dict, recorder: LoadRecorder):
+    """/api/chat/jobs に投入し、long-poll で結果が出るまでの時間を記録する (429 は Retry-After 後に再送)。"""
+    started = time.perf_counter()
+    ok = False
+    try:
+        while True:
+            r = session.post(f"{base_url}/api/chat/jobs", json=payload, timeout=30)
+            if r.status_code != 429:
+                break
+            recorder.record("POST /api/chat/jobs (429)", 0.0, True)
+            time.sleep(float(r.headers.get("Retry-After", "1")))
+        if r.status_code == 202:
+            job_id = r.json()["jobId"]
+            while True:
+                r = session.get(f"{base_url}/api/chat/jobs/{job_id}",
+                                params={"sessionId": payload["sessionId"], "wait": 25}, timeout=60)
+                status = r.json().get("status") if r.status_code == 200 else "failed"
+                if status in ("done", "failed"):
+                    ok = status == "done"
+                    break
+    except Exception:
+        ok = False
+    recorder.record("POST /api/chat/jobs (result)", time.perf_counter() - started, ok)
+
+
+def _virtual_user(base_url: str, turns: int, mode: str, start: threading.Barrier, recorder: LoadRecorder):
+    import requests
+
+    session = requests.Session()
+    start.wait()
+    r = _timed(recorder, "POST /api/login",
+               lambda: session.post(f"{base_url}/api/login", json={"userId": "test", "password": "test"}, timeout=30))
+    if r is None:
+        return
+    session_id = r.json()["sessionId"]
+
+    r = _timed(recorder, "GET /api/users", lambda: session.get(f"{base_url}/api/users", timeout=30))
+    users = r.json().get("users", []) if r is not None else []
+    user_id = random.choice(users)["userId"] if users else "U001"
+    if _timed(recorder, "POST /api/select-user",
+              lambda: session.post(f"{base_url}/api/select-user",
+                                   json={"sessionId": session_id, "userId": user_id}, timeout=30)) is None:
+        return
+
+    for i in range(turns):
+        payload = {"sessionId": session_id, "message": f"PC200-8 の 100001 の点検について教えて ({i})"}
+        if mode == "stream":
+            _chat_stream(session, base_url, payload, recorder)
+        elif mode == "jobs":
+            _chat_job(session, base_url, payload, recorder)
+        else:
+            _timed(recorder, "POST /api/chat",
+                   lambda: session.post(f"{base_url}/api/chat", json=payload, timeout=120))
+
+    _timed(recorder, "POST /api/chat/finish",
+           lambda: session.post(f"{base_url}/api/chat/finish", json={"sessionId": session_id}, timeout=30))
+
+
+def run_load(args) -> Dict[str, Dict]:
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    fakes = FakeServicesProcess(
+        openai_kwargs={"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+                       "tool_mode": args.tool_mode, "token_delay": args.token_delay,
+                       "slow_rate": args.slow_rate, "empty_rate": args.empty_rate, "rpm_limit": args.rpm_limit,
+                       "mini_latency_factor": args.mini_latency_factor},
+        search_kwargs={"latency": args.search_latency, "jitter": args.jitter, "error_rate": args.error_rate}
+    ).start()
+    _configure_app_env(f"{fakes.openai_url}/v1", f"{fakes.search_url}/DocumentQueryWithAnswer", workdir)
+    if args.router_mode:
+        os.environ["MODEL_ROUTER_MODE"] = args.router_mode
+
+    import openai
+    from werkzeug.serving import make_server
+    import run
+
+    openai.base_url = f"{fakes.openai_url}/v1/"
+    httpd = make_server("127.0.0.1", 0, run.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, name="bench-app", daemon=True).start()
+    base_url = f"http://127.0.0.1:{httpd.server_port}"
+
+    recorder = LoadRecorder()
+    barrier = threading.Barrier(args.users + 1)
+    mode = "jobs" if args.jobs else "stream" if args.stream else "chat"
+    threads = [threading.Thread(target=_virtual_user, args=(base_url, args.turns, mode, barrier, recorder),
+                                daemon=True) for _ in range(args.users)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    httpd.shutdown()
+    fake_stats = fakes.stats()
+    fakes.stop()
+
+    results = {name: summarize(values, recorder.errors.get(name, 0), elapsed)
+               for name, values in sorted(recorder.latencies.items())}
+    chat_key = {"jobs": "POST /api/chat/jobs (result)", "stream": "POST /api/chat/stream"}.get(mode, "POST /api/chat")
+    results["_overall"] = {
+        "elapsed_sec": round(elapsed, 3),
+        "requests_per_sec": round(sum(len(v) for k, v in recorder.latencies.items()
+                                      if not k.endswith(("(first delta)", "(429)"))) / elapsed, 2),
+        "turns_per_sec": round(len(recorder.latencies.get(chat_key, [])) / elapsed, 2),
+        "openai_requests": fake_stats["openaiRequests"],
+        "search_requests": fake_stats["searchRequests"],
+    }
+    print_table(f"load: {args.users} users x {args.turns} turns "
+                f"({mode}, tool_mode={args.tool_mode}, latency={args.latency}s)",
+                results)
+    print(f"\nelapsed={results['_overall']['elapsed_sec']}s "
+          f"requests/s={results['_overall']['requests_per_sec']} turns/s={results['_overall']['turns_per_sec']} "
+          f"openai_requests={fake_stats['openaiRequests']} openai_429={fake_stats['openaiRateLimited']} "
+          f"search_requests={fake_stats['searchRequests']}")
+    # variant/モデルごとの completion の呼び出し数と平均時間 (A/B の比較用)
+    results["_model_routes"] = run.model_router.stats()["calls"]
+    for route, stats in results["_model_routes"].items():
+        print(f"model route {route}: calls={stats['calls']} avg={stats['avgSec']}s")
+    return results
+
+
+# ==========================================
+# 3) マイクロベンチマーク
+# ==========================================
+def generate_fleet(machine_count: int, directory: str, machines_per_company: int = 50):
+    """
+    合成データ (users / customer_machine_list) を directory に書き出し、(users_path, machines_path) を返す。
+    1社あたり machines_per_company 台、1社あたり2ユーザ。
+    """
+    rng = random.Random(machine_count)
+    company_count = max(1, machine_count // machines_per_company)
+    machine_list = []
+    users = []
+    serial = 100000
+    for c in range(company_count):
+        company_id = f"C{c + 1:06d}"
+        n = machines_per_company if c < company_count - 1 else machine_count - machines_per_company * c
+        machines = []
+        for _ in range(n):
+            serial += 1
+            machines.append({"machineId": f"M{serial:07d}", "model": rng.choice(MODELS), "serial": str(serial)})
+        machine_list.append({"companyId": company_id, "machines": machines})
+        for u in range(2):
+            users.append({"userId": f"U{c * 2 + u + 1:06d}", "userName": f"ユーザ {c * 2 + u + 1}",
+                          "companyId": company_id, "companyName": f"会社{c + 1}",
+                          "email": f"user{c * 2 + u + 1}@example.com"})
+
+    users_path = os.path.join(directory, f"users_{machine_count}.json")
+    machines_path = os.path.join(directory, f"machines_{machine_count}.json")
+    with open(users_path, "w", encoding="utf-8") as f:
+        json.dump(users, f, ensure_ascii=False)
+    with open(machines_path, "w", encoding="utf-8") as f:
+        json.dump(machine_list, f, ensure_ascii=False)
+    return users_path, machines_path
+
+
+def bench(fn: Callable, iterations: int, warmup: int = 3) -> Dict:
+    for _ in range(min(warmup, iterations)):
+        fn()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, 0, time.perf_counter() - started)
+
+
+def run_micro(args) -> Dict[str, Dict]:
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    _configure_app_env("http://127.0.0.1:9/v1", "http://127.0.0.1:9/DocumentQueryWithAnswer", workdir)
+    os.environ.setdefault("DATA_RELOAD_INTERVAL", "0")
+
+    import run
+    from api_functions import getMachineInfo
+    from data_repository import repository
+
+    client = run.app.test_client()
+    results: Dict[str, Dict] = {}
+    for size in [int(s) for s in args.fleet.split(",") if s.strip()]:
+        users_path, machines_path = generate_fleet(size, workdir)
+        repository.users_path, repository.machines_path = users_path, machines_path
+        # スナップショット (インデックス) の構築時間
+        t0 = time.perf_counter()
+        repository.reload(force=True)
+        build_sec = time.perf_counter() - t0
+        results[f"repository build [{size}]"] = summarize([build_sec], 0)
+
+        snap = repository.snapshot()
+        keys = list(snap.machines_by_model_serial.keys())
+        rng = random.Random(0)
+        results[f"getMachineInfo hit [{size}]"] = bench(
+            lambda: getMachineInfo(*rng.choice(keys)), args.iterations)
+        results[f"getMachineInfo miss [{size}]"] = bench(
+            lambda: getMachineInfo("NO-SUCH", str(rng.randint(1, 10 ** 9))), args.iterations)
+        results[f"GET /api/users [{size}]"] = bench(
+            lambda: client.get("/api/users"), max(10, args.iterations // 50))
+        results[f"GET /api/users?q= [{size}]"] = bench(
+            lambda: client.get("/api/users", query_string={"q": f"ユーザ {rng.randint(1, 99)}"}),
+            max(10, args.iterations // 50))
+        etag = client.get("/api/users").headers.get("ETag", "")
+        results[f"GET /api/users 304 [{size}]"] = bench(
+            lambda: client.get("/api/users", headers={"If-None-Match": etag}), max(10, args.iterations // 50))
+
+        # プロンプト組み立て (履歴 history_turns ターン + ユーザ情報)
+        user = snap.users[0] if snap.users else {}
+        sess = {"conversation": [], "userInfo": user, "userContext": run.render_user_context(user)}
+        for i in range(args.history_turns):
+            sess["conversation"].append({"role": "user", "content": f"質問 {i}: PC200-8 の点検周期は？" * 3})
+            sess["conversation"].append({"role": "assistant", "content": f"回答 {i}: 250時間ごとです。" * 10})
+        results[f"prompt assembly [{size}]"] = bench(
+            lambda: run.build_conversation(sess, "エンジンオイルの交換手順を教えて"), args.iterations)
+
+        print(f"fleet={size}: companies={len(snap.companies_by_id)} users={len(snap.users)} "
+              f"build={build_sec * 1000:.1f}ms")
+
+    print_table("micro", results)
+    return results
+
+
+# ==========================================
+# 4) 起動時間
+# ==========================================
+# 子プロセスで最初に実行する (run の import 時間を、他のモジュールを読み込む前に計る)
+_STARTUP_CHILD = (
+    "import time; t0 = time.perf_counter(); import run; import_sec = time.perf_counter() - t0; "
+    "import benchmark; benchmark.startup_child(import_sec)"
+)
+
+
+def startup_child(import_sec: float):
+    """startup の子プロセス側。ready を待ち (warm の場合)、チャットを2ターン行い、計測結果を JSON で出力する。"""
+    import run
+
+    client = run.app.test_client()
+    timings = {"import run": import_sec}
+    t0 = time.perf_counter()
+    while client.get("/api/ops/ready").status_code != 200:
+        time.sleep(0.005)
+    timings["ready"] = time.perf_counter() - t0
+
+    session_id = client.post("/api/login", json={"userId": "test", "password": "test"}).get_json()["sessionId"]
+    client.post("/api/select-user", json={"sessionId": session_id, "userId": "U001"})
+    for name in ("first POST /api/chat", "second POST /api/chat"):
+        t0 = time.perf_counter()
+        r = client.post("/api/chat", json={"sessionId": session_id, "message": "PC200-8 の 100001 の点検について教えて"})
+        timings[name] = time.perf_counter() - t0 if r.status_code < 400 else None
+    print(json.dumps(timings))
+
+
+def run_startup(args) -> Dict[str, Dict]:
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    fakes = FakeServicesProcess(openai_kwargs={"latency": args.latency, "tool_mode": args.tool_mode},
+                                search_kwargs={"latency": args.search_latency}).start()
+    _configure_app_env(f"{fakes.openai_url}/v1", f"{fakes.search_url}/DocumentQueryWithAnswer", workdir)
+    os.environ.setdefault("DATA_RELOAD_INTERVAL", "0")
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    try:
+        for _ in range(args.runs):
+            for mode in ("cold", "warm"):
+                env = dict(os.environ, WARMUP_ENABLED="0" if mode == "cold" else "1")
+                out = subprocess.run([sys.executable, "-c", _STARTUP_CHILD], env=env, capture_output=True,
+                                     text=True, timeout=120, cwd=os.path.dirname(os.path.abspath(__file__)))
+                lines = out.stdout.strip().splitlines()
+                if out.returncode != 0 or not lines:
+                    errors[f"{mode}: import run"] += 1
+                    print(out.stderr[-2000:], file=sys.stderr)
+                    continue
+                for name, seconds in json.loads(lines[-1]).items():
+                    if seconds is None:
+                        errors[f"{mode}: {name}"] += 1
+                    else:
+                        latencies[f"{mode}: {name}"].append(seconds)
+    finally:
+        fakes.stop()
+
+    results = {name: summarize(values, errors.get(name, 0)) for name, values in sorted(latencies.items())}
+    print_table(f"startup: {args.runs} runs (cold: WARMUP_ENABLED=0, warm: after /api/ops/ready)", results)
+    return results
+
+
+# ==========================================
+# 5) CLI
+# ==========================================
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ChatBotWeb1 のオフライン負荷試験/マイクロベンチマーク")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    load = sub.add_parser("load", help="仮想ユーザによる負荷試験")
+    load.add_argument("--users", type=int, default=20, help="同時に動かす仮想ユーザ数")
+    load.add_argument("--turns", type=int, default=5, help="1ユーザあたりのチャットターン数")
+    load.add_argument("--stream", action="store_true", help="/api/chat/stream を使う")
+    load.add_argument("--jobs", action="store_true", help="/api/chat/jobs (ジョブ + long-poll) を使う")
+    load.add_argument("--latency", type=float, default=0.3, help="fake OpenAI の応答待ち時間(秒)")
+    load.add_argument("--token-delay", type=float, default=0.01, help="stream のチャンク間隔(秒)")
+    load.add_argument("--search-latency", type=float, default=0.2, help="fake 検索APIの応答待ち時間(秒)")
+    load.add_argument("--jitter", type=float, default=0.2, help="待ち時間のゆらぎ (割合)")
+    load.add_argument("--error-rate", type=float, default=0.0, help="fake サービスが 503 を返す割合")
+    load.add_argument("--slow-rate", type=float, default=0.0, help="OpenAI の応答を10倍遅らせる割合")
+    load.add_argument("--empty-rate", type=float, default=0.0, help="tool 結果の後の回答を空にする割合")
+    load.add_argument("--router-mode", choices=("off", "rules", "ab"), help="MODEL_ROUTER_MODE を上書きする")
+    load.add_argument("--mini-latency-factor", type=float, default=1.0,
+                      help="fake OpenAI で *-mini モデルの待ち時間に掛ける倍率")
+    load.add_argument("--rpm-limit", type=int, default=0, help="fake OpenAI の1分あたりのリクエスト上限 (超えたら 429)")
+    load.add_argument("--tool-mode", choices=TOOL_MODES, default="machine")
+
+    micro = sub.add_parser("micro", help="合成データでのマイクロベンチマーク")
+    micro.add_argument("--fleet", default="10000,100000", help="車両台数 (カンマ区切り。例: 10000,100000,1000000)")
+    micro.add_argument("--iterations", type=int, default=2000)
+    micro.add_argument("--history-turns", type=int, default=20)
+
+    startup = sub.add_parser("startup", help="run.py の import 時間と最初のリクエストのレイテンシ")
+    startup.add_argument("--runs", type=int, default=5, help="cold / warm それぞれの起動回数")
+    startup.add_argument("--latency", type=float, default=0.3, help="fake OpenAI の応答待ち時間(秒)")
+    startup.add_argument("--search-latency", type=float, default=0.2, help="fake 検索APIの応答待ち時間(秒)")
+    startup.add_argument("--tool-mode", choices=TOOL_MODES, default="machine")
+
+    for p in (load, micro, startup):
+        p.add_argument("--output", help="結果を JSON で保存するパス")
+        p.add_argument("--baseline", help="比較する過去の結果 (JSON)")
+        p.add_argument("--tolerance", type=float, default=0.25, help="p95 の悪化をどこまで許すか (割合)")
+
+    args = parser.parse_args(argv)
+    results = {"load": run_load, "micro": run_micro, "startup": run_startup}[args.command](args)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"command": args.command, "args": vars(args), "results": results}, f,
+                      ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\nREGRESSION:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nno regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,40 @@
 
 import os
 import json
-import openai
-from typing import List, Dict
+import logging
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Optional
 
-# debug用フラグ (必要に応じて切替)
-DEBUG = True
+# ログ出力 (レベルは環境変数 LOG_LEVEL / LOG_LEVELS で切替。logging_setup.py 参照)
+logger = logging.getLogger(__name__)
 
 # api_functions.pyに定義した関数をimportする想定
 from api_functions import getMachineInfo, searchManual, notifyStaff
+# 履歴のトークン予算管理 (tool 結果も予算に数える)
+from history_manager import history_manager, format_messages_for_summary, count_messages_tokens, count_text_tokens
+# 段階ごとの所要時間・トークン数などのメトリクス (/metrics)
+import metrics
+# 発言中の (機種, 号機) を先に照会する
+from data_repository import repository
+from machine_prefetch import extract_machine_candidates
+# ターンの締め切り (LLM / tool / 外部 API の timeout を残り時間から決める)
+import deadline
+from deadline import Deadline, DeadlineExceeded, TIMEOUT_REPLY, TRUNCATED_NOTE
+# プロセス全体の LLM 送出スケジューラ (RPM/TPM・同時実行数・優先度)
+from llm_scheduler import llm_scheduler, PRIORITY_AFTER_TOOLS, PRIORITY_INITIAL, PRIORITY_BACKGROUND
+# 応答生成に使うモデル (CHAT_MODEL が標準。completion ごとに model_router が軽いモデルと選び分ける)
+from model_router import model_router, CHAT_MODEL, RouteDecision
+# tool 結果をスキーマで小さくしてからプロンプトに入れる (元の結果は getToolResultDetail で取り出せる)
+from tool_results import tool_result_compactor, DETAIL_TOOL_NAME
+
+# 最初の completion の前に getMachineInfo を先に引くか (0 で無効)
+MACHINE_PREFETCH_ENABLED = os.environ.get("MACHINE_PREFETCH_ENABLED", "1") != "0"
+PREFETCH_CALL_ID_PREFIX = "prefetch_"
 
 
 function_definitions = [
@@ -67,141 +93,676 @@ function_definitions = [
     }
 ]
 
+if tool_result_compactor.enabled:
+    function_definitions.append({
+        "name": DETAIL_TOOL_NAME,
+        "description": "省略された関数結果 (\"compacted\" が付いたもの) の元データを取得する。"
+                       "path は \"data.raw\" や \"data.data.5\" のようなドット区切り (省略時は全体)。"
+                       "結果に nextOffset があれば offset に渡して続きを取得する。",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "detailRef": {"type": "string"},
+                "path": {"type": "string"},
+                "offset": {"type": "integer"}
+            },
+            "required": ["detailRef"]
+        }
+    })
+
+
+# tools API 形式の定義 (function_definitions をそのまま包む)
+tool_definitions = [
+    {"type": "function", "function": fn_def}
+    for fn_def in function_definitions
+]
+
+# 1ターン内で tool 呼び出しを繰り返す最大ラウンド数
+MAX_TOOL_ROUNDS = int(os.environ.get("MAX_TOOL_ROUNDS", "3"))
+# tool を並列実行するスレッド数の上限
+TOOL_MAX_WORKERS = int(os.environ.get("TOOL_MAX_WORKERS", "4"))
+
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+
+
+# LLM 呼び出し1回あたりの timeout の上限 (実際はターンの残り時間との小さい方)
+LLM_CALL_TIMEOUT_SEC = float(os.environ.get("LLM_CALL_TIMEOUT_SEC", "60"))
+# 最終回答のために残しておく時間。残りがこれを切ったら tool を使わせずに回答させ、
+# tool の実行もこの分を残した時間で打ち切る
+DEADLINE_ANSWER_RESERVE_SEC = float(os.environ.get("DEADLINE_ANSWER_RESERVE_SEC", "8"))
+
+# ヘッジ: tool 結果を渡した後の completion が遅い (最初のイベントまでが p95 を超えた) か空のとき、
+# 同じリクエストをもう1本投げ、先に中身を返し始めた方を採用して他方は打ち切る
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "1") != "0"
+# p95 を計算できるだけの実績が無いときの待ち時間
+HEDGE_DEFAULT_DELAY_SEC = float(os.environ.get("HEDGE_DEFAULT_DELAY_SEC", "5"))
+HEDGE_MIN_DELAY_SEC = float(os.environ.get("HEDGE_MIN_DELAY_SEC", "0.5"))
+HEDGE_MAX_DELAY_SEC = float(os.environ.get("HEDGE_MAX_DELAY_SEC", "15"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+# 残り時間がこれ未満なら追加の試行は投げない
+HEDGE_MIN_REMAINING_SEC = float(os.environ.get("HEDGE_MIN_REMAINING_SEC", "2"))
+# completion を読むスレッド数の上限 (ヘッジ分を含む)
+LLM_MAX_WORKERS = int(os.environ.get("LLM_MAX_WORKERS", "32"))
+
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="llm")
+
+# openai の import (0.5 秒ほどかかる) は最初の呼び出しまで遅らせる (warmup.preload で先に読み込める)
+_openai_module = None
+_openai_lock = threading.Lock()
 
-def generate_bot_reply(conversation: List[Dict]) -> str:
+
+def load_openai():
+    """openai モジュールを返す。初回だけ import して SDK の既定値を設定する。"""
+    global _openai_module
+    if _openai_module is None:
+        with _openai_lock:
+            if _openai_module is None:
+                import openai
+                # SDK の自動再試行 (timeout ごとに最大2回) は締め切りを超えうるので無効にし、
+                # 失敗時の再試行は _completion_events が残り時間の範囲内で行う
+                openai.max_retries = 0
+                _openai_module = openai
+    return _openai_module
+
+
+def warm_up_llm_connection(timeout: float) -> int:
     """
-    会話履歴( conversation )をOpenAIに渡し、Function calling対応で応答を受け取る。
-    もしfunction_callが返ってきたら、対応する関数を呼び出して結果を再度LLMに渡し、
-    最終テキストを得る。
+    OpenAI への接続 (TCP + TLS) を張ってプールに入れておく (models.retrieve を1回呼ぶ)。
+    応答が返れば、エラーのステータスでも接続は使い回せる。戻り値はステータスコード。
     """
+    openai = load_openai()
     openai.api_key = os.environ.get("OPENAI_API_KEY", "")
-    if DEBUG:
-        print("=== [DEBUG] generate_bot_reply ===")
-        # 省略: debug出力
-    
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=conversation,
-            functions=function_definitions,
-            function_call="auto",
-            temperature=0.7
-        )
-    except Exception as e:
-        if DEBUG:
-            print("[DEBUG] OpenAI API call exception:", str(e))
-        return f"[OpenAI API Error] {str(e)}"
-
-    if not response.choices:
-        if DEBUG:
-            print("[DEBUG] No choices returned from OpenAI")
-        return "[Error] No response from OpenAI"
-
-    response_message = response.choices[0].message
-    if response_message is None:
-        if DEBUG:
-            print("[DEBUG] response_message is None")
-        return "[Error] response_message is None"
-
-    # function_call チェック
-    if hasattr(response_message, "function_call") and response_message.function_call is not None:
-        fn_name = response_message.function_call.name
-        fn_args_str = response_message.function_call.arguments
-        try:
-            fn_args = json.loads(fn_args_str)
-        except json.JSONDecodeError as ex:
-            if DEBUG:
-                print("[DEBUG] JSONDecodeError in function_call arguments:", str(ex))
-            fn_args = {}
-
-        # 関数を実行
-        result_content = handle_function_call(fn_name, fn_args)
-
-        # conversation に function role を追加
-        conversation.append({
-            "role": "function",
-            "name": fn_name,
-            "content": json.dumps(result_content, ensure_ascii=False)
-        })
-
-        # ===== 二度目の呼び出し (function結果をLLMに再度渡す) =====
+        return openai.models.with_raw_response.retrieve(CHAT_MODEL, timeout=timeout).status_code
+    except openai.APIStatusError as e:
+        return e.status_code
+
+# スケジューラに渡すトークン数の見積もりで、生成分として足す数 (usage が返ったら実際の値で精算する)
+LLM_ESTIMATED_COMPLETION_TOKENS = int(os.environ.get("LLM_ESTIMATED_COMPLETION_TOKENS", "400"))
+_TOOL_DEFINITION_TOKENS = count_text_tokens(json.dumps(tool_definitions, ensure_ascii=False))
+
+
+def estimate_request_tokens(messages: List[Dict], with_tools: bool) -> int:
+    """レート制限 (TPM) 用の、1リクエストのトークン数の見積もり (プロンプト + 生成分)。"""
+    tokens = count_messages_tokens(messages) + LLM_ESTIMATED_COMPLETION_TOKENS
+    return tokens + (_TOOL_DEFINITION_TOKENS if with_tools else 0)
+
+
+def _raw_create(**kwargs):
+    """
+    chat.completions.create を応答ヘッダ付きで呼び、x-ratelimit-* と 429 をスケジューラに伝える。
+    戻り値は通常の create と同じ (stream=True なら Stream)。
+    """
+    openai = load_openai()
+    try:
+        raw = openai.chat.completions.with_raw_response.create(**kwargs)
+    except openai.RateLimitError as e:
+        llm_scheduler.observe_rate_limited(getattr(e.response, "headers", None))
+        raise
+    llm_scheduler.observe_headers(raw.headers)
+    return raw.parse()
+
+
+def _create_completion(conversation: List[Dict], allow_tools: bool = True, stream: bool = False,
+                       timeout: Optional[float] = None, model: str = CHAT_MODEL):
+    """
+    chat.completions.create の共通呼び出し。最終ラウンドでは tool を使わせない。
+    timeout はターンの残り時間から決める (SDK の自動再試行は無効にしてある。load_openai 参照)。
+    """
+    kwargs = {}
+    if stream:
+        # ストリームの最後のチャンクで usage を受け取る
+        kwargs["stream_options"] = {"include_usage": True}
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    return _raw_create(
+        model=model,
+        messages=conversation,
+        tools=tool_definitions,
+        tool_choice="auto" if allow_tools else "none",
+        temperature=0.7,
+        stream=stream,
+        **kwargs
+    )
+
+
+def log_usage(usage, label: str = "completion", model: str = CHAT_MODEL):
+    """
+    レスポンスの usage (プロンプト/キャッシュ済み/生成トークン数) をログに出し、メトリクスに加算する。
+    cached_tokens はプロバイダの自動プロンプトキャッシュが効いた分。
+    """
+    if usage is None:
+        return
+    metrics.record_usage(usage, model)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    prompt_tokens = usage.prompt_tokens or 0
+    ratio = cached / prompt_tokens if prompt_tokens else 0.0
+    logger.info("usage %s: prompt_tokens=%d cached_tokens=%d (%.0f%%) completion_tokens=%d",
+                label, prompt_tokens, cached, ratio * 100, usage.completion_tokens or 0,
+                extra={"fields": {"event": "llm_usage", "label": label, "promptTokens": prompt_tokens,
+                                  "cachedTokens": cached, "completionTokens": usage.completion_tokens or 0}})
+
+
+def _assistant_tool_message(content, tool_calls: List[Dict]) -> Dict:
+    """tool_calls を含む assistant メッセージ (次のリクエストにそのまま載せる形)。"""
+    return {
+        "role": "assistant",
+        "content": content or None,
+        "tool_calls": [
+            {
+                "id": tc["id"],
+                "type": "function",
+                "function": {"name": tc["name"], "arguments": tc["arguments"]}
+            }
+            for tc in tool_calls
+        ]
+    }
+
+
+class _LatencyWindow:
+    """直近の所要時間 (秒) を保持し、パーセンタイルを返す。"""
+
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            values = sorted(self._values)
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# (呼び出し種別 initial / after_tools, モデル) ごとの、最初のイベント (テキスト断片 or tool_calls) までの時間
+_first_event_latency: Dict = {}
+_first_event_latency_lock = threading.Lock()
+
+
+def _latency_window(call: str, model: str) -> _LatencyWindow:
+    with _first_event_latency_lock:
+        window = _first_event_latency.get((call, model))
+        if window is None:
+            window = _first_event_latency[(call, model)] = _LatencyWindow()
+        return window
+
+
+def _hedge_delay(call: str, model: str) -> float:
+    """ヘッジを投げるまでの待ち時間: 最初のイベントまでの時間の p95 (実績が少なければ既定値)。"""
+    p95 = _latency_window(call, model).percentile(0.95)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY_SEC
+    return min(HEDGE_MAX_DELAY_SEC, max(HEDGE_MIN_DELAY_SEC, p95))
+
+
+def hedge_stats() -> Dict:
+    """運用確認用: 呼び出し種別とモデルごとの p95 と、現在のヘッジまでの待ち時間。"""
+    stats = {"enabled": HEDGE_ENABLED}
+    with _first_event_latency_lock:
+        windows = sorted(_first_event_latency.items())
+    for (call, model), window in windows:
+        p95 = window.percentile(0.95)
+        stats[f"{call}/{model}"] = {"firstEventP95Sec": None if p95 is None else round(p95, 3),
+                                    "hedgeDelaySec": round(_hedge_delay(call, model), 3)}
+    return stats
+
+
+class _Attempt:
+    """
+    completion 1本 (stream=True) を LLM スレッドで読み、(attempt, 種別, 値) を events キューに入れる。
+      ("content", テキスト断片) / ("tool_calls", [...]) / ("end", None) / ("error", 例外)
+    cancel() で打ち切ると、ストリームを閉じて (生成を止めて) 以降は何も入れない。
+    送出は llm_scheduler を通す (順番待ちの間に締め切りを過ぎたら DeadlineExceeded を "error" で入れる)。
+    """
+
+    def __init__(self, number: int, conversation: List[Dict], allow_tools: bool, decision: RouteDecision,
+                 turn_deadline: Deadline, priority: int, events: "queue.Queue", label: str):
+        self.number = number
+        self.decision = decision
+        # スケジューラの待ちを除いた、送出してからの時間を計るため送出時に設定し直す
+        self.started = time.monotonic()
+        self._cancelled = threading.Event()
+        self._stream = None
+        # リクエストID などを LLM スレッドに引き継ぐ
+        context = contextvars.copy_context()
+        _llm_executor.submit(context.run, self._run, list(conversation), allow_tools, turn_deadline, priority,
+                             events, label)
+
+    def _run(self, conversation, allow_tools, turn_deadline, priority, events, label):
         try:
-            response2 = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=conversation,
-                functions=function_definitions,
-                function_call="auto",
-                temperature=0.7
-            )
+            with llm_scheduler.slot(priority, estimate_request_tokens(conversation, allow_tools),
+                                    turn_deadline, self._cancelled) as ticket:
+                if ticket is None or self._cancelled.is_set():
+                    return
+                self.started = time.monotonic()
+                self._read(conversation, allow_tools, turn_deadline.timeout(LLM_CALL_TIMEOUT_SEC), events, label,
+                           ticket)
         except Exception as e:
-            if DEBUG:
-                print("[DEBUG] Second OpenAI API call exception:", str(e))
-            return f"[OpenAI API Error] {str(e)}"
-
-        if not response2.choices:
-            if DEBUG:
-                print("[DEBUG] No choices returned in second call")
-            return "[Error] No second response from OpenAI"
-
-        final_msg = response2.choices[0].message
-
-        # ▼▼ リトライ機構 ▼▼
-        if (final_msg is None) or (not final_msg.content):
-            if DEBUG:
-                print("[DEBUG] final message is None or content is empty => RETRY ONCE")
-            # リトライしてみる
+            if not self._cancelled.is_set():
+                events.put((self, "error", e))
+        finally:
+            self._close()
+
+    def _read(self, conversation, allow_tools, timeout, events, label, ticket):
+        self._stream = _create_completion(conversation, allow_tools=allow_tools, stream=True, timeout=timeout,
+                                          model=self.decision.model)
+        if self._cancelled.is_set():
+            return
+        tool_calls: Dict[int, Dict] = {}
+        for chunk in self._stream:
+            if self._cancelled.is_set():
+                return
+            if getattr(chunk, "usage", None) is not None:
+                log_usage(chunk.usage, label, self.decision.model)
+                model_router.observe_usage(self.decision, chunk.usage)
+                ticket.settle((chunk.usage.prompt_tokens or 0) + (chunk.usage.completion_tokens or 0))
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta is None:
+                continue
+            # tool_calls は delta の index ごとに id / name / arguments を連結して組み立てる
+            for tc_delta in (delta.tool_calls or []):
+                tc = tool_calls.setdefault(tc_delta.index, {"id": "", "name": "", "arguments": ""})
+                if tc_delta.id:
+                    tc["id"] = tc_delta.id
+                if tc_delta.function is not None:
+                    if tc_delta.function.name:
+                        tc["name"] += tc_delta.function.name
+                    if tc_delta.function.arguments:
+                        tc["arguments"] += tc_delta.function.arguments
+            if delta.content:
+                events.put((self, "content", delta.content))
+        if tool_calls:
+            events.put((self, "tool_calls", [tool_calls[i] for i in sorted(tool_calls)]))
+        events.put((self, "end", None))
+
+    def _close(self):
+        stream = self._stream
+        if stream is not None:
             try:
-                response2_retry = openai.chat.completions.create(
-                    model="gpt-4o",
-                    messages=conversation,
-                    functions=function_definitions,
-                    function_call="auto",
-                    temperature=0.7
-                )
-                if not response2_retry.choices:
-                    if DEBUG:
-                        print("[DEBUG] No choices after RETRY second call")
-                    return "[Error] No second response from OpenAI (retry)"
-
-                final_msg_retry = response2_retry.choices[0].message
-                if final_msg_retry and final_msg_retry.content:
-                    if DEBUG:
-                        print("[DEBUG] Retry succeeded => final_msg obtained.")
-                    return final_msg_retry.content.strip()
-                else:
-                    if DEBUG:
-                        print("[DEBUG] Retry also returned None or empty content.")
-                    return "[Error] Final message is None (retry also failed)"
-            except Exception as ee:
-                if DEBUG:
-                    print("[DEBUG] Second call RETRY exception:", str(ee))
-                return f"[OpenAI API Error] {str(ee)}"
-        # ▲▲ リトライ機構ここまで ▲▲
-
-        if DEBUG and final_msg.content:
-            print("[DEBUG] final text response =>", final_msg.content[:80])
-
-        if final_msg is None or final_msg.content is None:
-            if DEBUG:
-                print("[DEBUG] final message is STILL None or content is None after no retry or single attempt")
-            return "[Error] Final message is None"
-
-        return final_msg.content.strip()
+                stream.close()
+            except Exception:
+                pass
 
-    else:
-        # 通常テキスト応答
-        bot_reply = response_message.content
-        if DEBUG:
-            print("[DEBUG] Normal text response =>", bot_reply[:80])
-        if not bot_reply:
-            return "[Empty response]"
-        return bot_reply.strip()
+    def cancel(self):
+        self._cancelled.set()
+        self._close()
+
+
+def _completion_events(conversation: List[Dict], allow_tools: bool, call: str, decision: RouteDecision,
+                       turn_deadline: Deadline, hedge: bool):
+    """
+    completion 1回分を締め切り付きで実行し、採用した試行のイベントだけを yield する。
+      ("content", テキスト断片) / ("tool_calls", [...])
+    - 最初の試行が例外なら、残り時間があれば1回だけ投げ直す
+    - hedge=True なら、最初のイベントが _hedge_delay() 以内に来ないときと、応答が空だったときにも
+      もう1本投げる。先に中身を返し始めた試行を採用し、他方は打ち切る
+    応答が空なら何も yield せずに終わる。締め切りを過ぎたら DeadlineExceeded、
+    投げ直しも失敗したら最後の例外を送出する。
+    """
+    events: "queue.Queue" = queue.Queue()
+    attempts: List[_Attempt] = []
+    finished = set()
+    winner: Optional[_Attempt] = None
+    last_error: Optional[Exception] = None
+
+    def launch(reason: str):
+        if attempts:
+            metrics.llm_retries_total.inc(reason=reason)
+            logger.info("launching another completion attempt (%s, call=%s, remaining=%.1fs)",
+                        reason, call, turn_deadline.remaining())
+        attempts.append(_Attempt(len(attempts) + 1, conversation, allow_tools, decision, turn_deadline, priority,
+                                 events, f"{call} attempt={len(attempts) + 1}"))
+
+    # ターン途中 (tool 結果の後) の completion は、新しいターンの最初の completion より先に送出する
+    priority = PRIORITY_AFTER_TOOLS if call == "after_tools" else PRIORITY_INITIAL
+    launch("initial")
+    hedge_at = time.monotonic() + _hedge_delay(call, decision.model) if hedge else None
+    try:
+        while True:
+            wait = turn_deadline.remaining()
+            if hedge_at is not None and winner is None and len(attempts) == 1:
+                wait = min(wait, max(0.0, hedge_at - time.monotonic()))
+            try:
+                attempt, kind, value = events.get(timeout=wait)
+            except queue.Empty:
+                if turn_deadline.expired():
+                    raise DeadlineExceeded()
+                # スケジューラで順番待ちが出ている (レート制限に近い) ときは、ヘッジでさらに混ませない
+                if turn_deadline.remaining() >= HEDGE_MIN_REMAINING_SEC and not llm_scheduler.busy():
+                    launch("hedge_slow")
+                hedge_at = None
+                continue
+
+            if winner is None and kind in ("content", "tool_calls"):
+                winner = attempt
+                _latency_window(call, decision.model).observe(time.monotonic() - attempt.started)
+                if len(attempts) > 1:
+                    metrics.llm_hedge_winner_total.inc(winner="primary" if attempt.number == 1 else "hedge")
+                for other in attempts:
+                    if other is not winner:
+                        other.cancel()
+            if winner is not None and attempt is not winner:
+                continue
+            if kind in ("content", "tool_calls"):
+                yield (kind, value)
+                continue
+            if attempt is winner:
+                if kind == "error":
+                    raise value
+                return
+
+            # 中身を返さずに終わった試行 (空応答 or 例外)
+            finished.add(attempt)
+            if kind == "error":
+                last_error = value
+                logger.warning("completion attempt %d failed (call=%s): %s", attempt.number, call, value)
+            if len(finished) < len(attempts):
+                continue  # もう1本がまだ動いている
+            if turn_deadline.expired():
+                raise DeadlineExceeded()
+            can_retry = len(attempts) < 2 and turn_deadline.remaining() >= HEDGE_MIN_REMAINING_SEC
+            if can_retry and (kind == "error" or hedge):
+                launch("error" if kind == "error" else "empty_reply")
+                hedge_at = None
+                continue
+            if kind == "error":
+                raise last_error
+            return
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+
+
+def _reply_events(conversation: List[Dict], turn_deadline: Deadline, variant: str, models: List[str]):
+    """
+    generate_bot_reply / generate_bot_reply_stream の本体。イベントの形式は generate_bot_reply_stream を参照。
+    tool_calls が返ってきたら対応する関数を並列に実行して結果を再度LLMに渡す (最大 MAX_TOOL_ROUNDS ラウンド)。
+    completion ごとのモデルは model_router が選ぶ (使ったモデルを models に追加する)。
+    """
+    tool_rounds = 0
+    # prefetch_machine_info で先に tool 結果を載せている場合、空応答のヘッジは tool ラウンド後と同じ扱いにする。
+    # ただしモデルの選択 (call) は initial のまま: 最初の completion は次に使う tool も決めるので、
+    # tools_likely (機種名・号機を含む発言) の規則で選ぶ
+    prefetched = bool(conversation) and conversation[-1].get("role") == "tool"
+    while True:
+        after_tools = tool_rounds > 0 or prefetched
+        call = "after_tools" if tool_rounds > 0 else "initial"
+        # 締め切りが近ければ tool を使わせずに、今ある情報で回答させる
+        allow_tools = tool_rounds < MAX_TOOL_ROUNDS and turn_deadline.remaining() > DEADLINE_ANSWER_RESERVE_SEC
+        decision = model_router.route(conversation, call, variant)
+        models.append(decision.model)
+        reply_parts = []
+        tool_calls = []
+        started = time.monotonic()
+        ok = False
+        try:
+            # ストリームを読み終えるまでを1回の呼び出しとして計る (ヘッジ・再試行を含む)
+            with metrics.span("llm", metrics.llm_call_seconds, model=decision.model, call=call):
+                for kind, value in _completion_events(conversation, allow_tools, call, decision, turn_deadline,
+                                                      hedge=HEDGE_ENABLED and after_tools):
+                    if kind == "content":
+                        reply_parts.append(value)
+                        yield ("delta", value)
+                    else:
+                        tool_calls = value
+            ok = True
+        except DeadlineExceeded:
+            metrics.deadline_exceeded_total.inc(stage="llm")
+            partial = "".join(reply_parts).strip()
+            logger.warning("turn deadline exceeded during completion (round=%d, partial=%d chars)",
+                           tool_rounds, len(partial))
+            yield ("done", partial + TRUNCATED_NOTE if partial else TIMEOUT_REPLY)
+            return
+        except Exception as e:
+            metrics.llm_errors_total.inc(model=decision.model, call=call)
+            logger.warning("OpenAI API call exception (round=%d): %s", tool_rounds, e)
+            yield ("done", f"[OpenAI API Error] {str(e)}")
+            return
+        finally:
+            model_router.observe_call(decision, call, time.monotonic() - started, ok)
+
+        if tool_calls and allow_tools:
+            conversation.append(_assistant_tool_message("".join(reply_parts), tool_calls))
+            for tc in tool_calls:
+                yield ("function_call", tc["name"])
+            # 関数を(並列に)実行し、tool role のメッセージを追加
+            conversation.extend(handle_tool_calls(tool_calls, turn_deadline))
+            # tool 結果の分だけ予算を超えたら古い履歴から外す
+            history_manager.enforce_budget(conversation)
+            tool_rounds += 1
+            continue
+
+        bot_reply = "".join(reply_parts)
+        if bot_reply:
+            logger.debug("text response (tool_rounds=%d) => %.80s", tool_rounds, bot_reply)
+            yield ("done", bot_reply.strip())
+            return
+        if not after_tools:
+            # 通常テキスト応答が空
+            yield ("done", "[Empty response]")
+            return
+        # tool 結果を渡した後の空応答は _completion_events でもう1本投げても空だった
+        logger.warning("final message is empty (hedge/retry also empty)")
+        yield ("done", "[Error] Final message is None (retry also failed)")
+        return
+
+
+def _turn_events(conversation: List[Dict], route_key: Optional[str]):
+    """
+    1ターン分の _reply_events。締め切りを設定し、A/B の振り分けとターン全体の結果を model_router に記録する。
+    """
+    load_openai().api_key = os.environ.get("OPENAI_API_KEY", "")
+    variant = model_router.variant_for(route_key)
+    models: List[str] = []
+    user_msg = next((m.get("content") or "" for m in reversed(conversation) if m.get("role") == "user"), "")
+    started = time.monotonic()
+    turn_deadline = deadline.start()
+    try:
+        for kind, value in _reply_events(conversation, turn_deadline, variant, models):
+            if kind == "done":
+                model_router.observe_turn(variant, models, time.monotonic() - started, user_msg, value)
+            yield (kind, value)
+    finally:
+        deadline.clear()
+
+
+def generate_bot_reply(conversation: List[Dict], route_key: Optional[str] = None) -> str:
+    """
+    会話履歴( conversation )をOpenAIに渡し、tools (tool_calls) 対応で応答を受け取る。
+    tool_calls が返ってきたら対応する関数を並列に実行して結果を再度LLMに渡す。
+    これを最大 MAX_TOOL_ROUNDS ラウンド繰り返し、最終テキストを得る。
+    ターン全体は TURN_DEADLINE_SEC 以内に終える (deadline.py)。
+    route_key (sessionId) は model_router の A/B 振り分けに使う。
+    """
+    logger.debug("generate_bot_reply start (%d messages)", len(conversation))
+    for kind, value in _turn_events(conversation, route_key):
+        if kind == "done":
+            return value
+    return "[Error] No response from OpenAI"
+
+
+def generate_bot_reply_stream(conversation: List[Dict], route_key: Optional[str] = None):
+    """
+    generate_bot_reply のストリーミング版 (SSE用)。
+    以下のイベントをyieldする:
+      ("delta", テキスト断片)   : モデルのトークンが届くたび
+      ("function_call", 関数名) : 関数実行を開始するとき (tool 1件ごと)
+      ("done", 最終テキスト)     : 最後に1回
+    エラー時は generate_bot_reply と同じ形式の文字列を ("done", ...) で返す。
+    """
+    logger.debug("generate_bot_reply_stream start (%d messages)", len(conversation))
+    yield from _turn_events(conversation, route_key)
+
+
+# 履歴要約に使うモデル (応答待ちには影響しないので軽量モデルで十分)
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-4o-mini")
+
+
+def summarize_conversation(previous_summary: str, messages: List[Dict]):
+    """
+    これまでの要約に messages の内容を畳み込んだ新しい要約を返す。失敗時は None。
+    history_manager からバックグラウンドで呼ばれる。
+    """
+    load_openai().api_key = os.environ.get("OPENAI_API_KEY", "")
+    prompt = (
+        "以下は建設機械の顧客ポータルでのチャットの、これまでの要約と続きのやりとりです。\n"
+        "車両(機種・号機)、問い合わせ内容、調べた結果、担当者への連絡状況など、"
+        "今後の回答に必要な事実を漏らさず、簡潔な日本語の箇条書きで要約し直してください。\n\n"
+        f"【これまでの要約】\n{previous_summary or '(なし)'}\n\n"
+        f"【続きのやりとり】\n{format_messages_for_summary(messages)}"
+    )
+    messages = [{"role": "user", "content": prompt}]
+    try:
+        # 応答待ちのターンを優先し、要約は空いているときに送る
+        with llm_scheduler.slot(PRIORITY_BACKGROUND, estimate_request_tokens(messages, False)) as ticket, \
+                metrics.span("llm", metrics.llm_call_seconds, model=SUMMARY_MODEL, call="summary"):
+            response = _raw_create(
+                model=SUMMARY_MODEL,
+                messages=messages,
+                temperature=0.2
+            )
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                ticket.settle((usage.prompt_tokens or 0) + (usage.completion_tokens or 0))
+    except Exception as e:
+        metrics.llm_errors_total.inc(model=SUMMARY_MODEL, call="summary")
+        logger.warning("summary OpenAI API call exception: %s", e)
+        return None
+    metrics.record_usage(getattr(response, "usage", None), SUMMARY_MODEL)
+    if not response.choices or not response.choices[0].message.content:
+        return None
+    return response.choices[0].message.content.strip()
 
 
+_KNOWN_TOOLS = {fn_def["name"] for fn_def in function_definitions}
+
+
+def _run_tool_call(tool_call: Dict) -> Dict:
+    """tool_call 1件を実行し、tool role のメッセージを返す。"""
+    try:
+        fn_args = json.loads(tool_call["arguments"] or "{}")
+    except json.JSONDecodeError as ex:
+        logger.warning("JSONDecodeError in tool_call arguments: %s", ex)
+        fn_args = {}
+
+    # 未知の関数名でメトリクスのラベルが増えないようにする
+    tool_label = tool_call["name"] if tool_call["name"] in _KNOWN_TOOLS else "unknown"
+    try:
+        with metrics.span("tool", metrics.tool_seconds, tool=tool_label):
+            result_content = handle_function_call(tool_call["name"], fn_args)
+    except Exception as e:
+        # 1つの tool の失敗でターン全体を落とさず、エラーとしてモデルに返す
+        logger.warning("tool %s raised: %s", tool_call["name"], e)
+        result_content = {"success": False, "error": str(e)}
+    if not result_content.get("success", False):
+        metrics.tool_errors_total.inc(tool=tool_label)
+
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call["id"],
+        "content": json.dumps(tool_result_compactor.compact(tool_label, result_content), ensure_ascii=False)
+    }
+
+
+def _timed_out_tool_message(tool_call: Dict) -> Dict:
+    """締め切りまでに終わらなかった tool の結果 (モデルが状況を説明できるようにエラーとして返す)。"""
+    tool_label = tool_call["name"] if tool_call["name"] in _KNOWN_TOOLS else "unknown"
+    metrics.tool_errors_total.inc(tool=tool_label)
+    metrics.deadline_exceeded_total.inc(stage="tool")
+    logger.warning("tool %s did not finish before the turn deadline", tool_call["name"])
+    message = "この情報は時間内に取得できませんでした。取得できた情報だけで回答し、必要なら再度お試しいただくよう案内してください。"
+    if tool_call["name"] == "notifyStaff":
+        # 通知は実行中のスレッドで後から届くことがあるので、再送させない (二重通知になる)
+        message = "通知の完了を時間内に確認できませんでした。通知は届いている可能性があるため、再送せずにその旨を案内してください。"
+    return {
+        "role": "tool",
+        "tool_call_id": tool_call["id"],
+        "content": json.dumps({
+            "success": False,
+            "errorCode": "DEADLINE_EXCEEDED",
+            "error": "時間内に結果を取得できませんでした。",
+            "message": message
+        }, ensure_ascii=False)
+    }
+
+
+def handle_tool_calls(tool_calls: List[Dict], turn_deadline: Optional[Deadline] = None) -> List[Dict]:
+    """
+    1レスポンス内の複数 tool_calls を上限付きスレッドプールで並列実行する。
+    戻り値は tool_calls と同じ順序の tool role メッセージのリスト。
+    turn_deadline があれば、最終回答の時間 (DEADLINE_ANSWER_RESERVE_SEC) を残して待ち、
+    間に合わなかった tool は DEADLINE_EXCEEDED のエラー結果にする (実行中のスレッドは止められないので結果を捨てる)。
+    """
+    if turn_deadline is None and len(tool_calls) == 1:
+        return [_run_tool_call(tool_calls[0])]
+    logger.debug("running %d tool calls in parallel", len(tool_calls))
+    # リクエストID・span の記録先・締め切りをワーカースレッドに引き継ぐ
+    futures = [_tool_executor.submit(contextvars.copy_context().run, _run_tool_call, tc) for tc in tool_calls]
+    timeout = None if turn_deadline is None else turn_deadline.timeout(reserve=DEADLINE_ANSWER_RESERVE_SEC)
+    wait(futures, timeout=timeout)
+    return [future.result() if future.done() else _timed_out_tool_message(tc)
+            for future, tc in zip(futures, tool_calls)]
+
+
+def prefetch_machine_info(conversation: List[Dict], user_msg: str) -> int:
+    """
+    発言に (機種, 号機) が含まれていれば、最初の completion の前に getMachineInfo を実行し、
+    モデルが呼んだ場合と同じ形 (assistant の tool_calls + tool 結果) を今回の発言の後ろに追加する。
+    モデルは結果を見てそのまま回答できるので、よくある質問では tool のための往復が1回減る。
+    追加した照会の件数を返す。
+    """
+    if not MACHINE_PREFETCH_ENABLED:
+        return 0
+    candidates = extract_machine_candidates(user_msg, repository.snapshot())
+    if not candidates:
+        metrics.machine_prefetch_total.inc(result="none")
+        return 0
+
+    tool_calls = [
+        {"id": f"{PREFETCH_CALL_ID_PREFIX}{i}", "name": "getMachineInfo",
+         "arguments": json.dumps({"model": model, "serial": serial}, ensure_ascii=False)}
+        for i, (model, serial) in enumerate(candidates)
+    ]
+    results = handle_tool_calls(tool_calls)
+    conversation.append(_assistant_tool_message(None, tool_calls))
+    conversation.extend(results)
+
+    found = False
+    for msg in results:
+        try:
+            found = found or bool(json.loads(msg["content"]).get("data", {}).get("found"))
+        except (ValueError, AttributeError):
+            pass
+    metrics.machine_prefetch_total.inc(result="hit" if found else "miss")
+    logger.debug("prefetched getMachineInfo for %s (found=%s)", candidates, found)
+    return len(tool_calls)
+
+
+def record_prefetch_followup(conversation: List[Dict]):
+    """先読みしたターンで、モデルがさらに tool を呼んだか (先読みで往復を省けたか) を記録する。"""
+    last_user = max((i for i, m in enumerate(conversation) if m.get("role") == "user"), default=-1)
+    prefetched = needed_tools = False
+    for m in conversation[last_user + 1:]:
+        for tc in m.get("tool_calls") or []:
+            if tc["id"].startswith(PREFETCH_CALL_ID_PREFIX):
+                prefetched = True
+            else:
+                needed_tools = True
+    if prefetched:
+        metrics.machine_prefetch_followup_total.inc(needed_tools=str(needed_tools).lower())
+
 
 def handle_function_call(fn_name: str, fn_args: dict) -> dict:
-    if DEBUG:
-        print(f"[DEBUG] function_call: {fn_name} with args={fn_args}")
+    logger.debug("function_call: %s with args=%s", fn_name, fn_args)
 
     if fn_name == "getMachineInfo":
         model = fn_args.get("model", "")
@@ -221,12 +782,18 @@ def handle_function_call(fn_name: str, fn_args: dict) -> dict:
             "success": True,
             "data": results
         }
+    elif fn_name == DETAIL_TOOL_NAME:
+        return tool_result_compactor.detail(fn_args.get("detailRef", ""), fn_args.get("path", ""),
+                                            fn_args.get("offset", 0))
     elif fn_name == "notifyStaff":
         resp = notifyStaff(**fn_args)
-        return {
+        result = {
             "success": resp.get("success", False),
             "errorMessage": resp.get("errorMessage", "")
         }
+        if resp.get("message"):
+            result["message"] = resp["message"]
+        return result
     else:
         return {
             "success": False,
@@ -0,0 +1,196 @@
+# chat_jobs.py
+#
+# チャットのジョブモード (/api/chat/jobs)。
+# - POST でターンを受け付けてすぐにジョブID を返し、結果は long-poll か SSE で受け取る
+#   (LLM + tool の 5〜20 秒のあいだ、gunicorn のワーカーを1つ占有し続けない)
+# - ジョブは CHAT_JOB_WORKERS 本のスレッドで実行する。実行待ちが CHAT_JOB_QUEUE_DEPTH 件を超えたら
+#   QueueFull (run.py で 429 + Retry-After) にする
+# - 同じセッションのターンは受け付けた順に1件ずつ実行し、別のセッションのターンは並列に実行する
+# - ジョブはプロセス内にだけ持つ。ジョブの状態を問い合わせるリクエストは、受け付けたワーカーに届く必要がある
+#   (gunicorn ならワーカー1つ + --threads で動かす)。ワーカーが複数のとき (SERVER_WORKER_PROCESSES > 1。
+#   gunicorn.conf.py が設定する) は available() が False になり、ジョブの API は 503 を返す
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# ジョブを実行するスレッド数 (= 同時に処理するターン数)
+CHAT_JOB_WORKERS = int(os.environ.get("CHAT_JOB_WORKERS", "8"))
+# 実行待ちにできるジョブ数 (実行中を除く)。超えたら 429
+CHAT_JOB_QUEUE_DEPTH = int(os.environ.get("CHAT_JOB_QUEUE_DEPTH", "32"))
+# 終わったジョブの結果を保持する秒数
+CHAT_JOB_RESULT_TTL_SEC = float(os.environ.get("CHAT_JOB_RESULT_TTL_SEC", "300"))
+# Retry-After の上限 (秒)
+CHAT_JOB_RETRY_AFTER_MAX_SEC = int(os.environ.get("CHAT_JOB_RETRY_AFTER_MAX_SEC", "60"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def server_worker_processes() -> int:
+    """アプリを動かしているワーカープロセスの数 (gunicorn.conf.py の when_ready が fork 前に設定する)。"""
+    return int(os.environ.get("SERVER_WORKER_PROCESSES", "1"))
+
+
+class QueueFull(Exception):
+    """実行待ちのジョブが上限に達した。retry_after は再送までの目安 (秒)。"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"chat job queue is full (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class ChatJob:
+    def __init__(self, session_id: str, fn: Callable[[], Dict]):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.status = QUEUED
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._fn = fn
+        # 受け付けたリクエストのリクエストID を実行スレッドに引き継ぐ
+        self._context = contextvars.copy_context()
+        self._done = threading.Event()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """終わるまで (最大 timeout 秒) 待つ。終わっていれば True。"""
+        return self._done.wait(timeout)
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def to_dict(self) -> Dict:
+        payload = {"jobId": self.id, "status": self.status}
+        if self.status == DONE:
+            payload["result"] = self.result
+        elif self.status == FAILED:
+            payload["error"] = self.error
+        return payload
+
+
+class ChatJobQueue:
+    def __init__(self, workers: int = CHAT_JOB_WORKERS, queue_depth: int = CHAT_JOB_QUEUE_DEPTH,
+                 result_ttl_sec: float = CHAT_JOB_RESULT_TTL_SEC):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.result_ttl_sec = result_ttl_sec
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ChatJob] = {}
+        # sessionId -> まだ始まっていないジョブ (先頭から順に実行する)
+        self._waiting: Dict[str, Deque[ChatJob]] = {}
+        # 実行中 (executor に渡した) ジョブがあるセッション
+        self._active_sessions = set()
+        self._queued = 0
+        self._running = 0
+        # 直近のジョブ実行時間の移動平均 (Retry-After の見積もりに使う)
+        self._avg_run_sec = 5.0
+        self._accepted = 0
+        self._rejected = 0
+
+    def submit(self, session_id: str, fn: Callable[[], Dict]) -> ChatJob:
+        """
+        fn (ターンを処理して結果の dict を返す) をジョブとして受け付ける。
+        同じセッションの前のジョブが終わるまでは始めない。実行待ちが上限なら QueueFull。
+        """
+        job = ChatJob(session_id, fn)
+        with self._lock:
+            self._purge_locked()
+            if self._queued >= self.queue_depth:
+                self._rejected += 1
+                metrics.chat_jobs_total.inc(result="rejected")
+                raise QueueFull(self._retry_after_locked())
+            self._jobs[job.id] = job
+            self._queued += 1
+            self._accepted += 1
+            start_now = session_id not in self._active_sessions
+            if start_now:
+                self._active_sessions.add(session_id)
+            else:
+                self._waiting.setdefault(session_id, deque()).append(job)
+        metrics.chat_jobs_total.inc(result="accepted")
+        if start_now:
+            self._executor.submit(self._run, job)
+        return job
+
+    def available(self) -> bool:
+        """ジョブモードを使えるか (ジョブの問い合わせが必ずこのプロセスに届く = ワーカーが1つ)。"""
+        return server_worker_processes() <= 1
+
+    def get(self, job_id: str) -> Optional[ChatJob]:
+        with self._lock:
+            self._purge_locked()
+            return self._jobs.get(job_id)
+
+    def _run(self, job: ChatJob):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        job.status = RUNNING
+        job.started_at = time.monotonic()
+        metrics.stage_seconds.observe(job.started_at - job.created_at, stage="job_queue_wait")
+        try:
+            job.result = job._context.run(job._fn)
+            job.status = DONE
+        except Exception as e:
+            # セッションが終わっていた等も含むので、スタックトレースは DEBUG のときだけ出す
+            logger.warning("chat job %s failed: %s", job.id, e, exc_info=logger.isEnabledFor(logging.DEBUG))
+            job.error = str(e)
+            job.status = FAILED
+        job.finished_at = time.monotonic()
+        job._done.set()
+        metrics.chat_jobs_total.inc(result=job.status)
+
+        with self._lock:
+            self._running -= 1
+            self._avg_run_sec = 0.8 * self._avg_run_sec + 0.2 * (job.finished_at - job.started_at)
+            waiting = self._waiting.get(job.session_id)
+            next_job = waiting.popleft() if waiting else None
+            if waiting is not None and not waiting:
+                del self._waiting[job.session_id]
+            if next_job is None:
+                self._active_sessions.discard(job.session_id)
+        if next_job is not None:
+            self._executor.submit(self._run, next_job)
+
+    def _retry_after_locked(self) -> int:
+        # 実行待ちがワーカー数ぶん進むごとに平均実行時間1回分かかるとみなす
+        rounds = self._queued / max(1, self.workers)
+        return max(1, min(CHAT_JOB_RETRY_AFTER_MAX_SEC, math.ceil(rounds * self._avg_run_sec)))
+
+    def _purge_locked(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl_sec]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "available": self.available(),
+                "workers": self.workers,
+                "queueDepth": self.queue_depth,
+                "queued": self._queued,
+                "running": self._running,
+                "jobs": len(self._jobs),
+                "accepted": self._accepted,
+                "rejected": self._rejected,
+                "avgRunSec": round(self._avg_run_sec, 3),
+            }
+
+
+chat_jobs = ChatJobQueue()
@@ -0,0 +1,255 @@
+# data_repository.py
+#
+# users.json / customer_machine_list.json をプロセス内に一度だけ読み込み、
+# 検索用のハッシュインデックスを構築して保持する共有リポジトリ。
+# ファイルの mtime が変わったらバックグラウンドで再構築し、参照を差し替える。
+# (リクエスト処理側ではディスクI/Oを行わない)
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+USERS_FILE = os.environ.get("USERS_FILE", "users.json")
+MACHINE_LIST_FILE = os.environ.get("MACHINE_LIST_FILE", "customer_machine_list.json")
+# mtime 監視の間隔(秒)
+RELOAD_CHECK_INTERVAL = float(os.environ.get("DATA_RELOAD_INTERVAL", "2.0"))
+
+
+def _file_mtime(file_path: str) -> Optional[float]:
+    try:
+        return os.stat(file_path).st_mtime
+    except OSError:
+        return None
+
+
+def _read_json(file_path: str):
+    """JSONファイルを読み込む。存在しない場合は空リストを返す。"""
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def normalize_search_text(text) -> str:
+    """検索用の正規化 (全角/半角の統一 + 大文字小文字を無視)。"""
+    return unicodedata.normalize("NFKC", str(text or "")).casefold().strip()
+
+
+# ==========================================
+# 1) スナップショット (構築後は変更しない)
+# ==========================================
+class DataSnapshot:
+    """
+    ある時点の users / machine_list と、そこから作ったインデックス一式。
+    構築後は読み取り専用として扱い、再読込時は新しいスナップショットを丸ごと作る。
+    """
+
+    def __init__(self, users: List[Dict], machine_list: List[Dict],
+                 users_mtime: Optional[float], machines_mtime: Optional[float]):
+        self.users = users
+        self.machine_list = machine_list
+        self.users_mtime = users_mtime
+        self.machines_mtime = machines_mtime
+
+        # userId -> user
+        self.users_by_id: Dict[str, Dict] = {}
+        for u in users:
+            if "userId" in u:
+                self.users_by_id[u["userId"]] = u
+
+        # companyId -> company block / 台数
+        self.companies_by_id: Dict[str, Dict] = {}
+        self.machine_count_by_company: Dict[str, int] = {}
+        # (model, serial) -> [(companyId, machine), ...]
+        self.machines_by_model_serial: Dict[Tuple[str, str], List[Tuple[str, Dict]]] = {}
+        # machineId -> (companyId, machine)
+        self.machines_by_id: Dict[str, Tuple[str, Dict]] = {}
+        # 機種名の語彙 (発言から機種を見つけるのに使う)
+        self.models = set()
+
+        for company_block in machine_list:
+            c_id = company_block.get("companyId")
+            c_machines = company_block.get("machines", [])
+            self.companies_by_id[c_id] = company_block
+            self.machine_count_by_company[c_id] = len(c_machines)
+            for mach in c_machines:
+                key = (mach.get("model"), mach.get("serial"))
+                self.machines_by_model_serial.setdefault(key, []).append((c_id, mach))
+                self.models.add(key[0])
+                if "machineId" in mach:
+                    self.machines_by_id[mach["machineId"]] = (c_id, mach)
+
+        # /api/users 用の一覧と前方一致検索のインデックス
+        self.user_directory = UserDirectory(users, self.machine_count_by_company)
+
+    @property
+    def version(self) -> str:
+        """データファイルの版を表す文字列 (ETag 等に利用)。"""
+        return f"{self.users_mtime or 0}-{self.machines_mtime or 0}"
+
+
+class UserDirectory:
+    """
+    /api/users 用のユーザ一覧 (会社ごとの台数を結合済み) と、前方一致検索用のソート済みインデックス。
+    検索キーは userId / userName / companyName の値全体と、空白で区切った各語
+    ("山田 太郎" は "山田" でも "太郎" でも見つかる)。結果は users.json の順に返す。
+    """
+
+    SEARCH_FIELDS = ("userId", "userName", "companyName")
+
+    def __init__(self, users: List[Dict], machine_count_by_company: Dict[str, int]):
+        self.rows: List[Dict] = []
+        for u in users:
+            if "userId" not in u:
+                continue
+            c_id = u.get("companyId", "")
+            self.rows.append({
+                "userId": u["userId"],
+                "userName": u.get("userName", ""),
+                "companyId": c_id,
+                "companyName": u.get("companyName", ""),
+                "machineCount": machine_count_by_company.get(c_id, 0)
+            })
+
+        entries = []
+        for i, row in enumerate(self.rows):
+            terms = set()
+            for field in self.SEARCH_FIELDS:
+                value = normalize_search_text(row[field])
+                if value:
+                    terms.add(value)
+                    terms.update(value.split())
+            entries.extend((term, i) for term in terms)
+        entries.sort()
+        self._terms = [term for term, _ in entries]
+        self._row_ids = [i for _, i in entries]
+
+    def search(self, query: str = "", offset: int = 0, limit: Optional[int] = None) -> Tuple[int, List[Dict]]:
+        """query に前方一致するユーザを (該当件数, offset から limit 件) で返す。query が空なら全件が対象。"""
+        end = None if limit is None else offset + limit
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return len(self.rows), self.rows[offset:end]
+        lo = bisect_left(self._terms, prefix)
+        hi = bisect_left(self._terms, prefix + "\U0010ffff", lo)
+        row_ids = sorted(set(self._row_ids[lo:hi]))
+        return len(row_ids), [self.rows[i] for i in row_ids[offset:end]]
+
+
+# ==========================================
+# 2) リポジトリ本体
+# ==========================================
+class DataRepository:
+    """
+    users.json / customer_machine_list.json の共有リポジトリ。
+    - 初回アクセス時に一度だけ読み込み、以降はメモリ上のインデックスで O(1) 検索
+    - 監視スレッドが mtime の変化を検知したら新しいスナップショットを作って差し替える
+    """
+
+    def __init__(self, users_path: str = USERS_FILE,
+                 machines_path: str = MACHINE_LIST_FILE,
+                 check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.users_path = users_path
+        self.machines_path = machines_path
+        self.check_interval = check_interval
+        self._snapshot: Optional[DataSnapshot] = None
+        self._lock = threading.Lock()
+        self._watcher_pid: Optional[int] = None
+
+    # ---------- 読み込み ----------
+    def _build_snapshot(self, previous: Optional[DataSnapshot]) -> DataSnapshot:
+        users_mtime = _file_mtime(self.users_path)
+        machines_mtime = _file_mtime(self.machines_path)
+
+        try:
+            users = _read_json(self.users_path)
+        except json.JSONDecodeError:
+            logger.error("%s decode error", self.users_path)
+            # 壊れたファイルは採用せず、前回の内容を維持する
+            users = previous.users if previous else []
+            users_mtime = previous.users_mtime if previous else users_mtime
+
+        try:
+            machine_list = _read_json(self.machines_path)
+        except json.JSONDecodeError:
+            logger.error("%s decode error", self.machines_path)
+            machine_list = previous.machine_list if previous else []
+            machines_mtime = previous.machines_mtime if previous else machines_mtime
+
+        return DataSnapshot(users, machine_list, users_mtime, machines_mtime)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        mtime が変わっていればスナップショットを再構築する。
+        再構築した場合は True を返す。
+        """
+        with self._lock:
+            current = self._snapshot
+            if (not force and current is not None
+                    and current.users_mtime == _file_mtime(self.users_path)
+                    and current.machines_mtime == _file_mtime(self.machines_path)):
+                return False
+            # 参照の代入のみで差し替える (読み手はロック不要)
+            self._snapshot = self._build_snapshot(current)
+            if current is not None:
+                logger.info("data repository reloaded (version=%s)", self._snapshot.version)
+            return True
+
+    def _watch_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("data repository reload failed")
+
+    def _ensure_watcher(self):
+        # fork 後のワーカーではスレッドが引き継がれないため pid ごとに起動する
+        pid = os.getpid()
+        if self._watcher_pid == pid or self.check_interval <= 0:
+            return
+        with self._lock:
+            if self._watcher_pid == pid:
+                return
+            self._watcher_pid = pid
+            t = threading.Thread(target=self._watch_loop, name="data-repository-watcher", daemon=True)
+            t.start()
+
+    def snapshot(self) -> DataSnapshot:
+        """現在のスナップショットを返す。初回のみ同期的に読み込む。"""
+        snap = self._snapshot
+        if snap is None:
+            self.reload(force=True)
+            snap = self._snapshot
+        self._ensure_watcher()
+        return snap
+
+    # ---------- 検索 ----------
+    def find_machines(self, model: str, serial: str) -> List[Tuple[str, Dict]]:
+        """(model, serial) に一致する [(companyId, machine), ...] を返す。"""
+        return self.snapshot().machines_by_model_serial.get((model, serial), [])
+
+    def find_machine_by_id(self, machine_id: str) -> Optional[Tuple[str, Dict]]:
+        return self.snapshot().machines_by_id.get(machine_id)
+
+    def find_company(self, company_id: str) -> Optional[Dict]:
+        return self.snapshot().companies_by_id.get(company_id)
+
+    def find_user(self, user_id: str) -> Optional[Dict]:
+        return self.snapshot().users_by_id.get(user_id)
+
+    def machine_count(self, company_id: str) -> int:
+        return self.snapshot().machine_count_by_company.get(company_id, 0)
+
+    def all_users(self) -> List[Dict]:
+        return self.snapshot().users
+
+
+# アプリ全体で共有するインスタンス
+repository = DataRepository()
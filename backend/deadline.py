@@ -0,0 +1,58 @@
+# deadline.py
+#
+# 1ターン (ユーザ発言1件への応答) の締め切り。
+# - chat_bot.generate_bot_reply(_stream) の開始時に TURN_DEADLINE_SEC 後の締め切りを作り、contextvars で持ち回る
+#   (tool を実行するスレッドにも metrics のリクエストID と同じく copy_context() で引き継がれる)
+# - LLM 呼び出し・tool・外部 API の timeout は、固定値ではなく残り時間から決める
+# - 締め切りを過ぎた場合は TIMEOUT_REPLY (何も返せていない) か、途中までの回答 + TRUNCATED_NOTE を返す
+import contextvars
+import os
+import time
+from typing import Optional
+
+TURN_DEADLINE_SEC = float(os.environ.get("TURN_DEADLINE_SEC", "60"))
+
+# 締め切りまでに回答を作れなかったときの応答 (answer_cache などはエラー応答として扱う)
+TIMEOUT_REPLY = "[Timeout] 回答の作成に時間がかかりすぎたため中断しました。お手数ですが、もう一度お試しください。"
+# 回答の途中で締め切りを過ぎたときに末尾に付ける注記
+TRUNCATED_NOTE = "\n\n(時間切れのため、回答を途中で打ち切りました)"
+
+
+class DeadlineExceeded(Exception):
+    """ターンの締め切りを過ぎた。"""
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None, reserve: float = 0.0) -> float:
+        """残り時間から reserve を引いた値 (cap があればそれ以下) を timeout として返す。"""
+        remaining = max(0.0, self.remaining() - reserve)
+        return remaining if cap is None else min(cap, remaining)
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)
+
+
+def start(seconds: float = TURN_DEADLINE_SEC) -> Deadline:
+    """ターンの締め切りを作って現在のコンテキストに設定する。"""
+    deadline = Deadline(seconds)
+    _current.set(deadline)
+    return deadline
+
+
+def clear():
+    _current.set(None)
+
+
+def current() -> Optional[Deadline]:
+    """現在のターンの締め切り (ターンの外なら None)。"""
+    return _current.get()
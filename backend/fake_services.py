@@ -0,0 +1,395 @@
+# fake_services.py
+#
+# ベンチマーク/負荷試験用の外部サービスのスタンドイン (ローカルHTTPサーバ)。
+# - FakeOpenAIServer: OpenAI 互換の POST /v1/chat/completions (stream あり/なし, tool_calls 対応)
+# - FakeSearchServer: DocumentQueryWithAnswer 互換の検索API
+# どちらも応答までの待ち時間・ゆらぎ・エラー率を指定でき、本物のキーやネットワークなしで
+# アプリ全体 (HTTP → Flask → chat_bot → tool → 外部API) を動かせる。
+#
+# 単体で起動する場合:
+#   python fake_services.py --openai-port 8081 --search-port 8082 --latency 0.3 --tool-mode machine
+import argparse
+import json
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# tool_mode: モデルが最初の呼び出しで返す tool_calls
+#   none    : tool を使わずテキストで答える
+#   machine : getMachineInfo を1件
+#   manual  : searchManual を1件
+#   both    : getMachineInfo と searchManual を並列に
+TOOL_MODES = ("none", "machine", "manual", "both")
+
+
+class _FakeServer:
+    """ThreadingHTTPServer をバックグラウンドスレッドで動かす共通部分。"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _delay(self, base: float):
+        if base > 0:
+            time.sleep(max(0.0, base * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def _count(self, failed: bool):
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+
+    def _should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def handle_post(self, handler: BaseHTTPRequestHandler, body: Dict):
+        raise NotImplementedError
+
+    def handle_get(self, handler: BaseHTTPRequestHandler):
+        _send_json(handler, 404, {"error": "not found"})
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    body = {}
+                server.handle_post(self, body)
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def do_HEAD(self):
+                # 接続の確立 (warmup.py) 用。keep-alive のまま本文なしで返す
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    # ヘッジで負けた試行や締め切り超えで、クライアントが途中で接続を切った
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _send_json(handler: BaseHTTPRequestHandler, status: int, payload: Dict, headers: Optional[Dict] = None):
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(data)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+class FakeOpenAIServer(_FakeServer):
+    """
+    OpenAI 互換の chat.completions。
+      latency      : 最初のバイトまでの秒数 (stream なしの場合は応答全体)
+      token_delay  : stream 時のチャンク間隔 (秒)
+      reply_chunks : 最終回答を何チャンクに分けて返すか
+      tool_mode    : TOOL_MODES のいずれか
+      machine      : tool 引数に使う (model, serial)
+      slow_rate    : 最初のバイトまでを slow_factor 倍に遅らせる割合 (裾の長いレイテンシの再現)
+      empty_rate   : tool 結果の後の回答を空で返す割合
+      rpm_limit    : 直近60秒のリクエスト数の上限。超えたら 429 + Retry-After (0 で無制限)。
+                     応答には x-ratelimit-*-requests ヘッダを付ける
+      mini_latency_factor : モデル名が "-mini" で終わるリクエストの待ち時間の倍率 (軽いモデルの再現)
+    """
+
+    def __init__(self, tool_mode: str = "machine", token_delay: float = 0.0, reply_chunks: int = 20,
+                 machine=("PC200-8", "100001"), slow_rate: float = 0.0, slow_factor: float = 10.0,
+                 empty_rate: float = 0.0, rpm_limit: int = 0, mini_latency_factor: float = 1.0, **kwargs):
+        if tool_mode not in TOOL_MODES:
+            raise ValueError(f"tool_mode must be one of {TOOL_MODES}")
+        self.tool_mode = tool_mode
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.empty_rate = empty_rate
+        self.rpm_limit = rpm_limit
+        self.mini_latency_factor = mini_latency_factor
+        self.rate_limited = 0
+        self._recent = deque()
+        self.token_delay = token_delay
+        self.reply_chunks = reply_chunks
+        self.machine = machine
+        super().__init__(**kwargs)
+
+    def _tool_calls(self) -> List[Dict]:
+        model, serial = self.machine
+        calls = []
+        if self.tool_mode in ("machine", "both"):
+            calls.append(("getMachineInfo", {"model": model, "serial": serial}))
+        if self.tool_mode in ("manual", "both"):
+            calls.append(("searchManual", {"model": model, "serial": serial,
+                                           "documentType": "取扱説明書", "query": "エンジンオイルの交換手順"}))
+        return [
+            {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+             "function": {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}}
+            for name, args in calls
+        ]
+
+    def _plan(self, body: Dict):
+        """(tool_calls, テキスト) を決める。ユーザ発言の直後で tool が使えるときだけ tool_calls を返す。"""
+        messages = body.get("messages") or [{}]
+        wants_tools = bool(body.get("tools")) and body.get("tool_choice") != "none"
+        if wants_tools and self.tool_mode != "none" and messages[-1].get("role") == "user":
+            return self._tool_calls(), None
+        if messages[-1].get("role") == "tool" and self.empty_rate > 0 and random.random() < self.empty_rate:
+            return None, ""
+        text = "ご質問の件について確認しました。" * 4
+        return None, text
+
+    @staticmethod
+    def _usage(body: Dict, completion_text: str) -> Dict:
+        prompt_chars = sum(len(json.dumps(m, ensure_ascii=False)) for m in body.get("messages") or [])
+        prompt_tokens = prompt_chars // 4 + 1
+        completion_tokens = len(completion_text) // 2 + 1
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0}}
+
+    def _rate_limit_headers(self) -> Optional[Dict]:
+        """rpm_limit を超えていれば None、そうでなければ今回の分を数えて x-ratelimit ヘッダを返す。"""
+        if self.rpm_limit <= 0:
+            return {}
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and now - self._recent[0] >= 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.rpm_limit:
+                self.rate_limited += 1
+                return None
+            self._recent.append(now)
+            reset = 60 - (now - self._recent[0])
+            return {"x-ratelimit-limit-requests": str(self.rpm_limit),
+                    "x-ratelimit-remaining-requests": str(self.rpm_limit - len(self._recent)),
+                    "x-ratelimit-reset-requests": f"{reset:.3f}s"}
+
+    def handle_get(self, handler):
+        # models.retrieve (warmup.py が接続を張るのに使う)
+        if handler.path.startswith("/v1/models/"):
+            _send_json(handler, 200, {"id": handler.path.rsplit("/", 1)[-1], "object": "model", "created": 0,
+                                      "owned_by": "fake"})
+            return
+        super().handle_get(handler)
+
+    def handle_post(self, handler, body):
+        headers = self._rate_limit_headers()
+        if headers is None:
+            retry_after = max(1, int(60 - (time.monotonic() - self._recent[0])) + 1)
+            _send_json(handler, 429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                                "code": "rate_limit_exceeded"}},
+                       {"Retry-After": str(retry_after), "x-ratelimit-remaining-requests": "0",
+                        "x-ratelimit-reset-requests": f"{retry_after}s"})
+            return
+        failed = self._should_fail()
+        self._count(failed)
+        slow = self.slow_rate > 0 and random.random() < self.slow_rate
+        factor = self.mini_latency_factor if str(body.get("model", "")).endswith("-mini") else 1
+        self._delay(self.latency * factor * (self.slow_factor if slow else 1))
+        if failed:
+            _send_json(handler, 503, {"error": {"message": "fake overloaded", "type": "server_error"}})
+            return
+
+        tool_calls, text = self._plan(body)
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()),
+                "model": body.get("model", "gpt-4o")}
+        if not body.get("stream"):
+            message = {"role": "assistant", "content": text}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            _send_json(handler, 200, dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": message,
+                "finish_reason": "tool_calls" if tool_calls else "stop"}],
+                usage=self._usage(body, text or json.dumps(tool_calls))), headers)
+            return
+        self._stream(handler, body, base, tool_calls, text, headers)
+
+    def _stream(self, handler, body, base, tool_calls, text, headers):
+        # 本物と同じく chunked 転送 + keep-alive で返す
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+
+        def write_chunk(data: bytes):
+            handler.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            handler.wfile.flush()
+
+        def send(choices, **extra):
+            chunk = dict(base, object="chat.completion.chunk", choices=choices, **extra)
+            write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        if tool_calls:
+            for i, tc in enumerate(tool_calls):
+                args = tc["function"]["arguments"]
+                send([{"index": 0, "delta": {"tool_calls": [{
+                    "index": i, "id": tc["id"], "type": "function",
+                    "function": {"name": tc["function"]["name"], "arguments": ""}}]}, "finish_reason": None}])
+                half = len(args) // 2
+                for part in (args[:half], args[half:]):
+                    send([{"index": 0, "delta": {"tool_calls": [{"index": i, "function": {"arguments": part}}]},
+                           "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": "tool_calls"}])
+        else:
+            size = max(1, len(text) // max(1, self.reply_chunks))
+            for start in range(0, len(text), size):
+                if start:
+                    self._delay(self.token_delay)
+                send([{"index": 0, "delta": {"content": text[start:start + size]}, "finish_reason": None}])
+            send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send([], usage=self._usage(body, text or json.dumps(tool_calls)))
+        write_chunk(b"data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+
+class FakeSearchServer(_FakeServer):
+    """DocumentQueryWithAnswer 互換: {"topNResults": {"openAiAnswer": ..., "results": [...]}} を返す。"""
+
+    def handle_post(self, handler, body):
+        failed = self._should_fail()
+        self._count(failed)
+        self._delay(self.latency)
+        if failed:
+            _send_json(handler, 503, {"error": "fake search unavailable"})
+            return
+        query = body.get("Query", "")
+        _send_json(handler, 200, {"topNResults": {
+            "openAiAnswer": f"{query} については手順書の該当ページを参照してください。",
+            "results": [{"title": f"{body.get('DocumentType', '')} p.{i + 1}", "score": 1.0 - i * 0.1,
+                         "content": f"{query} に関する記述 {i + 1}"} for i in range(3)]
+        }})
+
+
+def _serve_in_child(conn, openai_kwargs: Dict, search_kwargs: Dict):
+    openai_server = FakeOpenAIServer(**openai_kwargs).start()
+    search_server = FakeSearchServer(**search_kwargs).start()
+    conn.send((openai_server.url, search_server.url))
+    while True:
+        command = conn.recv()
+        if command == "stats":
+            conn.send({"openaiRequests": openai_server.requests, "openaiErrors": openai_server.errors,
+                       "openaiRateLimited": openai_server.rate_limited,
+                       "searchRequests": search_server.requests, "searchErrors": search_server.errors})
+        elif command == "stop":
+            openai_server.stop()
+            search_server.stop()
+            conn.send(None)
+            return
+
+
+class FakeServicesProcess:
+    """
+    2つのスタンドインを子プロセスで動かす。
+    負荷試験中にスタンドイン側の処理がアプリと GIL を取り合わないよう、計測対象とはプロセスを分ける。
+    """
+
+    def __init__(self, openai_kwargs: Optional[Dict] = None, search_kwargs: Optional[Dict] = None):
+        self.openai_kwargs = openai_kwargs or {}
+        self.search_kwargs = search_kwargs or {}
+        self.openai_url = ""
+        self.search_url = ""
+        self._conn = None
+        self._process = None
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve_in_child, args=(child_conn, self.openai_kwargs, self.search_kwargs),
+                                    name="fake-services", daemon=True)
+        self._process.start()
+        self.openai_url, self.search_url = self._conn.recv()
+        return self
+
+    def stats(self) -> Dict:
+        self._conn.send("stats")
+        return self._conn.recv()
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._conn.send("stop")
+        self._conn.recv()
+        self._process.join(timeout=5)
+        self._process = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI / DocumentQueryWithAnswer のスタンドインを起動する")
+    parser.add_argument("--openai-port", type=int, default=8081)
+    parser.add_argument("--search-port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.3, help="OpenAI の応答待ち時間(秒)")
+    parser.add_argument("--search-latency", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tool-mode", choices=TOOL_MODES, default="machine")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="OpenAI の応答を10倍遅らせる割合")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="tool 結果の後の回答を空にする割合")
+    parser.add_argument("--rpm-limit", type=int, default=0, help="OpenAI の1分あたりのリクエスト上限 (超えたら 429)")
+    args = parser.parse_args()
+
+    openai_server = FakeOpenAIServer(port=args.openai_port, latency=args.latency, jitter=args.jitter,
+                                     error_rate=args.error_rate, tool_mode=args.tool_mode,
+                                     token_delay=args.token_delay, slow_rate=args.slow_rate,
+                                     empty_rate=args.empty_rate, rpm_limit=args.rpm_limit).start()
+    search_server = FakeSearchServer(port=args.search_port, latency=args.search_latency, jitter=args.jitter,
+                                     error_rate=args.error_rate).start()
+    print(f"OPENAI_BASE_URL={openai_server.url}/v1")
+    print(f"SEARCH_API_URL={search_server.url}/DocumentQueryWithAnswer")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        openai_server.stop()
+        search_server.stop()
+
+
+if __name__ == "__main__":
+    main()
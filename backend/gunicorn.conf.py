@@ -0,0 +1,44 @@
+# gunicorn.conf.py
+#
+# App Service などで gunicorn を使うときの設定 (リポジトリのルートから):
+#   gunicorn --chdir backend --config backend/gunicorn.conf.py run:app
+# - preload_app: マスターで run.py を import し、warmup.preload() で重い import とデータの読み込みを
+#   済ませてから fork する。ワーカーはそれを copy-on-write で共有するので、起動が速くメモリも増えにくい
+# - post_fork: 各ワーカーで warmup.start() を呼び、外部 API への接続を張る (/api/ops/ready はそれまで 503)
+# ワーカーは既定で1つ (スレッドで並列に処理する)。
+# セッションはワーカーごとのメモリにあるので、ワーカーを増やすときは SESSION_STORE を sqlite か redis にする
+# (memory のまま GUNICORN_WORKERS を2以上にすると起動しない)。
+# ジョブモード (/api/chat/jobs) はワーカーが1つのときだけ使える (複数なら 503。chat_jobs.py 参照)。
+import os
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("GUNICORN_WORKERS", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# 1ターンは TURN_DEADLINE_SEC (既定 60 秒) 以内に終わるので、それより長めにする
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    # マスター: fork の直前に1回だけ (preload_app のときはアプリの import が済んでいる)
+    session_store = os.environ.get("SESSION_STORE", "memory").lower()
+    if server.num_workers > 1 and session_store == "memory":
+        # ログインしたワーカーと別のワーカーに振られたリクエストが 401 になるので、起動させない
+        server.log.error("SESSION_STORE=memory ではワーカーを1つにしてください (workers=%d)。"
+                         "複数ワーカーにする場合は SESSION_STORE=sqlite か redis を設定してください。",
+                         server.num_workers)
+        sys.exit(1)
+    # ワーカー数をアプリに知らせる (fork するワーカーに環境変数として引き継がれる)
+    os.environ["SERVER_WORKER_PROCESSES"] = str(server.num_workers)
+    if server.num_workers > 1:
+        server.log.warning("ワーカーが %d あるため、ジョブモード (/api/chat/jobs) は 503 を返します。",
+                           server.num_workers)
+    if preload_app:
+        from warmup import warmup
+        warmup.preload(freeze_gc=True)
+
+
+def post_fork(server, worker):
+    from warmup import warmup
+    warmup.start()
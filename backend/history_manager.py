@@ -0,0 +1,216 @@
+# history_manager.py
+#
+# 会話履歴をトークン予算内に収めるための管理。
+# - メッセージごとのトークン数を数え、新しいターンから予算内に収まる分だけプロンプトに載せる
+# - 古いターンは「これまでの会話の要約」システムメッセージに畳み込む
+#   (要約の更新は応答を返した後にバックグラウンドで行い、応答の待ち時間には含めない)
+#   要約は予算からあふれる前 (予算 - HISTORY_SUMMARY_MIN_TOKENS より古い分。予算の半分は残す) に先に作り、
+#   要約されるまではそのメッセージをプロンプトに載せたままにする。
+#   それでも予算からあふれてプロンプトから外れたメッセージがあれば、量にかかわらず次のターンの後に要約する
+#   (要約に失敗しても、外れたメッセージが残っている間は毎ターン再試行される)
+# - tool の結果もターン内で予算に数え、超えた分は古い履歴から外す
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken が無い/エンコーディングを取得できない環境では概算する
+    _encoding = None
+
+logger = logging.getLogger(__name__)
+
+# 履歴 (要約以外の過去メッセージ + 今回ターンの tool 結果) に使うトークン予算
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
+# 要約待ちのメッセージがこのトークン数以上たまったら要約を更新する。
+# 予算からこのトークン数を引いたウィンドウより古いメッセージを要約待ちとする (あふれる前に要約しておく)
+HISTORY_SUMMARY_MIN_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MIN_TOKENS", "400"))
+
+# メッセージ1件あたりの固定オーバーヘッド (role など)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text: str) -> int:
+    """テキストのトークン数。tiktoken が無い場合は文字種から概算する。"""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # 概算: ASCII は約4文字で1トークン、日本語などは1文字で約1トークン
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def count_message_tokens(msg: Dict) -> int:
+    tokens = MESSAGE_OVERHEAD_TOKENS + count_text_tokens(msg.get("content") or "")
+    for tc in msg.get("tool_calls") or []:
+        fn = tc.get("function", {})
+        tokens += count_text_tokens(fn.get("name", "")) + count_text_tokens(fn.get("arguments", ""))
+    return tokens
+
+
+def count_messages_tokens(messages: List[Dict]) -> int:
+    return sum(count_message_tokens(m) for m in messages)
+
+
+class HistoryManager:
+    """
+    セッションの conversation (表示用の全履歴) と summary から、プロンプトに載せる履歴を選ぶ。
+    sess["summary"] = {"content": 要約テキスト, "covered": 要約済みのメッセージ数 (conversation の先頭から)}
+    """
+
+    def __init__(self, budget_tokens: int = HISTORY_TOKEN_BUDGET,
+                 summary_min_tokens: int = HISTORY_SUMMARY_MIN_TOKENS):
+        self.budget_tokens = budget_tokens
+        self.summary_min_tokens = summary_min_tokens
+        # 要約はモデル呼び出しを伴うので専用スレッドで実行する
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    # ---------- プロンプト用の履歴 ----------
+    def _window_start(self, conversation: List[Dict], covered: int, budget: Optional[int] = None) -> int:
+        """予算 (省略時は budget_tokens) 内に収まる最も古いメッセージの位置 (covered 以降)。"""
+        budget = self.budget_tokens if budget is None else budget
+        used = 0
+        start = len(conversation)
+        while start > covered:
+            tokens = count_message_tokens(conversation[start - 1])
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        return start
+
+    def select_history(self, sess: Dict) -> List[Dict]:
+        """
+        プロンプトに載せる履歴を返す: [要約システムメッセージ(あれば)] + 予算内の新しいメッセージ。
+        要約されていないメッセージは、予算からあふれない限り古いものも載せる。
+        """
+        conversation = sess.get("conversation", [])
+        summary = sess.get("summary") or {}
+        covered = min(summary.get("covered", 0), len(conversation))
+        start = self._window_start(conversation, covered)
+
+        history = []
+        if summary.get("content"):
+            history.append({"role": "system", "content": SUMMARY_PREFIX + summary["content"]})
+        history.extend(conversation[start:])
+        return history
+
+    def _summary_budget(self) -> int:
+        """
+        要約せずに残すウィンドウの大きさ。予算より summary_min_tokens 小さくし、あふれる前に要約する
+        (予算が小さくても、新しいメッセージは予算の半分までは要約せずに残す)。
+        """
+        return max(self.budget_tokens // 2, self.budget_tokens - self.summary_min_tokens)
+
+    def _pending_messages(self, sess: Dict) -> Tuple[int, int, List[Dict]]:
+        """要約に畳み込むべきメッセージ (covered から要約ウィンドウの手前まで)。"""
+        conversation = sess.get("conversation", [])
+        summary = sess.get("summary") or {}
+        covered = min(summary.get("covered", 0), len(conversation))
+        start = self._window_start(conversation, covered, self._summary_budget())
+        return covered, start, conversation[covered:start]
+
+    def dropped_count(self, sess: Dict) -> int:
+        """要約されないまま予算からあふれ、プロンプトに載っていないメッセージの数。"""
+        conversation = sess.get("conversation", [])
+        covered = min((sess.get("summary") or {}).get("covered", 0), len(conversation))
+        return self._window_start(conversation, covered) - covered
+
+    # ---------- ターン内の tool 結果 ----------
+    def enforce_budget(self, conversation: List[Dict]) -> int:
+        """
+        generate_bot_reply の途中 (tool 結果を追加した後) に呼ぶ。
+        最後のユーザメッセージより前の履歴 + それ以降 (tool 呼び出しと結果) の合計が予算を超えたら、
+        古い履歴メッセージから外していく。外した件数を返す。
+        システムメッセージ (プロンプト/ユーザ情報/要約) と今回のターンは外さない。
+        """
+        last_user = max((i for i, m in enumerate(conversation) if m.get("role") == "user"), default=-1)
+        if last_user < 0:
+            return 0
+        history_idx = [i for i in range(last_user) if conversation[i].get("role") != "system"]
+        total = (count_messages_tokens(conversation[last_user:])
+                 + sum(count_message_tokens(conversation[i]) for i in history_idx))
+
+        dropped = set()
+        for i in history_idx:
+            if total <= self.budget_tokens:
+                break
+            total -= count_message_tokens(conversation[i])
+            dropped.add(i)
+        if dropped:
+            conversation[:] = [m for i, m in enumerate(conversation) if i not in dropped]
+        return len(dropped)
+
+    # ---------- 要約の更新 (バックグラウンド) ----------
+    def schedule_summary(self, session_store, session_id: str,
+                         summarize: Callable[[str, List[Dict]], Optional[str]]):
+        """
+        要約待ちのメッセージが summary_min_tokens 以上たまったか、要約されないまま
+        プロンプトから外れたメッセージがあれば、要約の更新をバックグラウンドで実行する。
+        summarize(前回の要約, 畳み込むメッセージ) -> 新しい要約 (失敗時は None)
+        """
+        sess = session_store.get(session_id)
+        if not sess:
+            return
+        _, _, pending = self._pending_messages(sess)
+        if not pending:
+            return
+        if count_messages_tokens(pending) < self.summary_min_tokens and not self.dropped_count(sess):
+            return
+        with self._pending_lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._executor.submit(self._update_summary, session_store, session_id, summarize)
+
+    def _update_summary(self, session_store, session_id, summarize):
+        try:
+            sess = session_store.get(session_id)
+            if not sess:
+                return
+            covered, start, pending = self._pending_messages(sess)
+            if not pending:
+                return
+            previous = (sess.get("summary") or {}).get("content", "")
+            new_summary = summarize(previous, pending)
+            if not new_summary:
+                return
+            with session_store.transaction(session_id) as latest:
+                if latest is None:
+                    return
+                # 要約中にリセット等で履歴が変わっていたら捨てる
+                latest_covered = (latest.get("summary") or {}).get("covered", 0)
+                if latest_covered != covered or latest.get("conversation", [])[covered:start] != pending:
+                    return
+                latest["summary"] = {"content": new_summary, "covered": start}
+        except Exception as e:
+            logger.warning("history summary failed for session=%s: %s", session_id, e)
+        finally:
+            with self._pending_lock:
+                self._pending.discard(session_id)
+
+
+def format_messages_for_summary(messages: List[Dict]) -> str:
+    """要約用に user/assistant のやりとりをテキスト化する。"""
+    lines = []
+    for m in messages:
+        content = m.get("content")
+        if not content and m.get("tool_calls"):
+            content = json.dumps(m["tool_calls"], ensure_ascii=False)
+        lines.append(f"{m.get('role', '')}: {content or ''}")
+    return "\n".join(lines)
+
+
+# アプリ全体で共有するインスタンス
+history_manager = HistoryManager()
@@ -0,0 +1,275 @@
+# http_client.py
+#
+# 外部API (マニュアル検索の APIM など) 向けの共有HTTPクライアント。
+# - requests.Session を使い回して keep-alive / コネクションプールを効かせる
+# - 接続タイムアウトと読み取りタイムアウトを分けて指定
+# - 一時的な失敗はジッター付き指数バックオフで再試行
+# - 失敗が続いたらサーキットブレーカーを開いて即座に失敗させる
+# requests の import (Session の作成) は最初の呼び出しまで遅らせる (起動を速くするため)。
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+# 再試行してよいHTTPステータス (一時的な失敗)
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため呼び出しを行わなかったことを表す。"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is temporarily unavailable (circuit open)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# ==========================================
+# 1) サーキットブレーカー
+# ==========================================
+class CircuitBreaker:
+    """
+    closed   : 通常状態。連続失敗が failure_threshold に達すると open へ
+    open     : reset_timeout 秒間は呼び出しを行わず即失敗
+    half_open: reset_timeout 経過後、1件だけ試行を通す。成功で closed、失敗で open へ戻る
+               (締め切りで打ち切った試行は失敗に数えず、open に戻して次の試行を待つ)
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = "closed"
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._times_opened = 0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> Optional[float]:
+        """
+        呼び出してよければ None、だめなら再試行までの残り秒数を返す。
+        """
+        with self._lock:
+            if self._state == "closed":
+                return None
+            elapsed = time.monotonic() - self._opened_at
+            if self._state == "open" and elapsed >= self.reset_timeout:
+                self._state = "half_open"
+                self._trial_in_flight = False
+            if self._state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return None
+            return max(self.reset_timeout - elapsed, 0.0)
+
+    def record_success(self):
+        with self._lock:
+            self._state = "closed"
+            self._consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._times_opened += 1
+                self._state = "open"
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def record_cancelled(self):
+        """
+        こちらの都合 (締め切り) で打ち切り、相手の成否が分からなかった呼び出し。失敗には数えない。
+        half_open の試行だった場合は試行を解放し、open に戻して reset_timeout 後にもう一度試す。
+        """
+        with self._lock:
+            if self._state == "half_open":
+                self._state = "open"
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            retry_after = 0.0
+            if self._state == "open":
+                retry_after = max(self.reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+            return {
+                "state": self._state,
+                "consecutiveFailures": self._consecutive_failures,
+                "timesOpened": self._times_opened,
+                "retryAfterSec": round(retry_after, 1)
+            }
+
+
+# ==========================================
+# 2) プール付きHTTPクライアント
+# ==========================================
+class PooledHttpClient:
+    """
+    1つの外部サービスに対する共有クライアント (スレッドセーフ)。
+    """
+
+    def __init__(self, name: str,
+                 pool_size: int = 10,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 30.0,
+                 max_retries: int = 2,
+                 backoff_base: float = 0.3,
+                 backoff_max: float = 3.0,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+
+        self._session = None
+        self._adapter = None
+        self._session_lock = threading.Lock()
+
+        self._counters = {
+            "requests": 0,
+            "attempts": 0,
+            "retries": 0,
+            "failures": 0,
+            "rejectedByBreaker": 0,
+            "deadlineExceeded": 0
+        }
+        self._counter_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """共有の requests.Session (初回に作る)。"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # 再試行は自前で行うので adapter 側の retry は無効にしておく
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0,
+                                          pool_block=False)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._adapter = adapter
+                    self._session = session
+        return self._session
+
+    def warm_up(self, url: str, timeout: Optional[float] = None) -> int:
+        """
+        url のホストへの接続 (TCP + TLS) を張ってプールに入れておく (HEAD を1回送る)。
+        応答のステータスは問わない (404 や 401 でも接続は使い回せる)。戻り値はステータスコード。
+        カウンタとブレーカーには数えない。
+        """
+        response = self.session.head(url, timeout=(self.connect_timeout, timeout or self.read_timeout),
+                                     allow_redirects=False)
+        return response.status_code
+
+    def _count(self, key: str, n: int = 1):
+        with self._counter_lock:
+            self._counters[key] += n
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: 0 〜 min(max, base * 2^attempt)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def post_json(self, url: str, body: Dict, headers: Optional[Dict] = None,
+                  read_timeout: Optional[float] = None, deadline=None) -> Dict:
+        """
+        JSON を POST して JSON を返す。
+        失敗時は requests.RequestException、ブレーカーが開いている場合は CircuitOpenError を送出する。
+        body は冪等な問い合わせ (検索など) であることが前提。
+        deadline (deadline.Deadline) があれば、timeout と再試行を残り時間の範囲に収める。
+        締め切りで打ち切った失敗はブレーカーの失敗に数えない。
+        """
+        session = self.session
+        import requests  # session を作った時点で読み込み済み
+        self._count("requests")
+        retry_after = self.breaker.before_call()
+        if retry_after is not None:
+            self._count("rejectedByBreaker")
+            raise CircuitOpenError(self.name, retry_after)
+
+        read_timeout = read_timeout or self.read_timeout
+        last_error: Optional[Exception] = None
+        cut_by_deadline = False
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                backoff = self._backoff(attempt - 1)
+                if deadline is not None and deadline.remaining() <= backoff:
+                    cut_by_deadline = True
+                    break
+                self._count("retries")
+                time.sleep(backoff)
+            timeout = (self.connect_timeout, read_timeout)
+            if deadline is not None:
+                remaining = deadline.remaining()
+                if remaining <= 0:
+                    cut_by_deadline = True
+                    break
+                cut_by_deadline = remaining < read_timeout
+                timeout = (min(self.connect_timeout, remaining), min(read_timeout, remaining))
+            self._count("attempts")
+            try:
+                response = session.post(url, json=body, headers=headers, timeout=timeout)
+                if response.status_code in RETRYABLE_STATUS and attempt < self.max_retries:
+                    last_error = requests.HTTPError(
+                        f"{response.status_code} Server Error for url: {url}", response=response)
+                    continue
+                response.raise_for_status()
+                data = response.json()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = e
+                continue
+            except requests.RequestException as e:
+                # 4xx など再試行しても無駄なもの
+                last_error = e
+                break
+            except ValueError as e:
+                # JSONとして解釈できない応答
+                last_error = requests.RequestException(f"Invalid JSON response: {e}")
+                break
+            self.breaker.record_success()
+            return data
+
+        self._count("failures")
+        if last_error is None or (cut_by_deadline and isinstance(last_error, requests.Timeout)):
+            # 相手の不調ではなく、こちらの締め切りで打ち切った
+            self._count("deadlineExceeded")
+            self.breaker.record_cancelled()
+            raise last_error or requests.Timeout(f"{self.name}: turn deadline exceeded")
+        status = getattr(getattr(last_error, "response", None), "status_code", None)
+        if status is not None and status < 500 and status != 429:
+            # 相手は応答している (リクエスト側の問題) のでブレーカーは開かない
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        raise last_error
+
+    def stats(self) -> Dict:
+        """運用確認用: プールの状態、カウンタ、ブレーカーの状態。"""
+        pools = []
+        poolmanager = self._adapter.poolmanager if self._adapter is not None else None
+        for key in list(poolmanager.pools.keys()) if poolmanager is not None else []:
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                "host": pool.host,
+                "connectionsCreated": pool.num_connections,
+                "requestsServed": pool.num_requests,
+                "idleConnections": pool.pool.qsize() if pool.pool is not None else 0
+            })
+        with self._counter_lock:
+            counters = dict(self._counters)
+        return {
+            "name": self.name,
+            "poolSize": self.pool_size,
+            "timeouts": {"connect": self.connect_timeout, "read": self.read_timeout},
+            "pools": pools,
+            "counters": counters,
+            "breaker": self.breaker.stats()
+        }
@@ -0,0 +1,275 @@
+# llm_scheduler.py
+#
+# プロセス全体で共有する、LLM (chat.completions) 呼び出しの送出スケジューラ。
+# - 1分あたりのリクエスト数 (LLM_RPM_LIMIT) とトークン数 (LLM_TPM_LIMIT) をトークンバケットで守る。
+#   トークン数は送る前にプロンプトから見積もり、usage が返ってきたら実際の値で差分を精算する
+# - 同時に実行する呼び出し数を LLM_MAX_CONCURRENCY で抑える
+# - 待ちは優先度付きキュー: tool 結果を渡した後の completion (ターンの途中) を、新しいターンの最初の
+#   completion より先に出す。バックグラウンドの履歴要約は最後
+# - 429 の Retry-After と x-ratelimit-* ヘッダを見て、バケットの残量と送出の再開時刻を合わせる
+#   (制限に当たったとき、実行中のターンが一斉に同じ瞬間に再送しない)
+# 上限が 0 の項目は制限しない。
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import metrics
+from deadline import Deadline, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+LLM_SCHEDULER_ENABLED = os.environ.get("LLM_SCHEDULER_ENABLED", "1") != "0"
+# 1分あたりのリクエスト数 / トークン数の上限 (組織のレート制限より少し低めに設定する。0 で無制限)
+LLM_RPM_LIMIT = int(os.environ.get("LLM_RPM_LIMIT", "0"))
+LLM_TPM_LIMIT = int(os.environ.get("LLM_TPM_LIMIT", "0"))
+# 同時に実行する completion の上限 (ストリームを読み終えるまでを1件と数える)
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+# Retry-After が無い 429 のときに送出を止める秒数
+LLM_RATE_LIMIT_DEFAULT_BACKOFF_SEC = float(os.environ.get("LLM_RATE_LIMIT_DEFAULT_BACKOFF_SEC", "2"))
+
+# 優先度 (小さいほど先)
+PRIORITY_AFTER_TOOLS = 0
+PRIORITY_INITIAL = 1
+PRIORITY_BACKGROUND = 2
+_PRIORITY_NAMES = {PRIORITY_AFTER_TOOLS: "after_tools", PRIORITY_INITIAL: "initial",
+                   PRIORITY_BACKGROUND: "background"}
+
+# キャンセル (ヘッジで負けた試行など) を見に行く間隔
+_WAIT_SLICE_SEC = 0.25
+
+# x-ratelimit-reset-* の "1s" / "6m0s" / "250ms" 形式
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """OpenAI の x-ratelimit-reset-* / Retry-After の値を秒にする。読めなければ None。"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+class TokenBucket:
+    """1分あたり rate_per_min ずつ補充されるバケット (容量も rate_per_min)。rate_per_min=0 なら無制限。"""
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = float(rate_per_min)
+        self.level = float(rate_per_min)
+        self._rate = rate_per_min / 60.0
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """amount を取り出せるまでの秒数 (今すぐ取り出せるなら 0)。容量より大きい要求は満タンまで待つ。"""
+        if self.unlimited:
+            return 0.0
+        self._refill(now)
+        needed = min(amount, self.capacity) - self.level
+        return 0.0 if needed <= 0 else needed / self._rate
+
+    def take(self, amount: float, now: float):
+        if not self.unlimited:
+            self._refill(now)
+            self.level -= amount
+
+    def give_back(self, amount: float, now: float):
+        if not self.unlimited:
+            self._refill(now)
+            self.level = min(self.capacity, self.level + amount)
+
+    def limit_to(self, remaining: float, now: float):
+        """サーバが返した残量に合わせる (こちらの見積もりより少なければ下げる)。"""
+        if not self.unlimited:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+
+class _Ticket:
+    """acquire() で得た送出枠。settle() で見積もりトークン数を実際の値に精算する。"""
+
+    def __init__(self, scheduler: "LlmScheduler", estimated_tokens: int):
+        self._scheduler = scheduler
+        self.estimated_tokens = estimated_tokens
+        self._settled = False
+
+    def settle(self, actual_tokens: int):
+        if self._settled:
+            return
+        self._settled = True
+        self._scheduler._settle(self.estimated_tokens, actual_tokens)
+
+
+class LlmScheduler:
+    def __init__(self, rpm_limit: int = LLM_RPM_LIMIT, tpm_limit: int = LLM_TPM_LIMIT,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, enabled: bool = LLM_SCHEDULER_ENABLED):
+        self.enabled = enabled
+        self.max_concurrency = max_concurrency
+        self._requests = TokenBucket(rpm_limit)
+        self._tokens = TokenBucket(tpm_limit)
+        self._cond = threading.Condition()
+        # (優先度, 到着順) のヒープ。先頭の待ちだけが送出できる
+        self._queue = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        # 429 / 残量 0 のとき、この時刻まで送出しない
+        self._paused_until = 0.0
+        self._dispatched = 0
+        self._rate_limited = 0
+
+    # ---------- 送出枠 ----------
+    @contextmanager
+    def slot(self, priority: int, estimated_tokens: int, turn_deadline: Optional[Deadline] = None,
+             cancelled: Optional[threading.Event] = None):
+        """
+        with scheduler.slot(...) as ticket: の中で completion を呼ぶ (ストリームを読み終えるまで含める)。
+        順番とレート制限の空きを待ち、締め切りを過ぎたら DeadlineExceeded を送出する。
+        cancelled がセットされたら待ちをやめて何もせずに抜ける (ticket は None)。
+        """
+        if not self.enabled:
+            yield _Ticket(self, 0)
+            return
+        ticket = self._acquire(priority, estimated_tokens, turn_deadline, cancelled)
+        try:
+            yield ticket
+        finally:
+            if ticket is not None:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _acquire(self, priority, estimated_tokens, turn_deadline, cancelled) -> Optional[_Ticket]:
+        entry = (priority, next(self._sequence))
+        started = time.monotonic()
+        dispatched = False
+        with self._cond:
+            heapq.heappush(self._queue, entry)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        return None
+                    now = time.monotonic()
+                    wait = self._dispatch_wait_locked(entry, estimated_tokens, now)
+                    if wait == 0:
+                        break
+                    if turn_deadline is not None:
+                        if turn_deadline.expired():
+                            raise DeadlineExceeded()
+                        wait = min(wait, turn_deadline.remaining())
+                    self._cond.wait(min(wait, _WAIT_SLICE_SEC))
+                heapq.heappop(self._queue)
+                self._requests.take(1, now)
+                self._tokens.take(estimated_tokens, now)
+                self._in_flight += 1
+                self._dispatched += 1
+                dispatched = True
+            finally:
+                if not dispatched:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                # 先頭が入れ替わったので、次の待ちに判定させる
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        metrics.llm_queue_wait_seconds.observe(waited, priority=_PRIORITY_NAMES.get(priority, str(priority)))
+        if waited >= 1.0:
+            logger.info("LLM call waited %.1fs in the scheduler queue (priority=%s, tokens~%d)",
+                        waited, _PRIORITY_NAMES.get(priority, priority), estimated_tokens)
+        return _Ticket(self, estimated_tokens)
+
+    def _dispatch_wait_locked(self, entry, estimated_tokens: int, now: float) -> float:
+        """entry が今送出できるなら 0、できないなら次に判定し直すまでの秒数。"""
+        if self._queue[0] != entry or self._in_flight >= self.max_concurrency:
+            return _WAIT_SLICE_SEC  # 順番か空き枠を待つ (解放時に notify される)
+        if now < self._paused_until:
+            return self._paused_until - now
+        return max(self._requests.wait_time(1, now), self._tokens.wait_time(estimated_tokens, now))
+
+    def _settle(self, estimated_tokens: int, actual_tokens: int):
+        now = time.monotonic()
+        with self._cond:
+            if actual_tokens > estimated_tokens:
+                self._tokens.take(actual_tokens - estimated_tokens, now)
+            else:
+                self._tokens.give_back(estimated_tokens - actual_tokens, now)
+                self._cond.notify_all()
+
+    # ---------- サーバからの情報 ----------
+    def observe_headers(self, headers):
+        """応答ヘッダの x-ratelimit-remaining-* / reset-* をバケットに反映する。"""
+        if headers is None or not self.enabled:
+            return
+        now = time.monotonic()
+        with self._cond:
+            for kind, bucket in (("requests", self._requests), ("tokens", self._tokens)):
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+                bucket.limit_to(remaining, now)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                    if reset:
+                        self._paused_until = max(self._paused_until, now + reset)
+
+    def observe_rate_limited(self, headers):
+        """429 を受けたとき: Retry-After (無ければ既定値) の間は誰も送出しない。"""
+        if not self.enabled:
+            return
+        retry_after = None
+        if headers is not None:
+            retry_after_ms = parse_duration(headers.get("retry-after-ms"))
+            retry_after = (retry_after_ms / 1000 if retry_after_ms is not None
+                           else parse_duration(headers.get("retry-after")))
+        backoff = retry_after if retry_after is not None else LLM_RATE_LIMIT_DEFAULT_BACKOFF_SEC
+        self.observe_headers(headers)
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self._rate_limited += 1
+        metrics.llm_rate_limited_total.inc()
+        logger.warning("LLM rate limited; pausing dispatch for %.1fs", backoff)
+
+    def busy(self) -> bool:
+        """送出待ちがある (= 追加の試行を投げるとさらに混む)。"""
+        with self._cond:
+            return bool(self._queue)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "enabled": self.enabled,
+                "waiting": len(self._queue),
+                "inFlight": self._in_flight,
+                "maxConcurrency": self.max_concurrency,
+                "requestsAvailable": None if self._requests.unlimited else round(self._requests.level, 1),
+                "tokensAvailable": None if self._tokens.unlimited else round(self._tokens.level),
+                "pausedForSec": round(max(0.0, self._paused_until - now), 2),
+                "dispatched": self._dispatched,
+                "rateLimited": self._rate_limited,
+            }
+
+
+llm_scheduler = LlmScheduler()
@@ -0,0 +1,217 @@
+# logging_setup.py
+#
+# アプリ全体のログ設定。print / debug_print の代わりに標準の logging を使う。
+# - 出力は1行1 JSON (構造化ログ)。追加項目は extra={"fields": {...}} で渡す
+# - リクエストスレッドはキューに積むだけで、整形と stdout への書き込みはバックグラウンドスレッドが行う
+# - モジュール (ロガー名) ごとにレベルを指定できる
+# - 大量に出る DEBUG ログはサンプリングできる
+# - ログに載せる値の長さを制限し、パスワードや API キーなどの資格情報は伏せ字にする
+#
+# 環境変数:
+#   LOG_LEVEL               全体のレベル (既定: INFO)
+#   LOG_LEVELS              ロガーごとのレベル。例: "chat_bot=DEBUG,run=WARNING"
+#   LOG_DEBUG_SAMPLE_RATE   DEBUG ログを出す割合 0.0〜1.0 (既定: 1.0)
+#   LOG_MAX_FIELD_CHARS     1つの値を何文字で切り詰めるか (既定: 2000)
+#   LOG_QUEUE_SIZE          キューの長さ。あふれた分は捨てて件数を数える (既定: 10000)
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# リクエストID (metrics.start_request で設定) をログに載せる
+from metrics import current_request_id
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+LOG_MAX_FIELD_CHARS = int(os.environ.get("LOG_MAX_FIELD_CHARS", "2000"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+REDACTED = "***"
+# キー名にこれらを含む値は伏せ字にする (大文字小文字を区別しない)
+# ("token" は末尾一致のみ。promptTokens などのトークン数は伏せない)
+SENSITIVE_KEYS = ("password", "passwd", "secret", "apikey", "api_key",
+                  "authorization", "subscription-key", "subscription_key")
+# 文字列中に紛れた資格情報
+_SENSITIVE_PATTERNS = [
+    re.compile(r"sk-[A-Za-z0-9_\-]{8,}"),
+    re.compile(r"(?i)(password|passwd|secret|api[_-]?key|subscription[_-]?key)(['\"]?\s*[:=]\s*['\"]?)([^'\"\s,}]+)"),
+]
+
+
+def _is_sensitive_key(key) -> bool:
+    key = str(key).lower()
+    return key.endswith("token") or any(s in key for s in SENSITIVE_KEYS)
+
+
+def redact_text(text: str) -> str:
+    text = _SENSITIVE_PATTERNS[0].sub(REDACTED, text)
+    return _SENSITIVE_PATTERNS[1].sub(lambda m: m.group(1) + m.group(2) + REDACTED, text)
+
+
+def sanitize(value, max_chars: int = LOG_MAX_FIELD_CHARS, _depth: int = 0):
+    """ログに載せる値から資格情報を伏せ、長すぎる文字列やリストを切り詰める。"""
+    if _depth > 5:
+        return "..."
+    if isinstance(value, dict):
+        return {k: (REDACTED if _is_sensitive_key(k) else sanitize(v, max_chars, _depth + 1))
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [sanitize(v, max_chars, _depth + 1) for v in value[:20]]
+        if len(value) > 20:
+            items.append(f"...(+{len(value) - 20} items)")
+        return items
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = redact_text(str(value))
+    if len(text) > max_chars:
+        text = text[:max_chars] + f"...(truncated {len(text) - max_chars} chars)"
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1 JSON で出力する。バックグラウンドスレッドで呼ばれる。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        args = record.args
+        if args:
+            if isinstance(args, dict):
+                args = sanitize(args)
+            else:
+                args = tuple(sanitize(a) if isinstance(a, (dict, list, tuple)) else a for a in args)
+        try:
+            message = str(record.msg) % args if args else str(record.msg)
+        except (TypeError, ValueError):
+            message = f"{record.msg} {args}"
+
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": sanitize(message),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["requestId"] = request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(sanitize(fields))
+        exc_text = record.exc_text
+        if record.exc_info:
+            exc_text = self.formatException(record.exc_info)
+        if exc_text:
+            entry["exc"] = sanitize(exc_text, max_chars=8000)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """DEBUG のレコードだけを rate の割合で通す。"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class RequestIdFilter(logging.Filter):
+    """ログを出したスレッドのリクエストID をレコードに付ける (キューに積む前に呼ばれる)。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id()
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    キューに積むだけのハンドラ。
+    標準の QueueHandler は積む前にメッセージを整形してしまうので、整形はリスナー側に任せる。
+    キューが満杯なら待たずに捨てて件数を数える。
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 後から中身が変わらないよう、dict/list の引数だけ浅くコピーしておく
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = dict(record.args)
+            else:
+                record.args = tuple(a.copy() if isinstance(a, (dict, list)) else a for a in record.args)
+        if record.exc_info:
+            # 例外オブジェクトはスレッドをまたがせずにここで文字列化する
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[DroppingQueueHandler] = None
+_setup_pid: Optional[int] = None
+_setup_lock = threading.Lock()
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """"chat_bot=DEBUG,run=INFO" -> {"chat_bot": "DEBUG", "run": "INFO"}"""
+    levels = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, level = part.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    ルートロガーにキュー経由の JSON ハンドラを設定する (何度呼んでもよい)。
+    fork 後のワーカーではリスナースレッドが引き継がれないため pid ごとに起動し直す。
+    """
+    global _listener, _queue_handler, _setup_pid
+    pid = os.getpid()
+    if _setup_pid == pid:
+        return
+    with _setup_lock:
+        if _setup_pid == pid:
+            return
+
+        root = logging.getLogger()
+        if _queue_handler is not None:
+            root.removeHandler(_queue_handler)
+
+        log_queue: "queue.Queue" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+        _listener.start()
+
+        _queue_handler = DroppingQueueHandler(log_queue)
+        _queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE_RATE))
+        _queue_handler.addFilter(RequestIdFilter())
+        root.addHandler(_queue_handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in parse_levels(LOG_LEVELS).items():
+            logging.getLogger(name).setLevel(level)
+        _setup_pid = pid
+
+
+def dropped_count() -> int:
+    """キューがあふれて捨てたログの件数。"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -0,0 +1,75 @@
+# machine_prefetch.py
+#
+# ユーザ発言から (機種, 号機) の候補を取り出す。
+# 例: "PC200-8の500001のエンジン重量は？" -> [("PC200-8", "500001")]
+# 機種は customer_machine_list.json に登場する機種名 (data_repository の語彙) だけを対象にし、
+# その直後 (PREFETCH_SERIAL_WINDOW 文字以内) にある号機らしき英数字を組にする。
+# chat_bot.prefetch_machine_info() が最初の completion の前に getMachineInfo を先に引くのに使う。
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+# 機種名の後ろで号機を探す範囲 (文字数)
+PREFETCH_SERIAL_WINDOW = int(os.environ.get("PREFETCH_SERIAL_WINDOW", "20"))
+# 1発言から取り出す候補の上限
+PREFETCH_MAX_CANDIDATES = int(os.environ.get("PREFETCH_MAX_CANDIDATES", "3"))
+
+# 号機: 英字0〜2文字 + 数字4〜8桁 (前後が英数字に続かないもの)
+_SERIAL_PATTERN = re.compile(r"(?<![0-9A-Z])([A-Z]{0,2}\d{4,8})(?![0-9])")
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").upper()
+
+
+class _Vocabulary:
+    """スナップショットごとの機種名の正規表現。スナップショットが差し替わったら作り直す。"""
+
+    def __init__(self):
+        self._snapshot = None
+        self._pattern: Optional[re.Pattern] = None
+        self._models: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get(self, snapshot) -> Tuple[Optional[re.Pattern], Dict[str, str]]:
+        if self._snapshot is not snapshot:
+            with self._lock:
+                if self._snapshot is not snapshot:
+                    models = {_normalize(m): m for m in snapshot.models if m}
+                    # 長い機種名を先に試す (PC200-8 より PC200-8M0 を優先)
+                    alternatives = sorted(models, key=len, reverse=True)
+                    pattern = (re.compile(r"(?<![0-9A-Z])(" + "|".join(map(re.escape, alternatives))
+                                          + r")(?![0-9A-Z])") if alternatives else None)
+                    self._pattern, self._models, self._snapshot = pattern, models, snapshot
+        return self._pattern, self._models
+
+
+_vocabulary = _Vocabulary()
+
+
+def extract_machine_candidates(text: str, snapshot,
+                               max_candidates: int = PREFETCH_MAX_CANDIDATES) -> List[Tuple[str, str]]:
+    """発言から (機種, 号機) の候補を出現順に返す (重複なし)。"""
+    pattern, models = _vocabulary.get(snapshot)
+    if pattern is None:
+        return []
+    normalized = _normalize(text)
+    candidates: List[Tuple[str, str]] = []
+    matches = list(pattern.finditer(normalized))
+    for i, match in enumerate(matches):
+        # 号機は次の機種名より手前で探す ("PC200-8とPC300-7の200001" を PC200-8 の号機にしない)
+        end = match.end() + PREFETCH_SERIAL_WINDOW
+        if i + 1 < len(matches):
+            end = min(end, matches[i + 1].start())
+        window = normalized[match.end():end]
+        serial = _SERIAL_PATTERN.search(window)
+        if serial is None:
+            continue
+        candidate = (models[match.group(1)], serial.group(1))
+        if candidate not in candidates:
+            candidates.append(candidate)
+        if len(candidates) >= max_candidates:
+            break
+    return candidates
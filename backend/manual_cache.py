@@ -0,0 +1,159 @@
+# manual_cache.py
+#
+# searchManual の結果キャッシュ。
+# - (model, documentType, query) を正規化したキーで保存
+# - TTL 付き、件数上限を超えたら LRU で追い出す
+# - 同じキーの問い合わせが同時に来た場合は1件だけ上流に投げ、結果を共有する (single-flight)
+#   待つ側はターンの締め切り (deadline.py) まで、締め切りが無ければ SINGLE_FLIGHT_WAIT_SEC までしか待たない。
+#   待ちきれなかったときは自分で compute() を呼ぶ (締め切りを過ぎていれば compute 側が締め切りのエラーを返す)
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import deadline
+
+# 締め切りの無い呼び出しで、同じキーの先行する compute() を待つ最大秒数
+SINGLE_FLIGHT_WAIT_SEC = float(os.environ.get("SINGLE_FLIGHT_WAIT_SEC", "60"))
+
+
+def normalize_text(text: str) -> str:
+    """全角/半角・大文字/小文字・連続空白の揺れを吸収する。"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return " ".join(text.lower().split())
+
+
+class _InFlight:
+    """上流へ問い合わせ中の1件。待っているスレッドは event で結果を待つ。"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    TTL + LRU のスレッドセーフなキャッシュ (single-flight 付き)。
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600.0,
+                 flight_wait_seconds: float = SINGLE_FLIGHT_WAIT_SEC):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.flight_wait_seconds = flight_wait_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._in_flight: Dict[Hashable, _InFlight] = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0,
+                          "flightWaitTimeouts": 0}
+
+    def _get_locked(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._counters["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set_locked(self, key: Hashable, value):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], object],
+                       should_cache: Callable[[object], bool] = lambda v: True):
+        """
+        キャッシュにあればそれを返し、なければ compute() を呼んで結果を保存する。
+        同じ key で compute() 実行中の場合は、その結果を待って共有する。
+        待つのはターンの締め切り (無ければ flight_wait_seconds) までで、過ぎたら自分で compute() を呼ぶ。
+        should_cache(結果) が False の場合 (エラー応答など) は保存しない。
+        """
+        with self._lock:
+            entry = self._get_locked(key)
+            if entry is not None:
+                self._counters["hits"] += 1
+                return entry[1]
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self._counters["coalesced"] += 1
+                leader = False
+            else:
+                self._counters["misses"] += 1
+                flight = _InFlight()
+                self._in_flight[key] = flight
+                leader = True
+
+        if not leader:
+            if flight.event.wait(self._flight_wait_timeout()):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            with self._lock:
+                self._counters["flightWaitTimeouts"] += 1
+            return compute()
+
+        try:
+            result = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            flight.result = result
+            with self._lock:
+                if should_cache(result):
+                    self._set_locked(key, result)
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+    def _flight_wait_timeout(self) -> Optional[float]:
+        turn_deadline = deadline.current()
+        if turn_deadline is not None:
+            return turn_deadline.remaining()
+        return self.flight_wait_seconds
+
+    def get(self, key: Hashable, default=None):
+        """キャッシュにあれば値を返す (single-flight なしの単純な参照)。"""
+        with self._lock:
+            entry = self._get_locked(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return default
+            self._counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._set_locked(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            stats["inFlight"] = len(self._in_flight)
+        stats["maxEntries"] = self.max_entries
+        stats["ttlSeconds"] = self.ttl_seconds
+        stats["flightWaitSeconds"] = self.flight_wait_seconds
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hitRate"] = round((stats["hits"] + stats["coalesced"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def manual_cache_key(model: str, documentType: str, query: str) -> Tuple[str, str, str]:
+    """searchManual 用のキャッシュキー。serial は検索結果に影響しないので含めない。"""
+    return (normalize_text(model), normalize_text(documentType), normalize_text(query))
@@ -0,0 +1,538 @@
+# manual_index.py
+#
+# マニュアルのローカル全文検索 (searchManual の高速経路 / リモートAPI障害時の代替)。
+# - コーパス: MANUAL_CORPUS_DIR 配下の .md / .txt / .json を節 (section) に分けて索引する
+#     manuals/<documentType>/<model>/*.md   (documentType / model のディレクトリは省略可)
+#     .md は見出し (#) ごと、.txt は空行区切りの段落をまとめて1節にする
+#     .json は [{"title", "text", "model"?, "documentType"?}, ...] (パスから決まる値を上書きできる)
+# - トークン化: 英数字は単語 (簡易ストップワード/複数形除去)、漢字とカタカナは bigram、
+#   ひらがな (助詞・活用語尾が大半) は捨てる。形態素解析器は使わない
+# - ランキング: BM25 (k1=1.2, b=0.75)
+# - 索引ファイル: 転置索引を1つのバイナリにまとめ、mmap で開く (読み込み時に全体を展開しない)
+#     ヘッダ / 語表 (語の位置, 長さ, ポスティング開始位置, df) / 語の文字列 /
+#     ポスティング (docId: uint32, tf: uint16) / 文書長 / 文書 (JSON) のオフセット / 文書本体
+#   語はバイト列の昇順に並べ、検索時は二分探索する。リトルエンディアン固定
+# - 差分ビルド: ファイルごとの (mtime, サイズ, 節, 語の出現数) を <索引>.cache.json に保持し、
+#   変わったファイルだけ読み直す
+#     python manual_index.py build [--corpus manuals] [--index manual_index.bin] [--full]
+#     python manual_index.py search "エンジンオイルの交換手順" --type "Operation and maintenance manual"
+#
+# 環境変数:
+#   MANUAL_CORPUS_DIR              コーパスのディレクトリ (既定: manuals)
+#   MANUAL_INDEX_PATH              索引ファイル (既定: manual_index.bin)
+#   MANUAL_INDEX_RELOAD_CHECK_SEC  索引ファイルの更新を確認する間隔 (既定: 5)
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MANUAL_CORPUS_DIR = os.environ.get("MANUAL_CORPUS_DIR", "manuals")
+MANUAL_INDEX_PATH = os.environ.get("MANUAL_INDEX_PATH", "manual_index.bin")
+MANUAL_INDEX_RELOAD_CHECK_SEC = float(os.environ.get("MANUAL_INDEX_RELOAD_CHECK_SEC", "5"))
+
+# 1節の目安の長さ (これを超える段落の並びは分割する)
+SECTION_TARGET_CHARS = 1000
+CORPUS_EXTENSIONS = (".md", ".markdown", ".txt", ".json")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 上位を決めるときに JSON を展開してフィルタを確認する文書数の上限
+MAX_CANDIDATES = 200
+# 検索の時間予算を確認する間隔 (ポスティング数)。よく出る語1つで予算を大きく超えないようにする
+BUDGET_CHECK_POSTINGS = 2048
+
+# トークン化の規則を変えたら上げる (差分ビルドのキャッシュを無効にする)
+TOKENIZER_VERSION = 1
+MAGIC = b"MANIDX01"
+# magic, 文書数, 語数, ポスティング数, 平均文書長, 各領域のオフセット x7
+_HEADER = struct.Struct("<8sIIQd7Q")
+
+
+# ==========================================
+# 1) トークン化
+# ==========================================
+_TOKEN_PATTERN = re.compile(
+    r"(?P<word>[a-z0-9]+(?:[-_.][a-z0-9]+)*)"
+    r"|(?P<kanji>[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff々〆]+)"
+    r"|(?P<katakana>[\u30a1-\u30ff]+)"
+)
+_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "if",
+    "in", "is", "it", "me", "my", "of", "on", "or", "please", "should", "tell", "that", "the", "this", "to",
+    "what", "when", "where", "which", "with", "you",
+}
+
+
+def _stem(word: str) -> str:
+    # 複数形の s だけ落とす (pumps -> pump, class はそのまま)
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")) and not word[-2].isdigit():
+        return word[:-1]
+    return word
+
+
+def _bigrams(run: str) -> List[str]:
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> List[str]:
+    """検索語のリスト (出現順, 重複あり) を返す。索引とクエリで同じものを使う。"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    terms: List[str] = []
+    for match in _TOKEN_PATTERN.finditer(text):
+        run = match.group()
+        if match.lastgroup == "word":
+            if run in _STOPWORDS:
+                continue
+            terms.append(_stem(run))
+            # PC200-8 -> pc200-8, pc200 (型式の一部でも当たるように)
+            parts = re.split(r"[-_.]", run)
+            if len(parts) > 1:
+                terms.extend(_stem(p) for p in parts if len(p) > 1 and p not in _STOPWORDS)
+        elif match.lastgroup == "kanji":
+            terms.extend(_bigrams(run) if len(run) > 1 else [run])
+        elif len(run) > 1:
+            # カタカナ語も bigram (エンジンオイル と エンジン オイル、オイル のどれでも当たるように)
+            terms.extend(_bigrams(run))
+    return terms
+
+
+def _normalize_label(text) -> str:
+    return " ".join(unicodedata.normalize("NFKC", str(text or "")).casefold().split())
+
+
+# ==========================================
+# 2) コーパスの読み込み (ファイル -> 節)
+# ==========================================
+def _chunk_paragraphs(text: str, target: int = SECTION_TARGET_CHARS) -> List[str]:
+    """空行区切りの段落を target 文字程度にまとめる。"""
+    chunks, current = [], ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > target:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _path_labels(rel_path: str) -> Tuple[str, str]:
+    """manuals/<documentType>/<model>/file の形なら (documentType, model) を返す。"""
+    parts = rel_path.split("/")
+    document_type = parts[0] if len(parts) >= 2 else ""
+    model = parts[1] if len(parts) >= 3 else ""
+    return document_type, model
+
+
+def parse_file(full_path: str, rel_path: str) -> List[Dict]:
+    """1ファイルを節のリスト [{"title", "text", "source", "documentType", "model"}, ...] にする。"""
+    document_type, model = _path_labels(rel_path)
+    stem = os.path.splitext(os.path.basename(rel_path))[0]
+    with open(full_path, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    raw_sections: List[Dict] = []
+    if rel_path.endswith(".json"):
+        data = json.loads(content)
+        for item in data.get("sections", []) if isinstance(data, dict) else data:
+            if isinstance(item, dict) and item.get("text"):
+                raw_sections.append(item)
+    elif rel_path.endswith((".md", ".markdown")):
+        title, lines = stem, []
+        for line in content.splitlines():
+            heading = re.match(r"^#{1,6}\s+(.*)$", line)
+            if heading:
+                raw_sections.append({"title": title, "text": "\n".join(lines)})
+                title, lines = heading.group(1).strip(), []
+            else:
+                lines.append(line)
+        raw_sections.append({"title": title, "text": "\n".join(lines)})
+    else:
+        raw_sections.append({"title": stem, "text": content})
+
+    sections = []
+    for item in raw_sections:
+        chunks = _chunk_paragraphs(str(item.get("text", "")))
+        for i, chunk in enumerate(chunks):
+            title = str(item.get("title") or stem)
+            sections.append({
+                "title": title if len(chunks) == 1 else f"{title} ({i + 1}/{len(chunks)})",
+                "text": chunk,
+                "source": rel_path,
+                "documentType": str(item.get("documentType", document_type)),
+                "model": str(item.get("model", model)),
+            })
+    return sections
+
+
+def _iter_corpus(corpus_dir: str) -> Iterator[Tuple[str, str]]:
+    for dirpath, dirnames, filenames in os.walk(corpus_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(CORPUS_EXTENSIONS) and not name.startswith("."):
+                full_path = os.path.join(dirpath, name)
+                yield os.path.relpath(full_path, corpus_dir).replace(os.sep, "/"), full_path
+
+
+# ==========================================
+# 3) 索引の作成 (差分ビルド)
+# ==========================================
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    # 読み込み中のプロセスは古いファイルを mmap したまま使い続けられる
+    os.replace(tmp_path, path)
+
+
+def _pad8(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def _le(arr: array) -> bytes:
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def write_index(index_path: str, sections: List[Dict]):
+    """節 (terms: {語: 出現数} 付き) のリストから索引ファイルを書く。"""
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    doc_lengths = array("I")
+    doc_offsets = array("Q", [0])
+    doc_blob = bytearray()
+    for doc_id, section in enumerate(sections):
+        terms = section["terms"]
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append((doc_id, min(tf, 0xFFFF)))
+        doc_lengths.append(sum(terms.values()))
+        doc_blob.extend(json.dumps({k: section[k] for k in ("title", "text", "source", "documentType", "model")},
+                                   ensure_ascii=False).encode("utf-8"))
+        doc_offsets.append(len(doc_blob))
+
+    term_table, term_blob = array("I"), bytearray()
+    post_docs, post_tfs = array("I"), array("H")
+    for term in sorted(postings, key=lambda t: t.encode("utf-8")):
+        encoded = term.encode("utf-8")
+        entries = postings[term]
+        term_table.extend((len(term_blob), len(encoded), len(post_docs), len(entries)))
+        term_blob.extend(encoded)
+        for doc_id, tf in entries:
+            post_docs.append(doc_id)
+            post_tfs.append(tf)
+
+    body = bytearray()
+    offsets = []
+    for part in (_le(term_table), term_blob, _le(post_docs), _le(post_tfs), _le(doc_lengths), _le(doc_offsets),
+                 doc_blob):
+        offsets.append(_HEADER.size + len(body))
+        body.extend(part)
+        _pad8(body)
+    avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+    header = _HEADER.pack(MAGIC, len(sections), len(postings), len(post_docs), avg_length, *offsets)
+    _write_atomic(index_path, header + bytes(body))
+
+
+def build_index(corpus_dir: str = MANUAL_CORPUS_DIR, index_path: str = MANUAL_INDEX_PATH,
+                full: bool = False) -> Dict:
+    """
+    corpus_dir を索引して index_path に書く。前回のキャッシュ (<index_path>.cache.json) と
+    mtime/サイズが同じファイルは読み直さない。何も変わっていなければ索引ファイルも書き換えない。
+    """
+    started = time.perf_counter()
+    cache_path = index_path + ".cache.json"
+    cached_files: Dict[str, Dict] = {}
+    if not full and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("tokenizerVersion") == TOKENIZER_VERSION:
+                cached_files = cache.get("files", {})
+        except (OSError, ValueError):
+            logger.warning("マニュアル索引のキャッシュを読めないため、全ファイルを解析し直します", exc_info=True)
+
+    files: Dict[str, Dict] = {}
+    counts = {"parsed": 0, "reused": 0, "failed": 0}
+    for rel_path, full_path in _iter_corpus(corpus_dir):
+        st = os.stat(full_path)
+        previous = cached_files.get(rel_path)
+        if previous and previous["mtime"] == st.st_mtime and previous["size"] == st.st_size:
+            files[rel_path] = previous
+            counts["reused"] += 1
+            continue
+        try:
+            sections = parse_file(full_path, rel_path)
+        except (OSError, ValueError) as e:
+            logger.warning("マニュアルのファイルを読めないため索引に含めません: %s", rel_path,
+                           extra={"fields": {"event": "manual_file_error", "path": rel_path, "error": str(e)}})
+            counts["failed"] += 1
+            continue
+        for section in sections:
+            section["terms"] = dict(Counter(tokenize(section["title"] + "\n" + section["text"])))
+        files[rel_path] = {"mtime": st.st_mtime, "size": st.st_size, "sections": sections}
+        counts["parsed"] += 1
+    counts["removed"] = len(set(cached_files) - set(files))
+
+    sections = [s for rel_path in sorted(files) for s in files[rel_path]["sections"]]
+    changed = full or counts["parsed"] or counts["removed"] or not os.path.exists(index_path)
+    if changed:
+        write_index(index_path, sections)
+        _write_atomic(cache_path, json.dumps({"tokenizerVersion": TOKENIZER_VERSION, "files": files},
+                                             ensure_ascii=False).encode("utf-8"))
+    counts.update({
+        "files": len(files), "sections": len(sections), "written": bool(changed),
+        "bytes": os.path.getsize(index_path) if os.path.exists(index_path) else 0,
+        "ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+    return counts
+
+
+# ==========================================
+# 4) 検索 (mmap した索引を読む)
+# ==========================================
+class _MappedIndex:
+    """mmap した索引ファイル1つ。構築後は読み取り専用。"""
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise ValueError("manual index requires a little-endian host")
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.doc_count, self.term_count, posting_count, self.avg_length,
+         *offsets) = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a manual index")
+        term_table, term_blob, post_docs, post_tfs, doc_lengths, doc_offsets, doc_blob = offsets
+        view = memoryview(self._mm)
+        self._terms = view[term_table:term_table + 16 * self.term_count].cast("I")
+        self._term_blob = term_blob
+        self._post_docs = view[post_docs:post_docs + 4 * posting_count].cast("I")
+        self._post_tfs = view[post_tfs:post_tfs + 2 * posting_count].cast("H")
+        self._doc_lengths = view[doc_lengths:doc_lengths + 4 * self.doc_count].cast("I")
+        self._doc_offsets = view[doc_offsets:doc_offsets + 8 * (self.doc_count + 1)].cast("Q")
+        self._doc_blob = doc_blob
+        self.size = len(self._mm)
+        # BM25 の文書長による正規化項 k1 * (1 - b + b * 文書長 / 平均文書長) を文書ごとに前計算しておく
+        avg_length = self.avg_length or 1.0
+        self.length_norms = array("d", (BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                                        for length in self._doc_lengths))
+
+    def _term_bytes(self, i: int) -> bytes:
+        start = self._term_blob + self._terms[4 * i]
+        return self._mm[start:start + self._terms[4 * i + 1]]
+
+    def postings(self, term: str) -> Tuple[int, memoryview, memoryview]:
+        """(df, docId の列, tf の列)。語が無ければ df=0。"""
+        target = term.encode("utf-8")
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_bytes(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count and self._term_bytes(lo) == target:
+            start, df = self._terms[4 * lo + 2], self._terms[4 * lo + 3]
+            return df, self._post_docs[start:start + df], self._post_tfs[start:start + df]
+        return 0, self._post_docs[0:0], self._post_tfs[0:0]
+
+    def document(self, doc_id: int) -> Dict:
+        start = self._doc_blob + self._doc_offsets[doc_id]
+        end = self._doc_blob + self._doc_offsets[doc_id + 1]
+        return json.loads(self._mm[start:end].decode("utf-8"))
+
+
+class LocalSearchResult:
+    """ローカル検索の結果。confidence は上位1件が含むクエリ語の割合 (IDF で重み付け, 0〜1)。"""
+
+    def __init__(self, sections: List[Dict], confidence: float, budget_exceeded: bool, elapsed_ms: float):
+        self.sections = sections
+        self.confidence = confidence
+        self.budget_exceeded = budget_exceeded
+        self.elapsed_ms = elapsed_ms
+
+    def is_confident(self, min_confidence: float) -> bool:
+        return bool(self.sections) and not self.budget_exceeded and self.confidence >= min_confidence
+
+
+class ManualIndex:
+    """
+    索引ファイルを mmap して BM25 で検索する。ファイルが差し替わったら (build の実行後) 開き直す。
+      result = manual_index.search(query, document_type, model, top_k, budget_sec)  # 索引が無ければ None
+    """
+
+    def __init__(self, path: str = MANUAL_INDEX_PATH, reload_check_sec: float = MANUAL_INDEX_RELOAD_CHECK_SEC):
+        self.path = path
+        self.reload_check_sec = reload_check_sec
+        self._index: Optional[_MappedIndex] = None
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"searches": 0, "budgetExceeded": 0, "reloads": 0, "loadErrors": 0}
+
+    def _current(self) -> Optional[_MappedIndex]:
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._index
+        with self._lock:
+            if now < self._next_check:
+                return self._index
+            self._next_check = now + self.reload_check_sec
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                try:
+                    # 古い mmap は参照が無くなった時点で閉じられる (検索中のスレッドはそのまま使える)
+                    self._index = _MappedIndex(self.path) if mtime is not None else None
+                    self._counters["reloads"] += 1
+                    if self._index is not None:
+                        logger.info("マニュアル索引を読み込みました: %s", self.path, extra={"fields": {
+                            "event": "manual_index_loaded", "path": self.path, "docs": self._index.doc_count,
+                            "terms": self._index.term_count, "bytes": self._index.size}})
+                except (OSError, ValueError, struct.error):
+                    self._index = None
+                    self._counters["loadErrors"] += 1
+                    logger.exception("マニュアル索引を読み込めません: %s", self.path)
+            return self._index
+
+    def search(self, query: str, document_type: str = "", model: str = "", top_k: int = 3,
+               budget_sec: float = 0.05) -> Optional[LocalSearchResult]:
+        index = self._current()
+        if index is None:
+            return None
+        started = time.perf_counter()
+        deadline = started + budget_sec
+        self._counters["searches"] += 1
+
+        n = index.doc_count
+        postings = []
+        missing = 0
+        for term in dict.fromkeys(tokenize(query)):
+            df, doc_ids, tfs = index.postings(term)
+            if df:
+                postings.append((math.log(1 + (n - df + 0.5) / (df + 0.5)), doc_ids, tfs))
+            else:
+                missing += 1
+        # 確信度の分母: 索引に無い語は、見つかった語の IDF の平均で数える
+        # (無い語を最大の IDF で数えると、言い回しの差で生じる bigram だけで確信度が大きく下がるため)
+        found_weight = sum(idf for idf, _, _ in postings)
+        total_weight = found_weight + (missing * found_weight / len(postings) if postings else 0.0)
+
+        scores: Dict[int, float] = {}
+        matched: Dict[int, float] = {}
+        budget_exceeded = False
+        length_norms = index.length_norms
+        # IDF の大きい (絞り込みに効く) 語から処理し、時間切れの場合も主要な語は反映されるようにする
+        # 時間は BUDGET_CHECK_POSTINGS 件ごとに確認する (語の途中で打ち切ることもある)
+        for idf, doc_ids, tfs in sorted(postings, key=lambda p: p[0], reverse=True):
+            weight = idf * (BM25_K1 + 1)
+            for offset in range(0, len(doc_ids), BUDGET_CHECK_POSTINGS):
+                end = offset + BUDGET_CHECK_POSTINGS
+                for doc_id, tf in zip(doc_ids[offset:end].tolist(), tfs[offset:end].tolist()):
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + length_norms[doc_id])
+                    matched[doc_id] = matched.get(doc_id, 0.0) + idf
+                if time.perf_counter() > deadline:
+                    budget_exceeded = True
+                    break
+            if budget_exceeded:
+                break
+
+        # documentType / model が指定されていれば、ラベルの無い節か一致する節だけを返す
+        wanted_type, wanted_model = _normalize_label(document_type), _normalize_label(model)
+        sections: List[Dict] = []
+        top_doc = None
+        ranked = sorted(scores, key=scores.get, reverse=True)[:MAX_CANDIDATES]
+        for doc_id in ranked:
+            doc = index.document(doc_id)
+            if wanted_type and doc.get("documentType") and _normalize_label(doc["documentType"]) != wanted_type:
+                continue
+            if wanted_model and doc.get("model") and _normalize_label(doc["model"]) != wanted_model:
+                continue
+            if top_doc is None:
+                top_doc = doc_id
+            doc["score"] = round(scores[doc_id], 3)
+            sections.append(doc)
+            if len(sections) >= top_k:
+                break
+
+        confidence = matched[top_doc] / total_weight if top_doc is not None and total_weight else 0.0
+        if budget_exceeded:
+            self._counters["budgetExceeded"] += 1
+        return LocalSearchResult(sections, round(confidence, 3), budget_exceeded,
+                                 round((time.perf_counter() - started) * 1000, 2))
+
+    def stats(self) -> Dict:
+        index = self._current()
+        stats = dict(self._counters)
+        stats.update({
+            "path": self.path,
+            "loaded": index is not None,
+            "docs": index.doc_count if index else 0,
+            "terms": index.term_count if index else 0,
+            "bytes": index.size if index else 0,
+        })
+        return stats
+
+
+# アプリ全体で共有するインスタンス
+manual_index = ManualIndex()
+
+
+# ==========================================
+# 5) CLI
+# ==========================================
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build or query the local manual search index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="(re)build the index; only changed files are re-read")
+    build.add_argument("--corpus", default=MANUAL_CORPUS_DIR)
+    build.add_argument("--index", default=MANUAL_INDEX_PATH)
+    build.add_argument("--full", action="store_true", help="ignore the incremental cache")
+    search = sub.add_parser("search", help="run a query against the index")
+    search.add_argument("query")
+    search.add_argument("--index", default=MANUAL_INDEX_PATH)
+    search.add_argument("--type", default="", help="documentType filter")
+    search.add_argument("--model", default="")
+    search.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        if not os.path.isdir(args.corpus):
+            print(f"{args.corpus} does not exist", file=sys.stderr)
+            return 1
+        print(json.dumps(build_index(args.corpus, args.index, args.full), ensure_ascii=False))
+        return 0
+
+    result = ManualIndex(args.index).search(args.query, args.type, args.model, args.top_k, budget_sec=10)
+    if result is None:
+        print(f"{args.index} not found (run `python manual_index.py build`)", file=sys.stderr)
+        return 1
+    print(f"confidence={result.confidence} elapsed={result.elapsed_ms}ms")
+    for section in result.sections:
+        print(f"- [{section['score']}] {section['source']} / {section['title']}")
+        print("  " + section["text"][:200].replace("\n", " "))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+# metrics.py
+#
+# レイテンシ計測とメトリクス (Prometheus テキスト形式) の最小実装。
+# - Counter / Histogram をラベル付きで保持し、render_prometheus() で /metrics 用の文字列にする
+# - span("段階名") で処理段階ごとの所要時間を計り、ヒストグラムに記録する
+# - リクエストID は contextvars で持ち回り、1ターン内の span とログを結び付ける
+#   (スレッドプールに渡すときは contextvars.copy_context() で引き継ぐ)
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 秒単位のバケット (LLM 呼び出しは数秒〜数十秒かかるので上限を広めに取る)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+_spans: contextvars.ContextVar = contextvars.ContextVar("spans", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Sequence[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: expected labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(list(zip(self.labelnames, key)))} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [バケットごとの件数..., 合計, 件数]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[-1] if state else 0
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, state in items:
+            base = list(zip(self.labelnames, key))
+            for bound, n in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{_format_labels(base + [('le', _format_value(bound))])} {n}")
+            lines.append(f"{self.name}_bucket{_format_labels(base + [('le', '+Inf')])} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(base)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(base)} {state[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ---------- アプリ共通のメトリクス ----------
+http_request_seconds = registry.histogram(
+    "chatbot_http_request_duration_seconds", "HTTP request latency per endpoint (until the response is returned)",
+    ("endpoint", "method", "status"))
+stage_seconds = registry.histogram(
+    "chatbot_stage_duration_seconds", "Latency of each stage of a chat turn", ("stage",))
+llm_call_seconds = registry.histogram(
+    "chatbot_llm_call_duration_seconds", "Latency of each chat.completions call", ("model", "call"))
+llm_errors_total = registry.counter(
+    "chatbot_llm_errors_total", "chat.completions calls that raised", ("model", "call"))
+llm_retries_total = registry.counter(
+    "chatbot_llm_retries_total",
+    "Extra completion attempts (hedge_slow: first event later than the p95-based delay, "
+    "empty_reply: first attempt returned nothing, error: first attempt raised)", ("reason",))
+llm_hedge_winner_total = registry.counter(
+    "chatbot_llm_hedge_winner_total", "Which attempt answered first when a completion was hedged", ("winner",))
+deadline_exceeded_total = registry.counter(
+    "chatbot_deadline_exceeded_total", "Turns that ran out of time, by the stage that was cut short", ("stage",))
+llm_queue_wait_seconds = registry.histogram(
+    "chatbot_llm_queue_wait_seconds", "Time a completion waited in the LLM scheduler (rate limits / concurrency)",
+    ("priority",))
+llm_rate_limited_total = registry.counter(
+    "chatbot_llm_rate_limited_total", "Completions rejected with 429 by the API")
+model_route_total = registry.counter(
+    "chatbot_model_route_total", "Completions by routed model, the rule that chose it and the A/B variant",
+    ("variant", "rule", "model"))
+model_route_tokens_total = registry.counter(
+    "chatbot_model_route_tokens_total", "Token usage per A/B variant and model", ("variant", "model", "kind"))
+model_route_turn_seconds = registry.histogram(
+    "chatbot_model_route_turn_duration_seconds", "Whole chat turn (all completions and tools) per A/B variant",
+    ("variant",))
+llm_tokens_total = registry.counter(
+    "chatbot_llm_tokens_total", "Token usage reported by the API", ("model", "kind"))
+tool_seconds = registry.histogram(
+    "chatbot_tool_duration_seconds", "Latency of each tool (function) call", ("tool",))
+tool_errors_total = registry.counter(
+    "chatbot_tool_errors_total", "Tool calls that raised or returned success=false", ("tool",))
+tool_result_chars_total = registry.counter(
+    "chatbot_tool_result_chars_total",
+    "JSON characters of tool results before (raw) and after (compact) projection into the prompt", ("tool", "form"))
+machine_prefetch_total = registry.counter(
+    "chatbot_machine_prefetch_total",
+    "Speculative getMachineInfo lookups per chat turn (hit: a machine was found, miss: candidates "
+    "but no match, none: no candidate in the message)", ("result",))
+machine_prefetch_followup_total = registry.counter(
+    "chatbot_machine_prefetch_followup_total",
+    "Prefetched turns by whether the model still made its own tool round (needed_tools=true/false)",
+    ("needed_tools",))
+manual_search_total = registry.counter(
+    "chatbot_manual_search_total",
+    "searchManual calls by how they were answered (local, local_fallback, remote_disabled, "
+    "remote_no_index, remote_low_confidence, remote_budget)", ("route",))
+chat_jobs_total = registry.counter(
+    "chatbot_chat_jobs_total", "Chat jobs by outcome (accepted / rejected when the queue is full / done / failed)",
+    ("result",))
+answer_cache_total = registry.counter(
+    "chatbot_answer_cache_total", "Answer cache lookups by result (hit / miss / skipped)", ("result",))
+
+
+# ---------- リクエストID と span ----------
+def start_request(request_id: Optional[str] = None) -> str:
+    """リクエストの開始時に呼ぶ。リクエストID を決めて、span の記録を空にする。"""
+    request_id = request_id or uuid.uuid4().hex
+    _request_id.set(request_id)
+    _spans.set([])
+    return request_id
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def request_spans() -> List[Dict]:
+    """現在のリクエストで記録した span の一覧 (開始順)。"""
+    return list(_spans.get() or [])
+
+
+@contextmanager
+def span(stage: str, histogram: Histogram = stage_seconds, **labels):
+    """
+    with span("prompt_build"): ... のように囲んだ区間の所要時間を histogram に記録する。
+    histogram の既定は stage_seconds (ラベルは stage)。別のヒストグラムを渡す場合は labels を指定する。
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **(labels or {"stage": stage}))
+        spans = _spans.get()
+        if spans is not None:
+            spans.append({"stage": stage, "ms": round(elapsed * 1000, 1), **labels})
+        logger.debug("span %s took %.1fms", stage, elapsed * 1000)
+
+
+def record_usage(usage, model: str):
+    """レスポンスの usage をトークン数カウンタに加算する。"""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    llm_tokens_total.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    llm_tokens_total.inc(getattr(details, "cached_tokens", 0) or 0, model=model, kind="cached")
+    llm_tokens_total.inc(usage.completion_tokens or 0, model=model, kind="completion")
+
+
+def render_prometheus() -> str:
+    return registry.render()
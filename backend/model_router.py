@@ -0,0 +1,163 @@
+# model_router.py
+#
+# completion ごとに使うモデルを選ぶ。
+# - 規則 (rules): 挨拶などの短い発言や、tool 結果を言い換えるだけの2回目の completion は FAST_CHAT_MODEL、
+#   tool を使いそうな発言・長い履歴・大きな tool 結果は CHAT_MODEL (gpt-4o)
+# - MODEL_ROUTER_MODE で切り替える
+#     off   : 常に CHAT_MODEL (従来どおり。既定)
+#     rules : 上の規則で選ぶ
+#     ab    : セッションごとに rules と baseline (常に CHAT_MODEL) に振り分け、レイテンシ・トークン数・
+#             回答を比べられるようにする (振り分けは sessionId のハッシュなので同じセッションは同じ側)
+# 回答の品質が変わるので、ab で比べて問題が無いことを確かめてから rules にする。
+# 選んだ結果と所要時間はログ (event=model_route / model_route_turn) と /metrics に出す。
+# 回答の品質は、ab モードで model_route_turn のログに残す発言と回答 (requestId 付き) を評価して比べる。
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import metrics
+from history_manager import count_message_tokens, count_text_tokens
+
+logger = logging.getLogger(__name__)
+
+# 応答生成の標準モデル / 軽いモデル
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "gpt-4o")
+FAST_CHAT_MODEL = os.environ.get("FAST_CHAT_MODEL", "gpt-4o-mini")
+MODEL_ROUTER_MODE = os.environ.get("MODEL_ROUTER_MODE", "off")
+# ab モードで rules 側に振るセッションの割合 (%)
+MODEL_ROUTER_AB_PERCENT = int(os.environ.get("MODEL_ROUTER_AB_PERCENT", "50"))
+# この文字数以下で tool を使いそうにない発言は軽いモデルにする
+ROUTE_SHORT_MESSAGE_CHARS = int(os.environ.get("ROUTE_SHORT_MESSAGE_CHARS", "30"))
+# 履歴 (system を除く) がこのトークン数を超えたら標準モデルにする
+ROUTE_LONG_HISTORY_TOKENS = int(os.environ.get("ROUTE_LONG_HISTORY_TOKENS", "3000"))
+# tool 結果がこのトークン数を超えたら、tool 後の completion も標準モデルにする
+ROUTE_MAX_TOOL_RESULT_TOKENS = int(os.environ.get("ROUTE_MAX_TOOL_RESULT_TOKENS", "2000"))
+# tool を使いそうな発言の目印 (カンマ区切り)
+ROUTE_TOOL_KEYWORDS = [k.strip() for k in os.environ.get(
+    "ROUTE_TOOL_KEYWORDS",
+    "マニュアル,手順,交換,点検,整備,故障,エラー,警告,修理,部品,仕様,重量,担当,連絡,問い合わせ,号機,機種,"
+    "manual,error,spec"
+).split(",") if k.strip()]
+
+VARIANT_RULES, VARIANT_BASELINE = "rules", "baseline"
+
+# 機種名・号機らしき英数字 (PC200-8, 100001 など)
+_MACHINE_LIKE = re.compile(r"[A-Z]{1,4}\d{2,4}(?:-\d+)?|\d{4,8}")
+
+
+class RouteDecision:
+    """1回の completion に使うモデルと、その理由 (rule) と A/B の振り分け (variant)。"""
+
+    def __init__(self, model: str, rule: str, variant: str):
+        self.model = model
+        self.rule = rule
+        self.variant = variant
+
+
+def _last_user_index(conversation: List[Dict]) -> int:
+    for i in range(len(conversation) - 1, -1, -1):
+        if conversation[i].get("role") == "user":
+            return i
+    return -1
+
+
+class ModelRouter:
+    def __init__(self, mode: str = MODEL_ROUTER_MODE, strong_model: str = CHAT_MODEL,
+                 fast_model: str = FAST_CHAT_MODEL, ab_percent: int = MODEL_ROUTER_AB_PERCENT):
+        if mode not in ("off", "rules", "ab"):
+            logger.warning("unknown MODEL_ROUTER_MODE=%r; using 'off'", mode)
+            mode = "off"
+        self.mode = mode
+        self.strong_model = strong_model
+        self.fast_model = fast_model
+        self.ab_percent = ab_percent
+        self._lock = threading.Lock()
+        # (variant, model) -> [呼び出し数, 合計秒数]
+        self._calls: Dict = defaultdict(lambda: [0, 0.0])
+
+    def variant_for(self, route_key: Optional[str]) -> str:
+        """ターンの振り分け。ab モードでは route_key (sessionId) のハッシュで決める。"""
+        if self.mode == "off":
+            return VARIANT_BASELINE
+        if self.mode == "rules" or not route_key:
+            return VARIANT_RULES
+        bucket = int(hashlib.sha1(route_key.encode("utf-8")).hexdigest()[:8], 16) % 100
+        return VARIANT_RULES if bucket < self.ab_percent else VARIANT_BASELINE
+
+    def route(self, conversation: List[Dict], call: str, variant: str) -> RouteDecision:
+        """call ("initial" / "after_tools") の completion に使うモデルを選ぶ。"""
+        if variant == VARIANT_BASELINE:
+            return RouteDecision(self.strong_model, "baseline", variant)
+        last_user = _last_user_index(conversation)
+        history_tokens = sum(count_message_tokens(m) for m in conversation[:max(0, last_user)]
+                             if m.get("role") != "system")
+        if history_tokens > ROUTE_LONG_HISTORY_TOKENS:
+            return RouteDecision(self.strong_model, "long_history", variant)
+        if call == "after_tools":
+            tool_tokens = sum(count_text_tokens(m.get("content") or "") for m in conversation[last_user + 1:]
+                              if m.get("role") == "tool")
+            if tool_tokens > ROUTE_MAX_TOOL_RESULT_TOKENS:
+                return RouteDecision(self.strong_model, "large_tool_result", variant)
+            return RouteDecision(self.fast_model, "after_tools", variant)
+        user_msg = (conversation[last_user].get("content") or "") if last_user >= 0 else ""
+        if self.tools_likely(user_msg):
+            return RouteDecision(self.strong_model, "tools_likely", variant)
+        if len(user_msg.strip()) <= ROUTE_SHORT_MESSAGE_CHARS:
+            return RouteDecision(self.fast_model, "short_message", variant)
+        return RouteDecision(self.strong_model, "default", variant)
+
+    @staticmethod
+    def tools_likely(user_msg: str) -> bool:
+        """機種名・号機らしき英数字か、tool を使う質問によく出る語を含むか。"""
+        text = unicodedata.normalize("NFKC", user_msg).upper()
+        if _MACHINE_LIKE.search(text):
+            return True
+        return any(keyword.upper() in text for keyword in ROUTE_TOOL_KEYWORDS)
+
+    def observe_call(self, decision: RouteDecision, call: str, seconds: float, ok: bool):
+        """completion 1回分 (ヘッジ・再試行を含む) の所要時間を記録する。"""
+        metrics.model_route_total.inc(variant=decision.variant, rule=decision.rule, model=decision.model)
+        with self._lock:
+            stats = self._calls[(decision.variant, decision.model)]
+            stats[0] += 1
+            stats[1] += seconds
+        logger.info("model route %s -> %s (rule=%s, variant=%s) took %.2fs%s",
+                    call, decision.model, decision.rule, decision.variant, seconds, "" if ok else " (failed)",
+                    extra={"fields": {"event": "model_route", "call": call, "model": decision.model,
+                                      "rule": decision.rule, "variant": decision.variant,
+                                      "seconds": round(seconds, 3), "ok": ok}})
+
+    def observe_usage(self, decision: RouteDecision, usage):
+        """A/B でトークン数 (費用) を比べるため、variant ごとにも数える。"""
+        if usage is None:
+            return
+        metrics.model_route_tokens_total.inc(usage.prompt_tokens or 0, variant=decision.variant,
+                                             model=decision.model, kind="prompt")
+        metrics.model_route_tokens_total.inc(usage.completion_tokens or 0, variant=decision.variant,
+                                             model=decision.model, kind="completion")
+
+    def observe_turn(self, variant: str, models: List[str], seconds: float, user_msg: str, reply: str):
+        """ターン全体の結果。品質の比較はこのログを評価データと突き合わせて行う。"""
+        metrics.model_route_turn_seconds.observe(seconds, variant=variant)
+        fields = {"event": "model_route_turn", "variant": variant, "models": models, "seconds": round(seconds, 3),
+                  "replyChars": len(reply)}
+        if self.mode == "ab":
+            # 比較用の発言と回答は A/B の間だけ残す
+            fields.update(userMessage=user_msg[:200], reply=reply[:500])
+        logger.info("model route turn (variant=%s, models=%s) took %.2fs", variant, ",".join(models), seconds,
+                    extra={"fields": fields})
+
+    def stats(self) -> Dict:
+        with self._lock:
+            calls = {f"{variant}/{model}": {"calls": n, "avgSec": round(total / n, 3) if n else None}
+                     for (variant, model), (n, total) in sorted(self._calls.items())}
+        return {"mode": self.mode, "strongModel": self.strong_model, "fastModel": self.fast_model,
+                "abPercent": self.ab_percent if self.mode == "ab" else None, "calls": calls}
+
+
+model_router = ModelRouter()
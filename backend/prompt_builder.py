@@ -0,0 +1,124 @@
+# prompt_builder.py
+#
+# プロンプト (messages) の組み立て。
+# - system_prompt.txt は一度だけ読み込んで検証し、mtime が変わったときだけ読み直す
+# - ユーザ情報のシステムメッセージは /api/select-user の時点で一度だけ生成してセッションに保存する
+# - 並び順は「全ユーザ共通のシステムプロンプト」→ 履歴 → ユーザ情報 → 今回の発言 とし、
+#   大きな静的プレフィックスをユーザに依らずバイト単位で同一に保つ
+#   (OpenAI の自動プロンプトキャッシュが効くようにするため)
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT_FILE = os.environ.get("SYSTEM_PROMPT_FILE", "system_prompt.txt")
+DEFAULT_SYSTEM_PROMPT = "あなたは建設機械のチャットボットです。"
+# mtime を確認する最短間隔(秒)。これより短い間隔ではファイルを stat しない
+PROMPT_RELOAD_CHECK_INTERVAL = float(os.environ.get("PROMPT_RELOAD_CHECK_INTERVAL", "2.0"))
+
+
+class PromptValidationError(ValueError):
+    """system_prompt.txt の内容がプロンプトとして使えない。"""
+
+
+def validate_system_prompt(text: str) -> str:
+    """
+    プロンプトとして妥当か確認し、正規化した文字列を返す。
+    改行コードと末尾の空白を揃え、キャッシュ対象のプレフィックスが編集環境で揺れないようにする。
+    """
+    text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
+    if not text:
+        raise PromptValidationError("system prompt is empty")
+    if "\x00" in text:
+        raise PromptValidationError("system prompt contains NUL characters")
+    return text
+
+
+class SystemPromptCache:
+    """system_prompt.txt をメモリに保持し、mtime が変わったときだけ読み直す。"""
+
+    def __init__(self, path: str = SYSTEM_PROMPT_FILE,
+                 check_interval: float = PROMPT_RELOAD_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._text: Optional[str] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _load_locked(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if self._text is not None and mtime == self._mtime:
+            return
+        if mtime is None:
+            # ファイルが無い場合は従来どおり既定の文言を使う
+            self._text, self._mtime = DEFAULT_SYSTEM_PROMPT, None
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                text = validate_system_prompt(f.read())
+        except (OSError, UnicodeDecodeError, PromptValidationError) as e:
+            logger.error("%s rejected: %s", self.path, e)
+            if self._text is None:
+                self._text = DEFAULT_SYSTEM_PROMPT
+            # 壊れた版は採用せず、直前の版を使い続ける
+            self._mtime = mtime
+            return
+        self._text, self._mtime = text, mtime
+
+    def get(self) -> str:
+        now = time.monotonic()
+        if self._text is None or now - self._checked_at >= self.check_interval:
+            with self._lock:
+                if self._text is None or now - self._checked_at >= self.check_interval:
+                    self._load_locked()
+                    self._checked_at = now
+        return self._text
+
+    @property
+    def version(self) -> str:
+        """読み込み済みプロンプトの版 (mtime)。"""
+        self.get()
+        return str(self._mtime or 0)
+
+
+def render_user_context(user_info: Dict) -> str:
+    """
+    ユーザ情報のシステムメッセージ。/api/select-user で一度だけ生成してセッションに保存する。
+    """
+    return (
+        "現在のユーザ情報:\n"
+        f"  ユーザID: {user_info.get('userId', '')}\n"
+        f"  氏名: {user_info.get('userName', '')}\n"
+        f"  会社ID: {user_info.get('companyId', '')}\n"
+        f"  会社名: {user_info.get('companyName', '')}\n"
+        "\n"
+        "必要に応じてこれらを回答に活用してください。"
+    )
+
+
+def assemble_messages(system_prompt: str, history: List[Dict],
+                      user_context: str, user_msg: str) -> List[Dict]:
+    """
+    messages を組み立てる。
+      1) システムプロンプト (全ユーザ共通・静的 → プロバイダ側でキャッシュされる)
+      2) 過去の履歴 (要約 + 予算内の新しいメッセージ)
+      3) ユーザ情報 (セッションごとに異なるので静的部分より後ろに置く)
+      4) 今回のユーザメッセージ
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend(history)
+    if user_context:
+        messages.append({"role": "system", "content": user_context})
+    messages.append({"role": "user", "content": user_msg})
+    return messages
+
+
+# アプリ全体で共有するインスタンス
+system_prompt_cache = SystemPromptCache()
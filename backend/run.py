@@ -2,121 +2,200 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import json
+import time
+import logging
 import uuid
-from flask import Flask, request, jsonify, session, send_from_directory
+from flask import Flask, request, jsonify, session, Response, stream_with_context, g
 from flask_cors import CORS
 from datetime import datetime
 
 # chat_bot.py から generate_bot_reply をimport
-from chat_bot import generate_bot_reply
-
-app = Flask(__name__, static_folder="../frontend/dist", static_url_path="/")
-# app = Flask(__name__, static_folder=..., static_url_path=...)
+from chat_bot import generate_bot_reply, generate_bot_reply_stream
+# 発言中の (機種, 号機) の先読み (最初の completion の前に getMachineInfo を実行)
+from chat_bot import prefetch_machine_info, record_prefetch_followup
+# LLM 呼び出しのヘッジ (遅い/空の応答への再試行) の状態
+from chat_bot import hedge_stats
+# LLM 送出スケジューラ (レート制限・同時実行数) の状態
+from llm_scheduler import llm_scheduler
+# completion ごとのモデルの選び分け (軽いモデル / gpt-4o, A/B)
+from model_router import model_router
+# tool 結果の射影 (元の結果の side cache)
+from tool_results import tool_result_compactor
+# users.json / customer_machine_list.json の共有インデックス
+from data_repository import repository
+# セッションの保存先 (プロセス内 / SQLite / Redis)
+from session_store import create_session_store_from_env
+# 履歴のトークン予算管理と要約
+from history_manager import history_manager
+from chat_bot import summarize_conversation
+# system_prompt.txt のキャッシュとメッセージの組み立て
+from prompt_builder import system_prompt_cache, render_user_context, assemble_messages
+# スタッフ受信箱 (notifyStaff の保存先) の読み出し
+from staff_inbox import inbox_writer
+# マニュアル検索の共有HTTPクライアント (運用状況の参照用)
+from api_functions import search_client, manual_cache
+from manual_index import manual_index
+# ログ設定 (キュー経由の構造化JSONログ)
+from logging_setup import setup_logging, dropped_count
+# 段階ごとのレイテンシ計測と /metrics
+import metrics
+# よく聞かれる最初の質問の回答キャッシュ (ANSWER_CACHE_TTL_SEC > 0 で有効)
+from answer_cache import answer_cache
+
+# ジョブモード (/api/chat/jobs) の実行キュー
+from chat_jobs import chat_jobs, QueueFull, DONE
+
+from static_assets import StaticAssets, STATIC_DIR
+# 起動直後の準備 (preload / 外部 API への接続) と /api/ops/ready
+from warmup import warmup
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# フロントエンド (frontend/dist) は Flask の static ルートではなく serve_react (static_assets) で配信する
+# (static ルート "/<path:filename>" があると SPA のルートが 404 になるため)
+app = Flask(__name__, static_folder=None)
+static_assets = StaticAssets(STATIC_DIR)
 
 app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY", "demo-secret-key")
 #CORS(app, origins=["https://upgraded-space-cod-6jwrvpw49j6cggr-5000.app.github.dev/", "https://upgraded-space-cod-6jwrvpw49j6cggr-5173.app.github.dev/"])
 CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
-sessions = {}  # sessionId -> { isLoggedIn, userId, conversation (list) }
+# sessionId -> { isLoggedIn, userId, conversation (list) }
+# 保存先は SESSION_STORE 環境変数で切替 (memory / sqlite / redis)。
+# 複数ワーカーで動かす場合は sqlite か redis を使う。
+session_store = create_session_store_from_env()
+SESSION_SWEEP_INTERVAL_SEC = float(os.environ.get("SESSION_SWEEP_INTERVAL_SEC", "60"))
 
 
 def get_session_data(session_id):
-    if session_id not in sessions:
-       debug_print(f"session_id={session_id} not found. Creating new session with isLoggedIn=False.")
-       sessions[session_id] = {
-            "isLoggedIn": False,
-            "userId": None,
-            "conversation": []
-        }
-    return sessions[session_id]
+    """
+    セッションを返す。未知の sessionId (未ログイン) の場合は None を返し、エントリは作らない。
+    """
+    ensure_session_sweeper()
+    sess = session_store.get(session_id)
+    if sess is None:
+        logger.debug("session_id=%s not found.", session_id)
+    return sess
+
+
+def report_sessions(removed, stats):
+    """セッション掃除のたびに件数と保持バイト数をログに出す。"""
+    logger.info("sessions: count=%s conversationBytes=%s removed=%s",
+                stats["sessions"], stats["conversationBytes"], removed,
+                extra={"fields": {"event": "session_sweep", "sessions": stats["sessions"],
+                                  "conversationBytes": stats["conversationBytes"], "removed": removed}})
+
+
+# クライアント/プロキシから受け取る X-Request-ID の形式 (それ以外は新しく採番する)
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+@app.before_request
+def begin_request_trace():
+    # gunicorn.conf.py を使わない起動方法でも、最初のリクエストで準備を始める
+    warmup.start()
+    incoming = request.headers.get("X-Request-ID", "")
+    g.request_id = metrics.start_request(incoming if _REQUEST_ID_PATTERN.match(incoming) else None)
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def finish_request_trace(response):
+    # ストリーミング応答はヘッダを返すまでの時間になる (本文の所要時間は stream_total の span で計る)
+    started = g.get("request_started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint,
+                                             method=request.method, status=response.status_code)
+    if g.get("request_id"):
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+def log_turn_spans(session_id):
+    """1ターン分の span (段階ごとの所要時間) をリクエストID 付きで1行にまとめて出す。"""
+    spans = metrics.request_spans()
+    logger.info("chat turn finished: %s", ", ".join(f"{s['stage']}={s['ms']}ms" for s in spans),
+                extra={"fields": {"event": "chat_turn", "sessionId": session_id, "spans": spans}})
+
+
+def ensure_session_sweeper():
+    # アイドルセッションの破棄と件数上限の適用をバックグラウンドで行う
+    session_store.start_sweeper(SESSION_SWEEP_INTERVAL_SEC, report_sessions)
 
-# --------------------------------------
-# デバッグ用: コマンドラインにメッセージを出力する
-def debug_print(msg):
-    print(f"[DEBUG] {msg}", flush=True)  # flush=True で即時出力
-# --------------------------------------
 
 @app.route("/api/login", methods=["POST"])
 def api_login():
-    debug_print("==== /api/login called ====")
+    logger.debug("/api/login called")
     data = request.json
-    debug_print(f"POST data: {data}")
+    logger.debug("POST data: %s", data)
     if not data:
-        debug_print("No data received in /api/login")
+        logger.debug("No data received in /api/login")
         return jsonify({"error": "No data"}), 400
 
     user_id = data.get("userId")
     password = data.get("password")
-    debug_print(f"user_id={user_id}, password={password}")
+    logger.debug("login attempt user_id=%s", user_id)
 
     if user_id == "test" and password == "test":
         session_id = str(uuid.uuid4())
-        sessions[session_id] = {
+        ensure_session_sweeper()
+        session_store.create(session_id, {
             "isLoggedIn": True,
             "userId": None,
             "conversation": []
-        }
-        debug_print(f"Login success, sessionId={session_id}")
+        })
+        logger.info("Login success user_id=%s sessionId=%s", user_id, session_id)
         return jsonify({"sessionId": session_id}), 200
     else:
-        debug_print("Invalid credentials")
+        logger.info("Invalid credentials user_id=%s", user_id)
         return jsonify({"error": "Invalid credentials"}), 401
 
 
+# /api/users の1ページの既定件数と上限
+USERS_PAGE_DEFAULT_LIMIT = int(os.environ.get("USERS_PAGE_DEFAULT_LIMIT", "50"))
+USERS_PAGE_MAX_LIMIT = int(os.environ.get("USERS_PAGE_MAX_LIMIT", "500"))
+
+
 @app.route("/api/users", methods=["GET"])
 def api_users():
-    debug_print("==== /api/users called ====")
-    try:
-        with open("users.json", "r", encoding="utf-8") as f:
-            users_data = json.load(f)
-    except FileNotFoundError:
-        debug_print("users.json not found")
-        return jsonify({"users": []})
-    except json.JSONDecodeError:
-        debug_print("users.json decode error")
-        return jsonify({"users": []})
-
-    # 2) customer_machine_list.jsonを読み込み
-    machine_list = []
+    """
+    GET /api/users?q=...&offset=0&limit=50
+    ユーザ一覧 (会社ごとの台数付き) を users.json の順に返す。
+    q を指定すると userId / userName / companyName の前方一致で絞り込む。
+    ETag はデータファイルの版から作るので、変化が無ければ If-None-Match に 304 を返す。
+    応答: { "users": [...], "total": 該当件数, "offset": N, "limit": M }
+    """
+    logger.debug("/api/users called")
     try:
-        with open("customer_machine_list.json", "r", encoding="utf-8") as f:
-            machine_list = json.load(f)  # [{ "companyId":"C001","machines":[...] }, ...]
-    except FileNotFoundError:
-        debug_print("customer_machine_list.json not found")
-        # ない場合は空配列 -> 全社0台扱い
-    except json.JSONDecodeError:
-        debug_print("customer_machine_list.json decode error")
-
-    # machine_listを { "C001":台数, "C002":台数, ... } にまとめる
-    company_machine_count = {}
-    for company_block in machine_list:
-        c_id = company_block["companyId"]
-        c_machines = company_block.get("machines", [])
-        company_machine_count[c_id] = len(c_machines)
-
-    output_list = []
-    for u in users_data:
-        c_id = u.get("companyId", "")
-        # c_idがmachine_listにあれば、台数を取得。なければ0
-        m_count = company_machine_count.get(c_id, 0)
-        out_item = {
-            "userId": u["userId"],
-            "userName": u["userName"],
-            "companyId": c_id,
-            "companyName": u.get("companyName", ""),
-            "machineCount": m_count
-        }
-        output_list.append(out_item)
-    debug_print(f"Returning {len(output_list)} users with machineCount.")
-    return jsonify({"users": output_list})
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = int(request.args.get("limit", USERS_PAGE_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    limit = min(max(1, limit), USERS_PAGE_MAX_LIMIT)
+
+    # 一覧と検索インデックスはスナップショット構築時に作成済み (users.json と台数の結合も済み)
+    snap = repository.snapshot()
+    etag = f"users-{snap.version}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+    total, users = snap.user_directory.search(request.args.get("q", ""), offset, limit)
+    logger.debug("Returning %d of %d users with machineCount.", len(users), total)
+    response = jsonify({"users": users, "total": total, "offset": offset, "limit": limit})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
 
 
 @app.route("/api/select-user", methods=["POST"])
 def api_select_user():
-    debug_print("==== /api/select-user called ====")
+    logger.debug("/api/select-user called")
     data = request.json
-    debug_print(f"POST data: {data}")
+    logger.debug("POST data: %s", data)
     if not data:
         return jsonify({"error": "No data"}), 400
 
@@ -126,159 +205,543 @@ def api_select_user():
         return jsonify({"error": "sessionId and userId required"}), 400
 
     sess = get_session_data(session_id)
-    if not sess["isLoggedIn"]:
+    if not sess or not sess["isLoggedIn"]:
         return jsonify({"error": "Not logged in"}), 401
 
     # users.json を検索して userId=chosen_user_id のユーザ情報を得る
     user_info = find_user_info_by_userId(chosen_user_id)
-    sess["userInfo"] = user_info  # {"userId":"U001","userName":"山田太郎","companyName":"ABC建設",...}
-
-    sess["userId"] = chosen_user_id
-    sess["conversation"] = []  # reset conversation
-    debug_print(f"User {chosen_user_id} selected for session={session_id}")
+    with session_store.transaction(session_id) as sess:
+        if sess is None:
+            return jsonify({"error": "Not logged in"}), 401
+        sess["userInfo"] = user_info  # {"userId":"U001","userName":"山田太郎","companyName":"ABC建設",...}
+        # プロンプトに載せるユーザ情報はここで一度だけ生成しておく
+        sess["userContext"] = render_user_context(user_info) if user_info else ""
+
+        sess["userId"] = chosen_user_id
+        clear_conversation(sess)  # reset conversation
+    logger.info("User %s selected for session=%s", chosen_user_id, session_id)
     return jsonify({"message": f"User {chosen_user_id} selected"}), 200
 
 def find_user_info_by_userId(user_id):
-    # users.jsonを読み込み、該当のuser_idを探してreturn
-    with open("users.json", "r", encoding="utf-8") as f:
-        all_users = json.load(f)
-    for u in all_users:
-        if u["userId"] == user_id:
-            return u
-    return {}
+    # userId インデックスから該当ユーザを探してreturn
+    user_info = repository.find_user(user_id)
+    return dict(user_info) if user_info else {}
+
+def build_conversation(sess, user_msg):
+    """
+    システムプロンプト (system_prompt.txt) + 既存会話履歴 + ユーザ情報 + 今回のユーザメッセージ
+    を messages 形式にまとめて返す。(/api/chat と /api/chat/stream で共用)
+    並び順は prompt_builder.assemble_messages を参照 (静的プレフィックスをユーザ間で共通に保つ)。
+    """
+    # 1) system_prompt.txt (メモリ上にキャッシュ済み。更新されたときだけ読み直す)
+    system_prompt_text = system_prompt_cache.get()
+
+    # 2) ユーザ情報のシステムメッセージ (/api/select-user で生成済み)
+    user_context = sess.get("userContext", "")
+    if not user_context and sess.get("userInfo"):
+        user_context = render_user_context(sess["userInfo"])
+
+    # 3) 過去の履歴 (トークン予算内の新しいメッセージ + 古いターンの要約)
+    #    sess["conversation"] は [{"role":"user","content":"..."}, {"role":"assistant","content":"..."}]
+    history = history_manager.select_history(sess)
+
+    return assemble_messages(system_prompt_text, history, user_context, user_msg)
+
+
+def answer_cache_key(sess, conversation, user_msg):
+    """回答キャッシュのキー。対象外 (無効/履歴が長いなど) なら None。"""
+    user_info = sess.get("userInfo") or {}
+    return answer_cache.key_for(conversation, sess.get("userContext", ""), user_info.get("companyId"),
+                                user_msg, len(sess.get("conversation", [])))
+
+
+def clear_conversation(sess):
+    """
+    会話をリセットする。メッセージ番号 (index) は単調増加させたいので、
+    消したメッセージの数だけ messageBase を進めておく。
+    """
+    sess["messageBase"] = sess.get("messageBase", 0) + len(sess.get("conversation", []))
+    sess["conversation"] = []
+    sess.pop("summary", None)
+
+
+def message_index(sess):
+    """次に追加されるメッセージの番号 (= これまでのメッセージ総数)。クライアントの since カーソルに使う。"""
+    return sess.get("messageBase", 0) + len(sess.get("conversation", []))
+
+
+def append_turn(session_id, user_msg, bot_reply):
+    """
+    今回のユーザ発言と応答をセッションに追記し、(追記したメッセージ, index, セッション) を返す。
+    セッション単位のロック内で追記し、同時リクエストの追記が混ざらないようにする。
+    セッションが消えていた場合は (追記したメッセージ, None, None)。
+    """
+    new_messages = [
+        {"role": "user", "content": user_msg},
+        {"role": "assistant", "content": bot_reply}
+    ]
+    with session_store.transaction(session_id) as sess:
+        if sess is None:
+            return new_messages, None, None
+        sess["conversation"].extend(new_messages)
+        index = message_index(sess)
+    # 予算からあふれた古いターンの要約は、応答とは別にバックグラウンドで更新する
+    history_manager.schedule_summary(session_store, session_id, summarize_conversation)
+    return new_messages, index, sess
+
+
+def turn_payload(bot_reply, new_messages, index, sess, include_conversation):
+    """
+    /api/chat (と stream の done イベント) の応答。
+    既定では今回追加されたメッセージだけを返し、全履歴は includeConversation=true のときだけ付ける。
+    """
+    payload = {
+        "reply": bot_reply,
+        "messages": new_messages,
+        "index": index
+    }
+    if include_conversation and sess is not None:
+        payload["conversation"] = sess["conversation"]
+    return payload
+
+
+def process_chat_turn(session_id, sess, user_msg):
+    """
+    1ターン分の処理 (/api/chat とジョブモードで共用)。(応答, 追記したメッセージ, index, セッション) を返す。
+    セッションが途中で消えた場合のセッションは None (append_turn を参照)。
+    """
+    # 1)-2) システムプロンプト + ユーザ情報 + 履歴 + 今回のメッセージ
+    with metrics.span("prompt_build"):
+        conversation = build_conversation(sess, user_msg)
+
+    # 3) OpenAIに問い合わせ (generate_bot_reply)。同じ最初の質問の回答がキャッシュにあればそれを使う
+    cache_key = answer_cache_key(sess, conversation, user_msg)
+    bot_reply = answer_cache.get(cache_key)
+    if bot_reply is None:
+        with metrics.span("prefetch"):
+            prefetched = prefetch_machine_info(conversation, user_msg)
+        with metrics.span("generate"):
+            bot_reply = generate_bot_reply(conversation, route_key=session_id)
+        if prefetched:
+            record_prefetch_followup(conversation)
+        # notifyStaff を呼んだターンやエラー応答は保存されない
+        answer_cache.put(cache_key, bot_reply, conversation)
+
+    # 4) conversationに最終的な2つのメッセージ(ユーザ→assistant)を反映
+    #   - generate_bot_reply 内部の tool 呼び出しなどは保存せず、回答テキスト(bot_reply)だけを追記
+    with metrics.span("persist"):
+        new_messages, index, sess = append_turn(session_id, user_msg, bot_reply)
+    log_turn_spans(session_id)
+    return bot_reply, new_messages, index, sess
+
 
 # =====================
 # ここからが今回のポイント： /api/chat
 # =====================
 @app.route("/api/chat", methods=["POST"])
 def api_chat():
-    debug_print("==== /api/chat called ====")
+    logger.debug("/api/chat called")
     """
-    { "sessionId":..., "message":"...ユーザ入力..." }
+    { "sessionId":..., "message":"...ユーザ入力...", "includeConversation": false }
     システムプロンプト (system_prompt.txt) + 既存会話履歴 + 今回のユーザメッセージ
     をまとめて generate_bot_reply(conversation) に渡し、回答を得る。
+    応答: { "reply", "messages": 今回追加された2件, "index": 次のメッセージ番号 }
+    (全履歴は includeConversation=true のとき、または GET /api/chat/history で取得する)
     """
     data = request.json
-    debug_print(f"POST data: {data}")
+    logger.debug("POST data: %s", data)
 
     if not data:
-        debug_print("No data in /api/chat")
+        logger.debug("No data in /api/chat")
         return jsonify({"error": "No data"}), 400
 
     session_id = data.get("sessionId")
     user_msg = data.get("message", "")
-    debug_print(f"sessionId={session_id}, user_msg='{user_msg}'")
+    logger.debug("sessionId=%s, user_msg=%r", session_id, user_msg)
 
     if not session_id:
         return jsonify({"error": "sessionId required"}), 400
 
     sess = get_session_data(session_id)
-    if not sess["isLoggedIn"]:
+    if not sess or not sess["isLoggedIn"]:
         return jsonify({"error": "Not logged in"}), 401
 
-    # 1) system_prompt.txt の読み込み
-    system_prompt_text = ""
+    bot_reply, new_messages, index, sess = process_chat_turn(session_id, sess, user_msg)
+    if sess is None:
+        # 応答待ちの間に /api/chat/finish された
+        return jsonify({"error": "Session finished"}), 410
+
+    logger.debug("conversation so far: %d messages", index)
+
+    # 5) 応答を返す (今回追加分のみ)
+    return jsonify(turn_payload(bot_reply, new_messages, index, sess,
+                                bool(data.get("includeConversation")))), 200
+
+
+def sse_event(event, payload):
+    """Server-Sent Events の1イベント分の文字列を作る。"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.route("/api/chat/stream", methods=["POST"])
+def api_chat_stream():
+    logger.debug("/api/chat/stream called")
+    """
+    /api/chat のストリーミング版。リクエスト形式は /api/chat と同じ。
+    応答は text/event-stream で、以下のイベントを順に送る:
+      event: delta          data: {"content": "...トークン..."}
+      event: function_call  data: {"name": "getMachineInfo"}
+      event: done           data: {"reply": "...最終テキスト...", "messages": [...], "index": N}
+    ストリーム終了時に会話をセッションへ保存する。
+    """
+    data = request.json
+    logger.debug("POST data: %s", data)
+
+    if not data:
+        logger.debug("No data in /api/chat/stream")
+        return jsonify({"error": "No data"}), 400
+
+    session_id = data.get("sessionId")
+    user_msg = data.get("message", "")
+    logger.debug("sessionId=%s, user_msg=%r", session_id, user_msg)
+
+    if not session_id:
+        return jsonify({"error": "sessionId required"}), 400
+
+    sess = get_session_data(session_id)
+    if not sess or not sess["isLoggedIn"]:
+        return jsonify({"error": "Not logged in"}), 401
+
+    with metrics.span("prompt_build"):
+        conversation = build_conversation(sess, user_msg)
+    include_conversation = bool(data.get("includeConversation"))
+    cache_key = answer_cache_key(sess, conversation, user_msg)
+
+    def reply_events():
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            yield ("delta", cached)
+            yield ("done", cached)
+            return
+        with metrics.span("prefetch"):
+            prefetched = prefetch_machine_info(conversation, user_msg)
+        for kind, value in generate_bot_reply_stream(conversation, route_key=session_id):
+            if kind == "done":
+                answer_cache.put(cache_key, value, conversation)
+                if prefetched:
+                    record_prefetch_followup(conversation)
+            yield (kind, value)
+
+    def generate():
+        bot_reply = ""
+        started = time.perf_counter()
+        first_delta = True
+        with metrics.span("generate"):
+            for kind, value in reply_events():
+                if kind == "delta":
+                    if first_delta:
+                        metrics.stage_seconds.observe(time.perf_counter() - started, stage="first_delta")
+                        first_delta = False
+                    yield sse_event("delta", {"content": value})
+                elif kind == "function_call":
+                    yield sse_event("function_call", {"name": value})
+                elif kind == "done":
+                    bot_reply = value
+
+        # ストリーム終了時に会話を保存
+        with metrics.span("persist"):
+            new_messages, index, sess = append_turn(session_id, user_msg, bot_reply)
+        metrics.stage_seconds.observe(time.perf_counter() - started, stage="stream_total")
+        log_turn_spans(session_id)
+        logger.debug("stream finished for session=%s", session_id)
+
+        yield sse_event("done", turn_payload(bot_reply, new_messages, index, sess, include_conversation))
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # プロキシでのバッファリングを抑止
+        }
+    )
+
+
+# =====================
+# ジョブモード: /api/chat/jobs
+# =====================
+# long-poll で待つ最大秒数 (これを過ぎたら status だけ返し、クライアントは再度問い合わせる)
+CHAT_JOB_POLL_MAX_WAIT_SEC = float(os.environ.get("CHAT_JOB_POLL_MAX_WAIT_SEC", "25"))
+# SSE でジョブの終了を待つ間の keep-alive コメントの間隔 (秒)
+CHAT_JOB_SSE_KEEPALIVE_SEC = float(os.environ.get("CHAT_JOB_SSE_KEEPALIVE_SEC", "15"))
+
+
+def run_chat_job(session_id, user_msg, include_conversation, request_id):
+    """ジョブの本体 (chat_jobs のスレッドで動く)。/api/chat の応答と同じ dict を返す。"""
+    # 受け付けたリクエストと同じリクエストID で、このターンの span を新しく記録する
+    metrics.start_request(request_id)
+    sess = get_session_data(session_id)
+    if not sess or not sess["isLoggedIn"]:
+        raise RuntimeError("Not logged in")
+    bot_reply, new_messages, index, sess = process_chat_turn(session_id, sess, user_msg)
+    if sess is None:
+        raise RuntimeError("Session finished")
+    return turn_payload(bot_reply, new_messages, index, sess, include_conversation)
+
+
+def chat_jobs_unavailable():
+    """ワーカーが複数でジョブモードを使えないときの 503 応答 (使えるなら None)。"""
+    if chat_jobs.available():
+        return None
+    return jsonify({"error": "Chat job mode requires a single worker process; use /api/chat"}), 503
+
+
+def find_session_job(job_id, session_id):
+    """ジョブID とセッションの組が合うジョブ。他のセッションのジョブは見せない。"""
+    job = chat_jobs.get(job_id)
+    if job is None or job.session_id != session_id:
+        return None
+    return job
+
+
+@app.route("/api/chat/jobs", methods=["POST"])
+def api_chat_job_submit():
+    """
+    /api/chat のジョブ版。リクエスト形式は /api/chat と同じで、応答を待たずに 202 を返す。
+      応答: { "jobId", "status": "queued" }  (Location ヘッダに結果の取得先)
+    結果は GET /api/chat/jobs/<jobId> (long-poll) か GET /api/chat/jobs/<jobId>/events (SSE) で受け取る。
+    実行待ちが CHAT_JOB_QUEUE_DEPTH 件を超えていたら 429 (Retry-After 付き)。
+    同じセッションのジョブは受け付けた順に実行する。
+    ワーカーが複数のときは 503 (ジョブは受け付けたプロセスにしか無いため)。
+    """
+    unavailable = chat_jobs_unavailable()
+    if unavailable:
+        return unavailable
+    data = request.json
+    if not data:
+        return jsonify({"error": "No data"}), 400
+
+    session_id = data.get("sessionId")
+    user_msg = data.get("message", "")
+    if not session_id:
+        return jsonify({"error": "sessionId required"}), 400
+
+    sess = get_session_data(session_id)
+    if not sess or not sess["isLoggedIn"]:
+        return jsonify({"error": "Not logged in"}), 401
+
+    include_conversation = bool(data.get("includeConversation"))
     try:
-        with open("system_prompt.txt", "r", encoding="utf-8") as f:
-            system_prompt_text = f.read()
-    except FileNotFoundError:
-        system_prompt_text = "あなたは建設機械のチャットボットです。"
-
-    # 2) ユーザ情報を追加のシステムメッセージとして注入 (もしあるなら)
-    user_info_msg = ""
-    user_info = sess.get("userInfo", {})
-    if user_info:
-        user_info_msg = f"""
-        現在のユーザ情報:
-          ユーザID: {user_info.get("userId","")}
-          氏名: {user_info.get("userName","")}
-          会社ID: {user_info.get("companyId","")}
-          会社名: {user_info.get("companyName","")}
-        
-        必要に応じてこれらを回答に活用してください。
-        """
-
-    # 2) 会話全体をmessages形式にまとめる
-    #   - 先頭: systemプロンプト
-    #   - 続き: sess["conversation"] (過去のユーザ/assistant)
-    #   - 最後: 今回のユーザメッセージ
-    conversation = []
-    conversation.append({"role": "system", "content": system_prompt_text})
-
-    if user_info_msg:
-        conversation.append({"role":"system", "content": user_info_msg})
-        
-    # 過去の履歴を追加
-    # sess["conversation"] は [{"role":"user","content":"..."}, {"role":"assistant","content":"..."}]
-    for msg in sess["conversation"]:
-        conversation.append(msg)
-
-    # 今回のユーザメッセージを会話に追加
-    conversation.append({"role": "user", "content": user_msg})
-
-    # 3) OpenAIに問い合わせ (generate_bot_reply)
-    bot_reply = generate_bot_reply(conversation)
+        job = chat_jobs.submit(session_id, lambda: run_chat_job(session_id, user_msg, include_conversation,
+                                                                g.request_id))
+    except QueueFull as e:
+        logger.warning("chat job rejected: %s", e)
+        response = jsonify({"error": "Too many requests", "retryAfter": e.retry_after})
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 429
 
-    # 4) conversationに最終的な2つのメッセージ(ユーザ→assistant)を反映
-    #   - すでに下記のような構造だが、generate_bot_reply 内部で conversation を増やしているかどうかによる
-    #   - ここでは回答テキスト(bot_reply)を会話に追記
-    sess["conversation"].append({"role": "user", "content": user_msg})
-    sess["conversation"].append({"role": "assistant", "content": bot_reply})
+    response = jsonify(job.to_dict())
+    response.headers["Location"] = f"/api/chat/jobs/{job.id}?sessionId={session_id}"
+    return response, 202
 
-    debug_print(f"conversation so far: {sess['conversation']}")
 
-    # 5) 応答を返す
-    return jsonify({
-        "reply": bot_reply,
-        "conversation": sess["conversation"]
-    }), 200
+@app.route("/api/chat/jobs/<job_id>", methods=["GET"])
+def api_chat_job_result(job_id):
+    """
+    ジョブの状態と結果 (long-poll)。?sessionId=...&wait=秒
+    終わっていなければ最大 wait 秒 (上限 CHAT_JOB_POLL_MAX_WAIT_SEC) 待つ。
+      応答: { "jobId", "status": queued / running / done / failed, "result": /api/chat と同じ形 (done のとき),
+              "error": "..." (failed のとき) }
+    """
+    unavailable = chat_jobs_unavailable()
+    if unavailable:
+        return unavailable
+    job = find_session_job(job_id, request.args.get("sessionId"))
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    try:
+        wait = float(request.args.get("wait", CHAT_JOB_POLL_MAX_WAIT_SEC))
+    except ValueError:
+        return jsonify({"error": "wait must be a number"}), 400
+    job.wait(min(max(0.0, wait), CHAT_JOB_POLL_MAX_WAIT_SEC))
+    return jsonify(job.to_dict()), 200
+
+
+@app.route("/api/chat/jobs/<job_id>/events", methods=["GET"])
+def api_chat_job_events(job_id):
+    """
+    ジョブの状態を Server-Sent Events で送る。?sessionId=...
+      event: status  data: {"jobId", "status"}   : 状態が変わるたび (queued / running)
+      event: done    data: /api/chat と同じ形     : 完了時 (ここでストリームを閉じる)
+      event: failed  data: {"jobId", "status", "error"}
+    待っている間は CHAT_JOB_SSE_KEEPALIVE_SEC ごとに keep-alive コメントを送る。
+    """
+    unavailable = chat_jobs_unavailable()
+    if unavailable:
+        return unavailable
+    job = find_session_job(job_id, request.args.get("sessionId"))
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        last_status = None
+        last_sent = time.monotonic()
+        while not job.finished:
+            if job.status != last_status:
+                last_status = job.status
+                last_sent = time.monotonic()
+                yield sse_event("status", {"jobId": job.id, "status": job.status})
+            if job.wait(1.0):
+                break
+            if time.monotonic() - last_sent >= CHAT_JOB_SSE_KEEPALIVE_SEC:
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+        if job.status == DONE:
+            yield sse_event("done", job.result)
+        else:
+            yield sse_event("failed", job.to_dict())
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+@app.route("/api/chat/history", methods=["GET"])
+def api_chat_history():
+    """
+    GET /api/chat/history?sessionId=...&since=N
+    メッセージ番号 since 以降のメッセージを返す (since 省略時は全履歴)。
+    ETag を付けるので、変化が無ければ If-None-Match に 304 を返す。
+    応答: { "messages": [...], "since": 実際の開始番号, "index": 次のメッセージ番号 }
+    """
+    session_id = request.args.get("sessionId")
+    if not session_id:
+        return jsonify({"error": "sessionId required"}), 400
+    try:
+        since = int(request.args.get("since", 0))
+    except ValueError:
+        return jsonify({"error": "since must be an integer"}), 400
+
+    sess = get_session_data(session_id)
+    if not sess or not sess["isLoggedIn"]:
+        return jsonify({"error": "Not logged in"}), 401
+
+    base = sess.get("messageBase", 0)
+    index = message_index(sess)
+    # リセットで messageBase が変わるとメッセージ数が同じでも別の ETag になる
+    etag = f"{base}-{index}-{max(since, base)}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+    start = max(since, base)
+    messages = sess["conversation"][start - base:]
+    response = jsonify({"messages": messages, "since": start, "index": index})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response, 200
 
 
 @app.route("/api/chat/reset", methods=["POST"])
 def api_chat_reset():
-    debug_print("==== /api/chat/reset called ====")
+    logger.debug("/api/chat/reset called")
     data = request.json
-    debug_print(f"POST data: {data}")
+    logger.debug("POST data: %s", data)
     if not data:
         return jsonify({"error": "No data"}), 400
 
     session_id = data.get("sessionId")
     sess = get_session_data(session_id)
-    if not sess["isLoggedIn"]:
+    if not sess or not sess["isLoggedIn"]:
         return jsonify({"error": "Not logged in"}), 401
 
-    sess["conversation"] = []
-    debug_print(f"Chat reset for session {session_id}")
+    with session_store.transaction(session_id) as sess:
+        if sess is not None:
+            clear_conversation(sess)
+    logger.info("Chat reset for session %s", session_id)
     return jsonify({"message": "Chat history reset."}), 200
 
 
 @app.route("/api/chat/finish", methods=["POST"])
 def api_chat_finish():
-    debug_print("==== /api/chat/finish called ====")
+    logger.debug("/api/chat/finish called")
     data = request.json
-    debug_print(f"POST data: {data}")
+    logger.debug("POST data: %s", data)
 
     if not data:
         return jsonify({"error": "No data"}), 400
 
     session_id = data.get("sessionId")
-    if session_id in sessions:
-        del sessions[session_id]
+    session_store.delete(session_id)
 
-    debug_print(f"Chat finished (session {session_id} removed).")
+    logger.info("Chat finished (session %s removed).", session_id)
     return jsonify({"message": "Chat finished"}), 200
 
 
+def machine_prefetch_stats():
+    """発言からの getMachineInfo 先読みの件数と的中率 (候補があったターンのうち車両が見つかった割合)。"""
+    counts = {r: int(metrics.machine_prefetch_total.value(result=r)) for r in ("hit", "miss", "none")}
+    attempted = counts["hit"] + counts["miss"]
+    counts["hitRate"] = round(counts["hit"] / attempted, 3) if attempted else 0.0
+    counts["avoidedToolRounds"] = int(metrics.machine_prefetch_followup_total.value(needed_tools="false"))
+    return counts
+
+
+@app.route("/api/ops/stats", methods=["GET"])
+def api_ops_stats():
+    """運用確認用: 外部APIクライアントのプール/ブレーカー状態、検索キャッシュ、セッション数などを返す。"""
+    return jsonify({
+        "searchClient": search_client.stats(),
+        "manualCache": manual_cache.stats(),
+        "manualIndex": manual_index.stats(),
+        "sessions": session_store.stats(),
+        "inboxWriter": inbox_writer.stats(),
+        "answerCache": answer_cache.stats(),
+        "machinePrefetch": machine_prefetch_stats(),
+        "llmHedge": hedge_stats(),
+        "llmScheduler": llm_scheduler.stats(),
+        "modelRouter": model_router.stats(),
+        "toolResults": tool_result_compactor.stats(),
+        "chatJobs": chat_jobs.stats(),
+        "staticAssets": static_assets.stats(),
+        "warmUp": warmup.status(),
+        "logging": {"dropped": dropped_count()}
+    }), 200
+
+
+@app.route("/api/ops/ready", methods=["GET"])
+def api_ops_ready():
+    """
+    readiness: このワーカーの準備 (warmup) が終わっていれば 200、まだなら 503 + Retry-After。
+    App Service のヘルスチェックのパスに指定する。
+    """
+    status = warmup.status()
+    if status["ready"]:
+        return jsonify(status), 200
+    response = jsonify(status)
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+@app.route("/metrics", methods=["GET"])
+def api_metrics():
+    """Prometheus 形式のメトリクス (エンドポイント/段階/LLM呼び出し/tool ごとのレイテンシ、リトライ、トークン数)。"""
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
 def serve_react(path):
-    if path != "" and os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
-    else:
-        return send_from_directory(app.static_folder, "index.html")
+    """ビルド済みフロントエンドを返す。マニフェストに無いパスは SPA のルートとして index.html を返す。"""
+    return static_assets.serve(path)
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    debug_print(f"=== Starting server on 0.0.0.0:{port} ===")
+    logger.info("=== Starting server on 0.0.0.0:%s ===", port)
+    warmup.start()
     app.run(host="0.0.0.0", port=port, debug=True)
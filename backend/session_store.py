@@ -0,0 +1,508 @@
+# session_store.py
+#
+# セッション (isLoggedIn / userId / userInfo / conversation) の保存先を抽象化する。
+#   - InProcessSessionStore : プロセス内の dict (従来通り。ワーカー1つ用)
+#   - SqliteSessionStore    : SQLite (WAL)。同一ホストの複数 gunicorn ワーカーで共有できる
+#   - RedisSessionStore     : Redis プロトコル (RESP) で話す。ホストをまたいで共有できる
+# どのバックエンドでも transaction() の中では同じ sessionId への更新が直列化される。
+#
+# メモリ上限のため、一定時間アクセスのないセッションは sweep() で破棄し (idle_timeout)、
+# セッション数が max_sessions を超えたら最も古いものから追い出す (LRU)。
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_bytes(data: Dict) -> int:
+    """セッションが保持している会話本文のバイト数 (UTF-8)。"""
+    return sum(len((m.get("content") or "").encode("utf-8")) for m in data.get("conversation", []))
+
+
+class SessionStore:
+    """
+    セッション保存先の基底クラス。
+    サブクラスは _load / _save / _delete / _locked / count / sweep / stats を実装する。
+    """
+
+    def __init__(self, idle_timeout: float = 3600.0, max_sessions: int = 10000):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sweeper_pid: Optional[int] = None
+        self._sweeper_guard = threading.Lock()
+
+    def create(self, session_id: str, data: Dict):
+        """新しいセッションを保存し、上限を超えた分を古い順に追い出す。"""
+        self.put(session_id, data)
+        self._evict_over_capacity()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        """セッションを読み出す (ロックしない)。存在しなければ None。"""
+        if not session_id:
+            return None
+        return self._load(session_id)
+
+    def put(self, session_id: str, data: Dict):
+        """セッションを丸ごと保存する。"""
+        with self._locked(session_id):
+            self._save(session_id, data)
+
+    def delete(self, session_id: str):
+        if not session_id:
+            return
+        with self._locked(session_id):
+            self._delete(session_id)
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    @contextmanager
+    def transaction(self, session_id: str, create: Optional[Dict] = None) -> Iterator[Optional[Dict]]:
+        """
+        セッション単位のロックを取って読み出し、ブロックを抜けたら保存する。
+        存在しない場合は create を初期値として使う (create も None なら None を yield し、保存しない)。
+        例外で抜けた場合は保存しない。
+        """
+        with self._locked(session_id):
+            data = self._load(session_id)
+            if data is None and create is not None:
+                data = create
+            yield data
+            if data is not None:
+                self._save(session_id, data)
+
+    # ---------- サブクラスで実装 ----------
+    def _load(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def _save(self, session_id: str, data: Dict):
+        raise NotImplementedError
+
+    def _delete(self, session_id: str):
+        raise NotImplementedError
+
+    def _locked(self, session_id: str):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """idle_timeout を過ぎたセッションを破棄し、破棄した件数を返す。"""
+        raise NotImplementedError
+
+    def _evict_over_capacity(self) -> int:
+        return 0
+
+    def stats(self) -> Dict:
+        """セッション数と保持している会話のバイト数。"""
+        raise NotImplementedError
+
+    # ---------- バックグラウンド掃除 ----------
+    def start_sweeper(self, interval: float, report: Optional[Callable[[int, Dict], None]] = None):
+        """
+        interval 秒ごとに sweep() するデーモンスレッドを起動する。
+        report(破棄件数, stats()) が渡されていれば毎回呼ぶ (ログ出力用)。
+        fork 後のワーカーではスレッドが引き継がれないため pid ごとに起動する。
+        """
+        pid = os.getpid()
+        if self._sweeper_pid == pid or interval <= 0:
+            return
+        with self._sweeper_guard:
+            if self._sweeper_pid == pid:
+                return
+            self._sweeper_pid = pid
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.sweep() + self._evict_over_capacity()
+                    if report is not None:
+                        report(removed, self.stats())
+                except Exception:
+                    logger.exception("session sweep failed")
+
+        threading.Thread(target=loop, name="session-sweeper", daemon=True).start()
+
+
+# ==========================================
+# 1) プロセス内 dict
+# ==========================================
+class InProcessSessionStore(SessionStore):
+    """
+    従来の sessions dict と同じくプロセスのメモリに保持する。
+    get() は保存中の dict をそのまま返す (コピーしない) ので、更新は transaction() 内で行うこと。
+    アクセス順を OrderedDict で持ち、先頭が最も長くアクセスのないセッションになる。
+    """
+
+    def __init__(self, idle_timeout: float = 3600.0, max_sessions: int = 10000):
+        super().__init__(idle_timeout, max_sessions)
+        # sessionId -> data (アクセス順)
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        # sessionId -> (最終アクセス時刻, 会話バイト数)
+        self._meta: Dict[str, Tuple[float, int]] = {}
+        self._locks: Dict[str, threading.RLock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _touch(self, session_id, nbytes=None):
+        if nbytes is None:
+            nbytes = self._meta.get(session_id, (0.0, 0))[1]
+        self._meta[session_id] = (time.monotonic(), nbytes)
+        self._sessions.move_to_end(session_id)
+
+    def _load(self, session_id):
+        with self._locks_guard:
+            data = self._sessions.get(session_id)
+            if data is not None:
+                self._touch(session_id)
+            return data
+
+    def _save(self, session_id, data):
+        nbytes = conversation_bytes(data)
+        with self._locks_guard:
+            self._sessions[session_id] = data
+            self._touch(session_id, nbytes)
+
+    def _delete(self, session_id):
+        with self._locks_guard:
+            self._sessions.pop(session_id, None)
+            self._meta.pop(session_id, None)
+            self._locks.pop(session_id, None)
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._locks_guard:
+            for session_id in self._sessions:
+                if self._meta[session_id][0] >= cutoff:
+                    break
+                expired.append(session_id)
+        for session_id in expired:
+            self.delete(session_id)
+        return len(expired)
+
+    def _evict_over_capacity(self):
+        with self._locks_guard:
+            overflow = len(self._sessions) - self.max_sessions
+            victims = list(islice(self._sessions, overflow)) if overflow > 0 else []
+        for session_id in victims:
+            self.delete(session_id)
+        return len(victims)
+
+    def stats(self):
+        with self._locks_guard:
+            total_bytes = sum(nbytes for _, nbytes in self._meta.values())
+            count = len(self._sessions)
+        return {"backend": "memory", "sessions": count, "conversationBytes": total_bytes,
+                "maxSessions": self.max_sessions, "idleTimeoutSec": self.idle_timeout}
+
+    @contextmanager
+    def _locked(self, session_id):
+        with self._locks_guard:
+            lock = self._locks.setdefault(session_id, threading.RLock())
+        with lock:
+            yield
+
+    def count(self):
+        return len(self._sessions)
+
+
+# ==========================================
+# 2) SQLite (同一ホストの複数ワーカーで共有)
+# ==========================================
+class SqliteSessionStore(SessionStore):
+    """
+    1セッション1行 (JSON) で SQLite に保存する。
+    - WAL モードなので読み出しは書き込みをブロックしない
+    - 接続はスレッドごとに持ち、プロセス内のロックは取らない (別セッションの読み出しや更新を待たせない)
+    - transaction() は BEGIN IMMEDIATE で書き込みロックを取り、スレッド間・ワーカー間の更新を直列化する
+      (ロック待ちは busy_timeout まで SQLite が行う)
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 10.0,
+                 idle_timeout: float = 3600.0, max_sessions: int = 10000):
+        super().__init__(idle_timeout, max_sessions)
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッドごと・プロセスごとに持つ (fork 後に共有しない)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _load(self, session_id):
+        row = self._conn().execute(
+            "SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, session_id, data):
+        self._conn().execute(
+            "INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (session_id, json.dumps(data, ensure_ascii=False), time.time()))
+
+    def _delete(self, session_id):
+        self._conn().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    @contextmanager
+    def _locked(self, session_id):
+        conn = self._conn()
+        if conn.in_transaction:
+            # 同一スレッドでの入れ子 (transaction 内の put など)
+            yield
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def sweep(self):
+        # 最終更新 (チャットの追記など) から idle_timeout 経過したものを破棄
+        cur = self._conn().execute(
+            "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_timeout,))
+        return cur.rowcount
+
+    def _evict_over_capacity(self):
+        cur = self._conn().execute(
+            "DELETE FROM sessions WHERE session_id IN ("
+            " SELECT session_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,))
+        return cur.rowcount
+
+    def stats(self):
+        count, total_bytes = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM sessions").fetchone()
+        return {"backend": "sqlite", "sessions": count, "conversationBytes": total_bytes,
+                "maxSessions": self.max_sessions, "idleTimeoutSec": self.idle_timeout}
+
+
+# ==========================================
+# 3) Redis プロトコル (RESP)
+# ==========================================
+class RespError(Exception):
+    """Redis からのエラー応答。"""
+
+
+class _RespConnection:
+    """最小限の RESP2 クライアント (1接続)。外部ライブラリに依存しない。"""
+
+    def __init__(self, host: str, port: int, db: int = 0, password: Optional[str] = None,
+                 timeout: float = 5.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.command("AUTH", password)
+        if db:
+            self.command("SELECT", db)
+
+    def command(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by server")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode()
+        if prefix == b"-":
+            raise RespError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RespError(f"unexpected reply: {line!r}")
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+# KEYS[1] の値が ARGV[1] (ロックを取ったときのトークン) のときだけ削除する
+_RELEASE_LOCK_SCRIPT = (
+    "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) else return 0 end"
+)
+
+
+class RedisSessionStore(SessionStore):
+    """
+    セッションを Redis の文字列キー (JSON) として保存する。
+    ロックは SET NX PX によるセッションごとの排他キーで取り、複数ホストのワーカー間で直列化する。
+    アイドル破棄はキーの有効期限 (保存のたびに idle_timeout で延長) に任せる。
+    件数上限は Redis 側の maxmemory-policy (allkeys-lru など) で設定すること。
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "chatbot:session:",
+                 lock_ttl_ms: int = 30000, lock_wait: float = 10.0,
+                 idle_timeout: float = 3600.0, max_sessions: int = 10000):
+        super().__init__(idle_timeout, max_sessions)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.password = parsed.password
+        self.prefix = prefix
+        self.lock_ttl_ms = lock_ttl_ms
+        self.lock_wait = lock_wait
+        self._local = threading.local()
+        self._held = threading.local()
+
+    def _conn(self) -> _RespConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = _RespConnection(self.host, self.port, self.db, self.password)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _command(self, *args):
+        try:
+            return self._conn().command(*args)
+        except (ConnectionError, OSError):
+            # 切断されていたら1回だけ張り直す
+            self._local.conn = None
+            return self._conn().command(*args)
+
+    def _key(self, session_id):
+        return self.prefix + session_id
+
+    def _load(self, session_id):
+        raw = self._command("GET", self._key(session_id))
+        return json.loads(raw) if raw is not None else None
+
+    def _save(self, session_id, data):
+        self._command("SET", self._key(session_id), json.dumps(data, ensure_ascii=False),
+                      "PX", int(self.idle_timeout * 1000))
+
+    def _delete(self, session_id):
+        self._command("DEL", self._key(session_id))
+
+    @contextmanager
+    def _locked(self, session_id):
+        held = getattr(self._held, "ids", None)
+        if held is None:
+            held = self._held.ids = set()
+        if session_id in held:
+            # 同一スレッドでの入れ子
+            yield
+            return
+
+        lock_key = self._key(session_id) + ":lock"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_wait
+        delay = 0.005
+        while self._command("SET", lock_key, token, "NX", "PX", self.lock_ttl_ms) is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"could not lock session {session_id}")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+        held.add(session_id)
+        try:
+            yield
+        finally:
+            held.discard(session_id)
+            # 自分が取ったロックのときだけ解放する (比較と削除を1回で行い、期限切れ後に他者が取ったロックを消さない)
+            self._command("EVAL", _RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+
+    def _session_keys(self):
+        cursor = "0"
+        while True:
+            cursor, keys = self._command("SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000)
+            cursor = cursor.decode() if isinstance(cursor, bytes) else str(cursor)
+            for k in keys:
+                if not k.endswith(b":lock"):
+                    yield k
+            if cursor == "0":
+                return
+
+    def count(self):
+        return sum(1 for _ in self._session_keys())
+
+    def sweep(self):
+        # 期限切れは Redis がキーごと消す
+        return 0
+
+    def stats(self):
+        count = 0
+        total_bytes = 0
+        for key in self._session_keys():
+            count += 1
+            total_bytes += self._command("STRLEN", key) or 0
+        return {"backend": "redis", "sessions": count, "conversationBytes": total_bytes,
+                "maxSessions": self.max_sessions, "idleTimeoutSec": self.idle_timeout}
+
+
+# ==========================================
+# 4) 環境変数からの生成
+# ==========================================
+def create_session_store_from_env() -> SessionStore:
+    """
+    SESSION_STORE=memory (既定) | sqlite | redis
+      sqlite: SESSION_SQLITE_PATH (既定: sessions.sqlite3)
+      redis : SESSION_REDIS_URL   (既定: redis://localhost:6379/0)
+    共通:
+      SESSION_IDLE_TIMEOUT_SEC (既定: 3600) / SESSION_MAX_COUNT (既定: 10000)
+    """
+    kind = os.environ.get("SESSION_STORE", "memory").lower()
+    limits = {
+        "idle_timeout": float(os.environ.get("SESSION_IDLE_TIMEOUT_SEC", "3600")),
+        "max_sessions": int(os.environ.get("SESSION_MAX_COUNT", "10000"))
+    }
+    if kind == "sqlite":
+        return SqliteSessionStore(os.environ.get("SESSION_SQLITE_PATH", "sessions.sqlite3"), **limits)
+    if kind == "redis":
+        return RedisSessionStore(os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0"), **limits)
+    return InProcessSessionStore(**limits)
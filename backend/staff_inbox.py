@@ -0,0 +1,220 @@
+# staff_inbox.py
+#
+# notifyStaff で使うスタッフ受信箱の保存先。
+# - staff_inbox_{staffId}.jsonl に1メッセージ1行で追記するだけ (ファイル全体の読み書きをしない)
+# - 追記時はファイルロック (flock) を取るので、複数ワーカーから同時に書いてもメッセージが失われない
+# - 書き込みはバックグラウンドの writer スレッドがまとめて行う。
+#   同時に来た通知は宛先ごとに1回の追記 + fsync にまとめ、呼び出し側は fsync 完了を待って返る
+# - 旧形式 (staff_inbox_{staffId}.json, JSON配列) は migrate_json_inboxes() で一度だけ変換する
+#
+# 受信箱の読み出しは HTTP には公開しない (顧客の質問や連絡先が入るため)。社内の運用ツールから読む:
+#   python staff_inbox.py read <staffId> [offset] [limit]
+#
+# 使い方 (旧形式の変換):
+#   python staff_inbox.py migrate [ディレクトリ]
+import glob
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows など。O_APPEND の1回書き込みに任せる
+    fcntl = None
+
+INBOX_DIR = os.environ.get("INBOX_DIR", ".")
+# 1回の書き込みでまとめる最大メッセージ数
+INBOX_BATCH_SIZE = int(os.environ.get("INBOX_BATCH_SIZE", "200"))
+# notifyStaff が fsync 完了を待つ最大秒数
+INBOX_WRITE_TIMEOUT = float(os.environ.get("INBOX_WRITE_TIMEOUT", "5.0"))
+
+_STAFF_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def inbox_path(staff_id: str, directory: str = INBOX_DIR) -> str:
+    if not _STAFF_ID_PATTERN.match(staff_id or ""):
+        raise ValueError(f"invalid staffId: {staff_id!r}")
+    return os.path.join(directory, f"staff_inbox_{staff_id}.jsonl")
+
+
+def _append_lines(path: str, lines: List[str]):
+    """ロックを取って行を追記し、fsync する。"""
+    data = "".join(lines).encode("utf-8")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+            os.fsync(fd)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class _PendingWrite:
+    def __init__(self, staff_id: str, message: Dict):
+        self.staff_id = staff_id
+        self.message = message
+        self.done = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class InboxWriter:
+    """
+    受信箱への追記を1本のスレッドでまとめて行う。
+    enqueue() したメッセージは宛先ごとにまとめて追記され、fsync 後に完了通知される。
+    """
+
+    def __init__(self, directory: str = INBOX_DIR, batch_size: int = INBOX_BATCH_SIZE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[_PendingWrite]" = queue.Queue()
+        self._thread_pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        self._counters = {"messages": 0, "batches": 0, "fileWrites": 0, "errors": 0, "writeTimeouts": 0}
+
+    def _ensure_thread(self):
+        # fork 後のワーカーではスレッドが引き継がれないため pid ごとに起動する
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._start_lock:
+            if self._thread_pid == pid:
+                return
+            self._thread_pid = pid
+            threading.Thread(target=self._run, name="inbox-writer", daemon=True).start()
+
+    def enqueue(self, recipients: List[str], message: Dict) -> List[_PendingWrite]:
+        """宛先ごとの書き込みを積む。宛先の staffId が不正なら ValueError。"""
+        for staff_id in recipients:
+            inbox_path(staff_id, self.directory)  # 検証のみ
+        self._ensure_thread()
+        pending = [_PendingWrite(staff_id, message) for staff_id in recipients]
+        for p in pending:
+            self._queue.put(p)
+        return pending
+
+    def write(self, recipients: List[str], message: Dict, timeout: float = INBOX_WRITE_TIMEOUT) -> bool:
+        """
+        積んだ書き込みが fsync されるまで (最大 timeout 秒) 待つ。全宛先の書き込みが終われば True。
+        timeout までに終わらなければ False (書き込みは積まれたままで、後で行われる)。書き込みの失敗は例外を送出する。
+        """
+        pending = self.enqueue(recipients, message)
+        wait_until = time.monotonic() + timeout
+        for p in pending:
+            if not p.done.wait(max(0.0, wait_until - time.monotonic())):
+                self._counters["writeTimeouts"] += 1
+                return False
+            if p.error is not None:
+                raise p.error
+        return True
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 溜まっている分をまとめて取り出す
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: List[_PendingWrite]):
+        by_staff: Dict[str, List[_PendingWrite]] = {}
+        for p in batch:
+            by_staff.setdefault(p.staff_id, []).append(p)
+
+        for staff_id, items in by_staff.items():
+            try:
+                _append_lines(
+                    inbox_path(staff_id, self.directory),
+                    [json.dumps(p.message, ensure_ascii=False) + "\n" for p in items])
+                self._counters["fileWrites"] += 1
+            except Exception as e:
+                self._counters["errors"] += 1
+                for p in items:
+                    p.error = e
+            for p in items:
+                p.done.set()
+        self._counters["messages"] += len(batch)
+        self._counters["batches"] += 1
+
+    def stats(self) -> Dict:
+        stats = dict(self._counters)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+
+def read_inbox(staff_id: str, offset: int = 0, limit: int = 50,
+               directory: str = INBOX_DIR) -> Dict:
+    """
+    受信箱を古い順に offset 件飛ばして最大 limit 件返す。
+    戻り値: {"messages": [...], "offset": offset, "limit": limit, "total": 全件数}
+    """
+    path = inbox_path(staff_id, directory)
+    messages = []
+    total = 0
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if offset <= total < offset + limit:
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # 書き込み途中で落ちた行などは読み飛ばす
+                        continue
+                total += 1
+    return {"messages": messages, "offset": offset, "limit": limit, "total": total}
+
+
+def migrate_json_inboxes(directory: str = INBOX_DIR) -> Dict[str, int]:
+    """
+    旧形式の staff_inbox_{staffId}.json (JSON配列) を .jsonl に追記して変換する。
+    変換済みの旧ファイルは .json.migrated にリネームするので、何度実行しても二重にはならない。
+    戻り値: {staffId: 変換した件数}
+    """
+    migrated = {}
+    for json_path in sorted(glob.glob(os.path.join(directory, "staff_inbox_*.json"))):
+        staff_id = os.path.basename(json_path)[len("staff_inbox_"):-len(".json")]
+        with open(json_path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+        if items:
+            _append_lines(inbox_path(staff_id, directory),
+                          [json.dumps(item, ensure_ascii=False) + "\n" for item in items])
+        os.replace(json_path, json_path + ".migrated")
+        migrated[staff_id] = len(items)
+    return migrated
+
+
+# アプリ全体で共有するインスタンス
+inbox_writer = InboxWriter()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        target_dir = sys.argv[2] if len(sys.argv) >= 3 else INBOX_DIR
+        result = migrate_json_inboxes(target_dir)
+        for sid, count in result.items():
+            print(f"staff_inbox_{sid}.json -> staff_inbox_{sid}.jsonl ({count} messages)")
+        print(f"migrated {len(result)} inbox file(s)")
+    elif len(sys.argv) >= 3 and sys.argv[1] == "read":
+        read_offset = int(sys.argv[3]) if len(sys.argv) >= 4 else 0
+        read_limit = int(sys.argv[4]) if len(sys.argv) >= 5 else 50
+        print(json.dumps(read_inbox(sys.argv[2], read_offset, read_limit), ensure_ascii=False, indent=2))
+    else:
+        print("usage: python staff_inbox.py migrate [directory]")
+        print("       python staff_inbox.py read <staffId> [offset] [limit]")
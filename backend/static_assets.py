@@ -0,0 +1,287 @@
+# static_assets.py
+#
+# フロントエンド (frontend/dist) の配信。
+# - 起動時に dist 配下を走査してマニフェスト (パス -> サイズ/ETag/Content-Type/圧縮版) を作る
+#   リクエスト処理側では os.path.exists などのファイルシステム確認をしない
+# - 事前圧縮した .br / .gz があれば Accept-Encoding に応じて返す (圧縮は下の CLI で作る)
+# - Vite のハッシュ付きファイル (assets/index-AbCd1234.js など) は Cache-Control: immutable で1年キャッシュ
+# - index.html などハッシュ無しのファイルは no-cache + 強い ETag (If-None-Match が一致すれば 304)
+# - マニフェストに無いパスは SPA のルートとみなして index.html を返す (assets/ と api/ 配下は 404)
+# - index.html の mtime が変わったら (npm run build し直したら) マニフェストを作り直す
+#
+# 事前圧縮:
+#   cd frontend && npm run build && python ../backend/static_assets.py
+#   (.gz は常に作る。.br は brotli パッケージがあれば作る)
+#
+# 環境変数:
+#   STATIC_DIR                配信するディレクトリ (既定: ../frontend/dist)
+#   STATIC_MEMORY_MAX_BYTES   このサイズ以下のファイルはメモリに載せて返す (既定: 2MB)
+#   STATIC_MAX_AGE_SEC        ハッシュ無しファイル (index.html 以外) の max-age (既定: 3600)
+#   STATIC_RELOAD_CHECK_SEC   index.html の mtime を確認する間隔 (既定: 2.0)
+import argparse
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+from flask import Response, abort, request, send_file
+
+try:
+    import brotli
+except ImportError:  # brotli が無い環境では .br を作らない (配信は既存の .br があれば行う)
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = os.environ.get(
+    "STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "frontend", "dist"))
+STATIC_MEMORY_MAX_BYTES = int(os.environ.get("STATIC_MEMORY_MAX_BYTES", str(2 * 1024 * 1024)))
+STATIC_MAX_AGE_SEC = int(os.environ.get("STATIC_MAX_AGE_SEC", "3600"))
+STATIC_RELOAD_CHECK_SEC = float(os.environ.get("STATIC_RELOAD_CHECK_SEC", "2.0"))
+
+INDEX_FILE = "index.html"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Vite の出力名 [name]-[hash].[ext] (hash は8文字の英数字/_/-)
+_HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8,}\.[A-Za-z0-9]+$")
+# 優先順 (Accept-Encoding の q 値が同じなら先のものを選ぶ)
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# 事前圧縮の対象
+COMPRESSIBLE_EXTENSIONS = {".html", ".js", ".mjs", ".css", ".svg", ".json", ".map", ".txt", ".xml", ".ico",
+                           ".webmanifest"}
+# 配信しないパス (SPA のルートとして index.html を返さず 404 にする)
+NOT_FOUND_PREFIXES = ("assets/", "api/")
+
+
+class _Asset:
+    """マニフェストの1エントリ (1ファイルの1エンコーディング)。"""
+    __slots__ = ("path", "size", "etag", "body")
+
+    def __init__(self, path: str, size: int, etag: str, body: Optional[bytes]):
+        self.path = path
+        self.size = size
+        self.etag = etag
+        # STATIC_MEMORY_MAX_BYTES 以下ならファイル内容を保持する (None ならファイルから送る)
+        self.body = body
+
+
+class _Entry:
+    __slots__ = ("content_type", "cache_control", "variants")
+
+    def __init__(self, content_type: str, cache_control: str, variants: Dict[str, _Asset]):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        # エンコーディング ("identity" / "br" / "gzip") -> _Asset
+        self.variants = variants
+
+
+def is_hashed(rel_path: str) -> bool:
+    return rel_path.startswith("assets/") and bool(_HASHED_NAME.search(rel_path))
+
+
+def _content_type(rel_path: str) -> str:
+    if rel_path.endswith((".js", ".mjs")):
+        return "text/javascript"
+    return mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+
+
+def _load_asset(full_path: str, suffix: str, memory_max_bytes: int) -> _Asset:
+    with open(full_path, "rb") as f:
+        data = f.read()
+    etag = hashlib.sha256(data).hexdigest()[:32] + suffix
+    return _Asset(full_path, len(data), etag, data if len(data) <= memory_max_bytes else None)
+
+
+class StaticAssets:
+    """
+    dist ディレクトリのマニフェストと配信。
+      static_assets.serve(path)  # Flask のビューから呼ぶ
+    """
+
+    def __init__(self, root: str = STATIC_DIR, memory_max_bytes: int = STATIC_MEMORY_MAX_BYTES,
+                 max_age: int = STATIC_MAX_AGE_SEC, reload_check_sec: float = STATIC_RELOAD_CHECK_SEC):
+        self.root = os.path.abspath(root)
+        self.memory_max_bytes = memory_max_bytes
+        self.max_age = max_age
+        self.reload_check_sec = reload_check_sec
+        self._manifest: Dict[str, _Entry] = {}
+        self._index_mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"served": 0, "notModified": 0, "spaFallback": 0, "notFound": 0, "reloads": 0,
+                          "br": 0, "gzip": 0, "identity": 0}
+        self.reload()
+
+    # ---------- マニフェスト ----------
+    def _index_file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(os.path.join(self.root, INDEX_FILE)).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        """dist 配下を走査してマニフェストを作り直す (参照の差し替えのみで、配信中のリクエストには影響しない)。"""
+        started = time.perf_counter()
+        index_mtime = self._index_file_mtime()
+        files = {}
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                full_path = os.path.join(dirpath, name)
+                files[os.path.relpath(full_path, self.root).replace(os.sep, "/")] = full_path
+
+        manifest: Dict[str, _Entry] = {}
+        for rel_path, full_path in files.items():
+            if rel_path.endswith(tuple(suffix for _, suffix in ENCODINGS)) and rel_path.rsplit(".", 1)[0] in files:
+                continue  # 圧縮版は元ファイルのエントリにまとめる
+            try:
+                identity = _load_asset(full_path, "", self.memory_max_bytes)
+                variants = {"identity": identity}
+                for encoding, suffix in ENCODINGS:
+                    compressed_path = files.get(rel_path + suffix)
+                    if compressed_path is None:
+                        continue
+                    compressed = _load_asset(compressed_path, "-" + encoding, self.memory_max_bytes)
+                    # 元より大きい/古い圧縮版は使わない
+                    if (compressed.size < identity.size
+                            and os.stat(compressed_path).st_mtime >= os.stat(full_path).st_mtime):
+                        variants[encoding] = compressed
+            except OSError:
+                logger.warning("静的ファイルを読めないため配信対象から外します: %s", rel_path,
+                               extra={"fields": {"event": "static_read_error", "path": rel_path}}, exc_info=True)
+                continue
+            if is_hashed(rel_path):
+                cache_control = IMMUTABLE_CACHE_CONTROL
+            elif rel_path == INDEX_FILE:
+                cache_control = "no-cache"
+            else:
+                cache_control = f"public, max-age={self.max_age}"
+            manifest[rel_path] = _Entry(_content_type(rel_path), cache_control, variants)
+
+        with self._lock:
+            self._manifest = manifest
+            self._index_mtime = index_mtime
+            self._counters["reloads"] += 1
+        logger.info("静的ファイルの一覧を作成しました (%d 件)", len(manifest), extra={"fields": {
+            "event": "static_manifest", "root": self.root, "files": len(manifest),
+            "compressed": sum(len(e.variants) - 1 for e in manifest.values()),
+            "ms": round((time.perf_counter() - started) * 1000, 1)}})
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_check_sec
+        if self._index_file_mtime() != self._index_mtime:
+            self.reload()
+
+    # ---------- 配信 ----------
+    def _choose_variant(self, entry: _Entry) -> str:
+        if len(entry.variants) == 1:
+            return "identity"
+        accepted = request.accept_encodings
+        best, best_quality = "identity", 0.0
+        for encoding, _suffix in ENCODINGS:
+            quality = accepted.quality(encoding) if encoding in entry.variants else 0
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def serve(self, path: str) -> Response:
+        """path (先頭の / を除いたもの) に対応するファイル、または SPA 用の index.html を返す。"""
+        self._reload_if_changed()
+        manifest = self._manifest
+        entry = manifest.get(path) if path else None
+        if entry is None:
+            if path.startswith(NOT_FOUND_PREFIXES) or INDEX_FILE not in manifest:
+                self._counters["notFound"] += 1
+                abort(404)
+            self._counters["spaFallback"] += 1
+            entry = manifest[INDEX_FILE]
+
+        encoding = self._choose_variant(entry)
+        asset = entry.variants[encoding]
+        headers = {"Cache-Control": entry.cache_control, "ETag": f'"{asset.etag}"'}
+        if len(entry.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if request.if_none_match.contains_weak(asset.etag):
+            self._counters["notModified"] += 1
+            return Response(status=304, headers=headers)
+
+        if asset.body is not None:
+            response = Response(asset.body, mimetype=entry.content_type, headers=headers)
+        else:
+            response = send_file(asset.path, mimetype=entry.content_type, conditional=False, etag=False)
+            response.headers.update(headers)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        self._counters["served"] += 1
+        self._counters[encoding] += 1
+        return response
+
+    def stats(self) -> Dict:
+        manifest = self._manifest
+        stats = dict(self._counters)
+        stats.update({
+            "root": self.root,
+            "files": len(manifest),
+            "hashed": sum(1 for p in manifest if is_hashed(p)),
+            "compressedVariants": sum(len(e.variants) - 1 for e in manifest.values()),
+            "memoryBytes": sum(a.size for e in manifest.values() for a in e.variants.values() if a.body is not None),
+        })
+        return stats
+
+
+# ==========================================
+# 事前圧縮 (ビルド後に実行する CLI)
+# ==========================================
+def compress_directory(root: str, min_size: int = 512) -> Dict[str, int]:
+    """root 配下の圧縮対象ファイルに .gz (と brotli があれば .br) を作る。元より新しい圧縮版があれば作り直さない。"""
+    counts = {"gzip": 0, "br": 0, "skipped": 0}
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            if os.path.getsize(full_path) < min_size:
+                counts["skipped"] += 1
+                continue
+            with open(full_path, "rb") as f:
+                data = f.read()
+            compressors = [("gzip", ".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                compressors.append(("br", ".br", lambda d: brotli.compress(d, quality=11)))
+            for encoding, suffix, compress in compressors:
+                target = full_path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(full_path):
+                    continue
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    continue
+                with open(target + ".tmp", "wb") as f:
+                    f.write(compressed)
+                os.replace(target + ".tmp", target)
+                counts[encoding] += 1
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Precompress built frontend assets (.gz, and .br if brotli is installed)")
+    parser.add_argument("root", nargs="?", default=STATIC_DIR, help="directory to compress (default: STATIC_DIR)")
+    parser.add_argument("--min-size", type=int, default=512, help="skip files smaller than this many bytes")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.root):
+        print(f"{args.root} does not exist (run `npm run build` first)", file=sys.stderr)
+        return 1
+    counts = compress_directory(args.root, args.min_size)
+    print(f"gzip: {counts['gzip']}, br: {counts['br']}{'' if brotli else ' (brotli not installed)'}, "
+          f"skipped (small): {counts['skipped']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# history_manager.HistoryManager の単体テスト (予算内の履歴の選択と要約の更新。モデルは呼ばない)
+#   python -m unittest test_history_manager
+import unittest
+from contextlib import contextmanager
+
+from history_manager import SUMMARY_PREFIX, HistoryManager, count_message_tokens
+
+
+class _Store:
+    """session_store の代わり (1セッションだけ持つ)。"""
+
+    def __init__(self, sess):
+        self.sess = sess
+
+    def get(self, session_id):
+        return self.sess
+
+    @contextmanager
+    def transaction(self, session_id):
+        yield self.sess
+
+
+def _conversation(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"メッセージ{i} エンジンオイルの交換について"}
+            for i in range(n)]
+
+
+def _run_summary(manager, sess, summarize):
+    manager.schedule_summary(_Store(sess), "s", summarize)
+    manager._executor.shutdown(wait=True)
+
+
+class SelectHistoryTest(unittest.TestCase):
+    def test_everything_fits_in_budget(self):
+        manager = HistoryManager(budget_tokens=10000)
+        sess = {"conversation": _conversation(6)}
+        self.assertEqual(manager.select_history(sess), sess["conversation"])
+        self.assertEqual(manager.dropped_count(sess), 0)
+
+    def test_newest_messages_are_kept_when_over_budget(self):
+        conversation = _conversation(10)
+        per_message = count_message_tokens(conversation[-1])
+        manager = HistoryManager(budget_tokens=per_message * 3)
+        history = manager.select_history({"conversation": conversation})
+        self.assertEqual(history, conversation[-3:])
+
+    def test_summary_replaces_covered_messages(self):
+        conversation = _conversation(6)
+        manager = HistoryManager(budget_tokens=10000)
+        sess = {"conversation": conversation, "summary": {"content": "前半の要約", "covered": 4}}
+        history = manager.select_history(sess)
+        self.assertEqual(history[0], {"role": "system", "content": SUMMARY_PREFIX + "前半の要約"})
+        self.assertEqual(history[1:], conversation[4:])
+
+
+class SummaryTest(unittest.TestCase):
+    def test_messages_are_summarized_before_they_leave_the_prompt(self):
+        conversation = _conversation(8)
+        per_message = count_message_tokens(conversation[-1])
+        # 予算は全件ぶん。要約しないで残すウィンドウは4件ぶん
+        manager = HistoryManager(budget_tokens=per_message * 8, summary_min_tokens=per_message * 4)
+        sess = {"conversation": conversation}
+        self.assertEqual(manager.dropped_count(sess), 0)
+        summarized = []
+        _run_summary(manager, sess, lambda previous, messages: summarized.extend(messages) or "要約")
+        self.assertEqual(summarized, conversation[:4])
+        self.assertEqual(sess["summary"], {"content": "要約", "covered": 4})
+        self.assertEqual(manager.select_history(sess)[1:], conversation[4:])
+
+    def test_dropped_messages_are_summarized_below_min_tokens(self):
+        conversation = _conversation(4)
+        per_message = count_message_tokens(conversation[-1])
+        manager = HistoryManager(budget_tokens=per_message * 3, summary_min_tokens=100000)
+        sess = {"conversation": conversation}
+        self.assertEqual(manager.dropped_count(sess), 1)
+        _run_summary(manager, sess, lambda previous, messages: "要約")
+        self.assertGreaterEqual(sess["summary"]["covered"], 1)
+        self.assertEqual(manager.dropped_count(sess), 0)
+
+    def test_nothing_is_summarized_while_under_threshold(self):
+        manager = HistoryManager(budget_tokens=10000, summary_min_tokens=400)
+        sess = {"conversation": _conversation(4)}
+        calls = []
+        _run_summary(manager, sess, lambda previous, messages: calls.append(messages) or "要約")
+        self.assertEqual(calls, [])
+        self.assertNotIn("summary", sess)
+
+    def test_failed_summary_keeps_state(self):
+        conversation = _conversation(4)
+        per_message = count_message_tokens(conversation[-1])
+        manager = HistoryManager(budget_tokens=per_message * 3, summary_min_tokens=100000)
+        sess = {"conversation": conversation}
+        _run_summary(manager, sess, lambda previous, messages: None)
+        self.assertNotIn("summary", sess)
+        # 外れたメッセージが残っているので、次のターンでも要約が試みられる
+        self.assertEqual(manager.dropped_count(sess), 1)
+
+
+class EnforceBudgetTest(unittest.TestCase):
+    def test_old_history_is_dropped_but_current_turn_is_kept(self):
+        conversation = [{"role": "system", "content": "prompt"}] + _conversation(6) + [
+            {"role": "user", "content": "今回の質問"},
+            {"role": "tool", "tool_call_id": "1", "content": "x" * 400},
+        ]
+        current_turn = conversation[-2:]
+        manager = HistoryManager(budget_tokens=count_message_tokens(current_turn[0])
+                                 + count_message_tokens(current_turn[1]) + 1)
+        dropped = manager.enforce_budget(conversation)
+        self.assertEqual(dropped, 6)
+        self.assertEqual(conversation, [{"role": "system", "content": "prompt"}] + current_turn)
+
+
+if __name__ == "__main__":
+    unittest.main()
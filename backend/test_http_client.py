@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# http_client.CircuitBreaker / PooledHttpClient の単体テスト (外部への通信はしない)
+#   python -m unittest test_http_client
+import time
+import unittest
+
+import requests
+
+from deadline import Deadline
+from http_client import CircuitBreaker, PooledHttpClient
+
+
+class _TimeoutSession:
+    """post すると必ず timeout する requests.Session の代わり。"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        self.calls += 1
+        raise requests.Timeout("read timed out")
+
+
+def _half_open_client(session, reset_timeout=0.05):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    time.sleep(reset_timeout * 1.2)
+    client = PooledHttpClient("test", max_retries=0, breaker=breaker)
+    client._session = session
+    return client, breaker
+
+
+class HalfOpenDeadlineTest(unittest.TestCase):
+    def test_expired_deadline_releases_trial(self):
+        # 締め切りを過ぎていて1回も試行しなかった (last_error が None) half_open の試行
+        session = _TimeoutSession()
+        client, breaker = _half_open_client(session)
+        with self.assertRaises(requests.Timeout):
+            client.post_json("http://example.invalid", {}, deadline=Deadline(0))
+        self.assertEqual(session.calls, 0)
+        stats = breaker.stats()
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["timesOpened"], 1)
+        # reset_timeout の間は閉じたまま、過ぎればもう一度試行を通す
+        self.assertIsNotNone(breaker.before_call())
+        time.sleep(0.06)
+        self.assertIsNone(breaker.before_call())
+
+    def test_trial_cut_by_deadline_is_not_a_failure(self):
+        # 締め切りより read_timeout が長く、試行が timeout した half_open の試行
+        session = _TimeoutSession()
+        client, breaker = _half_open_client(session)
+        with self.assertRaises(requests.Timeout):
+            client.post_json("http://example.invalid", {}, read_timeout=30, deadline=Deadline(5))
+        self.assertEqual(session.calls, 1)
+        self.assertEqual(client.stats()["counters"]["deadlineExceeded"], 1)
+        self.assertEqual(breaker.stats()["state"], "open")
+        self.assertEqual(breaker.stats()["consecutiveFailures"], 1)
+        time.sleep(0.06)
+        self.assertIsNone(breaker.before_call())
+
+    def test_record_cancelled_when_closed_keeps_state(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.record_cancelled()
+        self.assertEqual(breaker.stats()["state"], "closed")
+        self.assertIsNone(breaker.before_call())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# manual_cache.TTLCache の単体テスト (TTL / LRU / single-flight)
+#   python -m unittest test_manual_cache
+import threading
+import time
+import unittest
+
+import deadline
+from manual_cache import TTLCache, manual_cache_key, normalize_text
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_expired_entry_is_recomputed(self):
+        cache = TTLCache(ttl_seconds=0.05)
+        self.assertEqual(cache.get_or_compute("k", lambda: 1), 1)
+        self.assertEqual(cache.get_or_compute("k", lambda: 2), 1)
+        time.sleep(0.06)
+        self.assertEqual(cache.get_or_compute("k", lambda: 3), 3)
+        self.assertEqual(cache.stats()["expired"], 1)
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = TTLCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")  # a を最近使ったことにする
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_should_cache_false_is_not_stored(self):
+        cache = TTLCache()
+        cache.get_or_compute("k", lambda: {"error": "x"}, should_cache=lambda r: "error" not in r)
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_concurrent_calls_share_one_compute(self):
+        cache = TTLCache()
+        calls = []
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            release.wait(1.0)
+            return "v"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("k", compute)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ["v"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["coalesced"], 4)
+
+    def test_leader_error_is_raised_to_followers(self):
+        cache = TTLCache()
+        started = threading.Event()
+
+        def failing():
+            started.set()
+            time.sleep(0.05)
+            raise ValueError("upstream")
+
+        leader = threading.Thread(target=lambda: self.assertRaises(ValueError, cache.get_or_compute, "k", failing))
+        leader.start()
+        started.wait(1.0)
+        with self.assertRaises(ValueError):
+            cache.get_or_compute("k", lambda: "unused")
+        leader.join()
+        self.assertEqual(cache.stats()["inFlight"], 0)
+
+    def test_follower_wait_is_bounded(self):
+        cache = TTLCache(flight_wait_seconds=0.05)
+        release = threading.Event()
+        leader = threading.Thread(target=lambda: cache.get_or_compute("k", lambda: release.wait(1.0) and "leader"))
+        leader.start()
+        time.sleep(0.02)
+        started = time.monotonic()
+        self.assertEqual(cache.get_or_compute("k", lambda: "local"), "local")
+        self.assertLess(time.monotonic() - started, 0.5)
+        release.set()
+        leader.join()
+        self.assertEqual(cache.stats()["flightWaitTimeouts"], 1)
+
+    def test_follower_wait_uses_turn_deadline(self):
+        cache = TTLCache(flight_wait_seconds=10)
+        release = threading.Event()
+        leader = threading.Thread(target=lambda: cache.get_or_compute("k", lambda: release.wait(1.0) and "leader"))
+        leader.start()
+        time.sleep(0.02)
+        results = []
+
+        def follower():
+            deadline.start(0.05)
+            results.append(cache.get_or_compute("k", lambda: "local"))
+
+        t = threading.Thread(target=follower)
+        t.start()
+        t.join(0.5)
+        self.assertEqual(results, ["local"])
+        release.set()
+        leader.join()
+
+
+class CacheKeyTest(unittest.TestCase):
+    def test_key_ignores_width_case_and_spaces(self):
+        self.assertEqual(normalize_text("  ＰＣ２００   Engine "), "pc200 engine")
+        self.assertEqual(manual_cache_key("PC200", "Shop Manual", "オイル  交換"),
+                         manual_cache_key("ｐｃ200", "shop manual", "オイル 交換"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# manual_index の単体テスト (トークン化と、索引の作成 -> mmap 検索の往復)
+#   python -m unittest test_manual_index
+import os
+import shutil
+import tempfile
+import unittest
+
+from manual_index import ManualIndex, build_index, tokenize
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_model_numbers_are_split(self):
+        terms = tokenize("PC200-8 の Pumps")
+        self.assertIn("pc200-8", terms)
+        self.assertIn("pc200", terms)
+        self.assertIn("pump", terms)
+
+    def test_japanese_runs_become_bigrams(self):
+        self.assertEqual(tokenize("油圧"), ["油圧"])
+        self.assertEqual(tokenize("エンジンオイル"), ["エン", "ンジ", "ジン", "ンオ", "オイ", "イル"])
+
+    def test_stopwords_and_width_are_normalized(self):
+        self.assertEqual(tokenize("What is the ＦＩＬＴＥＲ"), ["filter"])
+
+
+class BuildAndSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.dir, "manuals")
+        self._write("Shop Manual/PC200/engine.md",
+                    "# エンジンオイルの交換\nドレンプラグを外してエンジンオイルを抜く。\n"
+                    "# 燃料フィルタ\n燃料フィルタは500時間ごとに交換する。\n")
+        self._write("Operation and maintenance manual/PC300/hydraulic.md",
+                    "# 作動油の点検\n作動油タンクのレベルゲージを確認する。\n")
+        self.index_path = os.path.join(self.dir, "manual_index.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, rel_path, text):
+        path = os.path.join(self.corpus, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_round_trip(self):
+        result = build_index(self.corpus, self.index_path)
+        self.assertEqual(result["files"], 2)
+        self.assertTrue(result["written"])
+
+        found = ManualIndex(self.index_path).search("燃料フィルタの交換時期", budget_sec=1.0)
+        self.assertEqual(found.sections[0]["title"], "燃料フィルタ")
+        self.assertEqual(found.sections[0]["source"], "Shop Manual/PC200/engine.md")
+        self.assertEqual(found.sections[0]["model"], "PC200")
+        self.assertGreater(found.confidence, 0.5)
+        self.assertFalse(found.budget_exceeded)
+
+    def test_filters_by_document_type_and_model(self):
+        build_index(self.corpus, self.index_path)
+        index = ManualIndex(self.index_path)
+        found = index.search("交換 点検", document_type="Operation and maintenance manual", budget_sec=1.0)
+        self.assertEqual([s["title"] for s in found.sections], ["作動油の点検"])
+        found = index.search("エンジンオイル", model="PC300", budget_sec=1.0)
+        self.assertEqual(found.sections, [])
+
+    def test_unchanged_corpus_is_not_rewritten(self):
+        build_index(self.corpus, self.index_path)
+        again = build_index(self.corpus, self.index_path)
+        self.assertEqual((again["parsed"], again["reused"], again["written"]), (0, 2, False))
+
+    def test_zero_budget_is_reported(self):
+        build_index(self.corpus, self.index_path)
+        found = ManualIndex(self.index_path).search("エンジンオイル 交換", budget_sec=0.0)
+        self.assertTrue(found.budget_exceeded)
+        self.assertFalse(found.is_confident(0.0))
+
+    def test_missing_index_returns_none(self):
+        self.assertIsNone(ManualIndex(os.path.join(self.dir, "missing.bin")).search("オイル"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# session_store の単体テスト (memory と sqlite。redis はサーバが要るので対象外)
+#   python -m unittest test_session_store
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from session_store import InProcessSessionStore, SqliteSessionStore
+
+
+class _StoreContract:
+    """どのバックエンドでも成り立つこと。サブクラスで make_store を実装する。"""
+
+    def make_store(self, idle_timeout=3600.0, max_sessions=10000):
+        raise NotImplementedError
+
+    def test_create_get_delete(self):
+        store = self.make_store()
+        store.create("s1", {"isLoggedIn": True, "conversation": []})
+        self.assertEqual(store.get("s1"), {"isLoggedIn": True, "conversation": []})
+        self.assertIn("s1", store)
+        store.delete("s1")
+        self.assertIsNone(store.get("s1"))
+        self.assertIsNone(store.get(""))
+
+    def test_transaction_saves_on_exit(self):
+        store = self.make_store()
+        store.create("s1", {"conversation": []})
+        with store.transaction("s1") as sess:
+            sess["conversation"].append({"role": "user", "content": "こんにちは"})
+        self.assertEqual(store.get("s1")["conversation"], [{"role": "user", "content": "こんにちは"}])
+
+    def test_transaction_on_missing_session(self):
+        store = self.make_store()
+        with store.transaction("missing") as sess:
+            self.assertIsNone(sess)
+        with store.transaction("new", create={"n": 1}) as sess:
+            sess["n"] += 1
+        self.assertEqual(store.get("new"), {"n": 2})
+
+    def test_transaction_is_not_saved_on_error(self):
+        store = self.make_store()
+        store.create("s1", {"n": 0})
+        with self.assertRaises(RuntimeError):
+            with store.transaction("s1") as sess:
+                sess["n"] = 1
+                raise RuntimeError("boom")
+        if not isinstance(store, InProcessSessionStore):  # memory は同じ dict を返すので対象外
+            self.assertEqual(store.get("s1"), {"n": 0})
+
+    def test_concurrent_transactions_do_not_lose_updates(self):
+        store = self.make_store()
+        for i in range(2):
+            store.create(f"s{i}", {"n": 0})
+
+        def worker(session_id):
+            for _ in range(50):
+                with store.transaction(session_id) as sess:
+                    sess["n"] += 1
+
+        threads = [threading.Thread(target=worker, args=(f"s{i % 2}",)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([store.get(f"s{i}")["n"] for i in range(2)], [200, 200])
+
+    def test_oldest_sessions_are_evicted_over_capacity(self):
+        store = self.make_store(max_sessions=2)
+        for i in range(3):
+            store.create(f"s{i}", {"i": i})
+            time.sleep(0.01)
+        self.assertIsNone(store.get("s0"))
+        self.assertEqual(store.count(), 2)
+
+    def test_idle_sessions_are_swept(self):
+        store = self.make_store(idle_timeout=0.05)
+        store.create("old", {"conversation": []})
+        time.sleep(0.1)
+        store.create("new", {"conversation": []})
+        self.assertEqual(store.sweep(), 1)
+        self.assertIsNone(store.get("old"))
+        self.assertIsNotNone(store.get("new"))
+
+    def test_stats(self):
+        store = self.make_store()
+        store.create("s1", {"conversation": [{"role": "user", "content": "abc"}]})
+        stats = store.stats()
+        self.assertEqual(stats["sessions"], 1)
+        self.assertGreater(stats["conversationBytes"], 0)
+
+
+class InProcessSessionStoreTest(_StoreContract, unittest.TestCase):
+    def make_store(self, idle_timeout=3600.0, max_sessions=10000):
+        return InProcessSessionStore(idle_timeout=idle_timeout, max_sessions=max_sessions)
+
+    def test_reading_refreshes_lru_order(self):
+        store = self.make_store(max_sessions=2)
+        store.create("a", {})
+        store.create("b", {})
+        store.get("a")
+        store.create("c", {})
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("a"))
+
+
+class SqliteSessionStoreTest(_StoreContract, unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_store(self, idle_timeout=3600.0, max_sessions=10000):
+        return SqliteSessionStore(os.path.join(self.dir, "sessions.sqlite3"),
+                                  idle_timeout=idle_timeout, max_sessions=max_sessions)
+
+    def test_sessions_are_shared_between_store_instances(self):
+        # 別ワーカー (= 別の接続) からも同じセッションが見える
+        self.make_store().create("s1", {"isLoggedIn": True})
+        self.assertEqual(self.make_store().get("s1"), {"isLoggedIn": True})
+
+
+if __name__ == "__main__":
+    unittest.main()
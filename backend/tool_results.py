@@ -0,0 +1,232 @@
+# tool_results.py
+#
+# tool の戻り値を、プロンプト (tool role のメッセージ) に入れる前に小さくする。
+# - tool ごとに宣言したスキーマ (TOOL_RESULT_SCHEMAS) で、モデルが回答に使う項目だけを残す
+#   (searchManual の上流応答 raw、getMachineInfo の緯度経度など。いつも落とす項目なので印は付けない)
+# - リストの件数と長い文字列は上限で切り、切ったことが分かる印を付ける
+#   文字列: 末尾に "…(+N chars)"、結果全体: "compacted": {"detailRef", "truncated"}
+# - getMachineInfo の複数ヒットで全件同じ値の項目 (販売店・担当者など) は "<キー>Common" に1回だけ書く
+# - 切ったときだけ元の結果を side cache (TTL + LRU) に残し、モデルが getToolResultDetail(detailRef, path) で
+#   必要な部分だけ取り出せるようにする
+# tool 結果を小さくすると、体感の待ち時間を決める tool 後の completion のプロンプトが短くなり、
+# ターン内の履歴予算 (history_manager) も圧迫しにくくなる。
+# side cache はプロセス内にだけ持つ (別のワーカーや TTL 切れでは取り出せず、その旨をモデルに返す)。
+import json
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional
+
+import metrics
+from manual_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+TOOL_RESULT_COMPACTION_ENABLED = os.environ.get("TOOL_RESULT_COMPACTION_ENABLED", "1") != "0"
+# getMachineInfo で返す車両の件数
+TOOL_RESULT_MAX_MACHINES = int(os.environ.get("TOOL_RESULT_MAX_MACHINES", "5"))
+# searchManual の openAiAnswer / 抜粋1件あたりの文字数
+TOOL_RESULT_MAX_ANSWER_CHARS = int(os.environ.get("TOOL_RESULT_MAX_ANSWER_CHARS", "1500"))
+TOOL_RESULT_MAX_SECTION_CHARS = int(os.environ.get("TOOL_RESULT_MAX_SECTION_CHARS", "800"))
+# スキーマを宣言していない tool / 項目に使う上限
+TOOL_RESULT_MAX_ITEMS = int(os.environ.get("TOOL_RESULT_MAX_ITEMS", "10"))
+TOOL_RESULT_MAX_TEXT_CHARS = int(os.environ.get("TOOL_RESULT_MAX_TEXT_CHARS", "1000"))
+# 元の結果を残しておく件数と秒数
+TOOL_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("TOOL_RESULT_CACHE_MAX_ENTRIES", "2000"))
+TOOL_RESULT_CACHE_TTL_SEC = float(os.environ.get("TOOL_RESULT_CACHE_TTL_SEC", "1800"))
+# getToolResultDetail で1回に返す文字数
+TOOL_RESULT_DETAIL_MAX_CHARS = int(os.environ.get("TOOL_RESULT_DETAIL_MAX_CHARS", "4000"))
+
+DETAIL_TOOL_NAME = "getToolResultDetail"
+
+
+class Text:
+    """文字列を max_chars 文字までにする。"""
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+
+
+class ListOf:
+    """
+    リストを max_items 件までにし、各要素を item のスキーマで射影する。
+    hoist_common なら、全要素で同じ値の項目を親の "<キー>Common" にまとめる。
+    """
+
+    def __init__(self, item, max_items: int, hoist_common: bool = False):
+        self.item = item
+        self.max_items = max_items
+        self.hoist_common = hoist_common
+
+
+# そのまま残す (数値・真偽値・短い文字列)
+KEEP = "keep"
+
+# tool ごとのスキーマ。dict は「書いたキーだけを残す」、None は上限だけ掛けて全項目を残す。
+# どの tool の結果も {"success": ..., "data": ... / "error": ...} で包まれている (chat_bot.handle_function_call)。
+_RESULT_ENVELOPE = {"success": KEEP, "error": Text(300), "errorCode": KEEP, "message": Text(300)}
+
+TOOL_RESULT_SCHEMAS: Dict[str, Dict] = {
+    "getMachineInfo": {
+        **_RESULT_ENVELOPE,
+        "data": {
+            "found": KEEP,
+            "message": Text(200),
+            "data": ListOf({
+                "machineId": KEEP,
+                "customerId": KEEP,
+                "customerName": KEEP,
+                "address": KEEP,
+                "dealerCode": KEEP,
+                "dealerName": KEEP,
+                "contactPersonId": KEEP,
+                "contactPersonName": KEEP,
+            }, TOOL_RESULT_MAX_MACHINES, hoist_common=True),
+        },
+    },
+    "searchManual": {
+        **_RESULT_ENVELOPE,
+        "data": {
+            "openAiAnswer": Text(TOOL_RESULT_MAX_ANSWER_CHARS),
+            "source": KEEP,
+            "confidence": KEEP,
+            "sections": ListOf({
+                "title": KEEP,
+                "document": KEEP,
+                "text": Text(TOOL_RESULT_MAX_SECTION_CHARS),
+            }, 3),
+            "error": Text(300),
+            "errorCode": KEEP,
+            "retryAfterSec": KEEP,
+            "message": Text(300),
+            "remoteError": KEEP,
+            "note": Text(300),
+        },
+    },
+    "notifyStaff": {**_RESULT_ENVELOPE, "errorMessage": Text(300)},
+}
+
+
+class _Report:
+    """射影中に切った箇所 (path は "data.sections[].text" の形)。"""
+
+    def __init__(self):
+        self.truncated: Dict[str, None] = {}
+
+
+def _join(path: str, key: str) -> str:
+    return f"{path}.{key}" if path else key
+
+
+def _cut_text(value: str, max_chars: int, path: str, report: _Report) -> str:
+    if len(value) <= max_chars:
+        return value
+    report.truncated[f"{path}: {max_chars}/{len(value)} chars"] = None
+    return value[:max_chars] + f"…(+{len(value) - max_chars} chars)"
+
+
+def _project(value, spec, path: str, report: _Report):
+    if spec == KEEP:
+        return value
+    if isinstance(spec, Text) and isinstance(value, str):
+        return _cut_text(value, spec.max_chars, path, report)
+    if isinstance(spec, ListOf) and isinstance(value, list):
+        return _project_list(value, spec.item, spec.max_items, path, report)
+    if isinstance(spec, dict) and isinstance(value, dict):
+        return _project_dict(value, spec, path, report)
+    # スキーマが無い (または想定と違う形の) 値は、上限だけ掛けて残す
+    if isinstance(value, str):
+        return _cut_text(value, TOOL_RESULT_MAX_TEXT_CHARS, path, report)
+    if isinstance(value, list):
+        return _project_list(value, None, TOOL_RESULT_MAX_ITEMS, path, report)
+    if isinstance(value, dict):
+        return {k: _project(v, None, _join(path, k), report) for k, v in value.items()}
+    return value
+
+
+def _project_list(value: List, item_spec, max_items: int, path: str, report: _Report) -> List:
+    if len(value) > max_items:
+        report.truncated[f"{path}: {max_items}/{len(value)} items"] = None
+    return [_project(item, item_spec, f"{path}[]", report) for item in value[:max_items]]
+
+
+def _project_dict(value: Dict, spec: Dict, path: str, report: _Report) -> Dict:
+    projected = {}
+    for key, item in value.items():
+        if key not in spec:
+            continue
+        field_spec = spec[key]
+        projected[key] = _project(item, field_spec, _join(path, key), report)
+        if isinstance(field_spec, ListOf) and field_spec.hoist_common:
+            common = _hoist_common(projected[key])
+            if common:
+                projected[f"{key}Common"] = common
+    return projected
+
+
+def _hoist_common(items: List) -> Dict:
+    """全要素 (2件以上の dict) で同じ値の項目を取り出し、各要素からは消す。"""
+    if len(items) < 2 or not all(isinstance(item, dict) for item in items):
+        return {}
+    first = items[0]
+    common = {k: v for k, v in first.items() if all(k in item and item[k] == v for item in items[1:])}
+    for item in items:
+        for key in common:
+            del item[key]
+    return common
+
+
+class ToolResultCompactor:
+    def __init__(self, enabled: bool = TOOL_RESULT_COMPACTION_ENABLED,
+                 schemas: Optional[Dict[str, Dict]] = None):
+        self.enabled = enabled
+        self.schemas = TOOL_RESULT_SCHEMAS if schemas is None else schemas
+        self._raw = TTLCache(max_entries=TOOL_RESULT_CACHE_MAX_ENTRIES, ttl_seconds=TOOL_RESULT_CACHE_TTL_SEC)
+
+    def compact(self, tool_name: str, result: Dict) -> Dict:
+        """
+        tool の結果をスキーマで射影する。リストや文字列を切ったときは元の結果を side cache に残し、
+        "compacted" (detailRef と切った箇所) を付けて返す。tool_name は既知の tool 名 (メトリクスのラベル)。
+        """
+        if not self.enabled or tool_name == DETAIL_TOOL_NAME or not isinstance(result, dict):
+            return result
+        report = _Report()
+        projected = _project(result, self.schemas.get(tool_name), "", report)
+        if report.truncated:
+            detail_ref = uuid.uuid4().hex[:16]
+            self._raw.put(detail_ref, result)
+            projected["compacted"] = {"detailRef": detail_ref, "truncated": list(report.truncated)}
+        raw_chars = len(json.dumps(result, ensure_ascii=False))
+        compact_chars = len(json.dumps(projected, ensure_ascii=False))
+        metrics.tool_result_chars_total.inc(raw_chars, tool=tool_name, form="raw")
+        metrics.tool_result_chars_total.inc(compact_chars, tool=tool_name, form="compact")
+        logger.debug("compacted %s result: %d -> %d chars", tool_name, raw_chars, compact_chars)
+        return projected
+
+    def detail(self, detail_ref: str, path: str = "", offset: int = 0) -> Dict:
+        """getToolResultDetail: 元の結果の path の部分を JSON 文字列で返す (長ければ offset で続きを取る)。"""
+        raw = self._raw.get(detail_ref)
+        if raw is None:
+            return {"success": False, "errorCode": "DETAIL_NOT_FOUND",
+                    "error": "元の結果は保持期間を過ぎたか、見つかりません。必要なら元の関数をもう一度呼び出してください。"}
+        value = raw
+        for key in [k for k in (path or "").split(".") if k]:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+                value = value[int(key)]
+            else:
+                return {"success": False, "errorCode": "PATH_NOT_FOUND", "error": f"'{path}' はありません。"}
+        text = json.dumps(value, ensure_ascii=False)
+        offset = max(0, int(offset or 0))
+        chunk = text[offset:offset + TOOL_RESULT_DETAIL_MAX_CHARS]
+        payload = {"success": True, "path": path or "", "content": chunk, "totalChars": len(text)}
+        if offset + len(chunk) < len(text):
+            payload["nextOffset"] = offset + len(chunk)
+        return payload
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled, "rawCache": self._raw.stats()}
+
+
+tool_result_compactor = ToolResultCompactor()
@@ -0,0 +1,173 @@
+# warmup.py
+#
+# デプロイ・スケールアウト直後の最初のリクエストを遅くしないための起動処理。
+# - preload(): 重いライブラリ (openai, requests) の import と、データ (users / 車両インデックス)・
+#   システムプロンプト・マニュアル索引の読み込みを先に済ませる。
+#   gunicorn --preload (gunicorn.conf.py) ではマスターで1回だけ実行し、ワーカーは fork でそのまま共有する。
+#   マスターでは最後に gc.freeze() し、ワーカーの GC が共有ページに書き込んでコピーを起こさないようにする
+# - start(): ワーカー (プロセス) ごとに、バックグラウンドで preload と外部 API (OpenAI / マニュアル検索) への
+#   接続の確立を行う。ソケットは fork をまたいで共有できないので、接続は fork 後に張る
+# - ready(): start() の処理が終わったか。/api/ops/ready はそれまで 503 を返す (App Service のヘルスチェックに使う)
+# 接続に失敗した項目はエラーとして記録するが、準備完了は止めない
+# (外部 API の障害で全インスタンスが振り分けから外れないようにする。障害時はブレーカーと締め切りに任せる)。
+import gc
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from logging_setup import setup_logging
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "1") != "0"
+# 外部 API への接続を先に張るか (0 なら preload だけ行う)
+WARMUP_CONNECT = os.environ.get("WARMUP_CONNECT", "1") != "0"
+# 接続1件あたりの timeout (秒)
+WARMUP_TIMEOUT_SEC = float(os.environ.get("WARMUP_TIMEOUT_SEC", "10"))
+
+
+def _import_openai():
+    from chat_bot import load_openai
+    load_openai()
+
+
+def _import_requests():
+    from api_functions import search_client
+    search_client.session  # 初回の参照で requests を読み込み、Session を作る
+
+
+def _load_data():
+    from data_repository import repository
+    return repository.snapshot().version
+
+
+def _load_system_prompt():
+    from prompt_builder import system_prompt_cache
+    return system_prompt_cache.version
+
+
+def _load_manual_index():
+    from manual_index import manual_index
+    return manual_index.stats()["docs"]
+
+
+def _connect_openai(timeout: float):
+    from chat_bot import warm_up_llm_connection
+    return warm_up_llm_connection(timeout)
+
+
+def _connect_search(timeout: float):
+    from api_functions import search_client, SEARCH_API_URL
+    return search_client.warm_up(SEARCH_API_URL, timeout)
+
+
+_PRELOAD_STEPS = [
+    ("import_openai", _import_openai),
+    ("import_requests", _import_requests),
+    ("data", _load_data),
+    ("system_prompt", _load_system_prompt),
+    ("manual_index", _load_manual_index),
+]
+
+
+class WarmUp:
+    def __init__(self, enabled: bool = WARMUP_ENABLED, connect: bool = WARMUP_CONNECT,
+                 timeout_sec: float = WARMUP_TIMEOUT_SEC):
+        self.enabled = enabled
+        self.connect = connect
+        self.timeout_sec = timeout_sec
+        self._lock = threading.Lock()
+        self._preloaded = False
+        # start() を実行したプロセス。fork 後のワーカーでは一致しないので、やり直す
+        self._pid: Optional[int] = None
+        self._ready = threading.Event()
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        # 項目名 -> {"ok", "ms", "pid", ("result" | "error")}
+        self._steps: Dict[str, Dict] = {}
+
+    def _step(self, name: str, fn: Callable):
+        started = time.perf_counter()
+        entry = {"pid": os.getpid()}
+        try:
+            result = fn()
+            entry["ok"] = True
+            if result is not None:
+                entry["result"] = result
+        except Exception as e:
+            logger.warning("warm-up step %s failed: %s", name, e)
+            entry.update(ok=False, error=str(e))
+        entry["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self._steps[name] = entry
+
+    def preload(self, freeze_gc: bool = False):
+        """
+        重い import とデータの読み込み (2回目以降は何もしない)。
+        gunicorn のマスターで呼ぶときは freeze_gc=True にして、読み込んだオブジェクトを GC の対象から外す。
+        """
+        with self._lock:
+            if self._preloaded:
+                return
+            for name, fn in _PRELOAD_STEPS:
+                self._step(name, fn)
+            self._preloaded = True
+        if freeze_gc:
+            gc.collect()
+            gc.freeze()
+        logger.info("preload finished: %s", ", ".join(f"{k}={v['ms']}ms" for k, v in self._steps.items()))
+
+    def start(self):
+        """このプロセスの準備をバックグラウンドで始める (プロセスごとに1回。何度呼んでもよい)。"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            # fork 前 (マスター) の状態は引き継がない
+            self._ready = threading.Event()
+            self._started_at = time.monotonic()
+            self._finished_at = None
+        # fork 後のワーカーではログのリスナースレッドが無いので起動し直す
+        setup_logging()
+        if not self.enabled:
+            self._finish()
+            return
+        threading.Thread(target=self._run, name="warm-up", daemon=True).start()
+
+    def _run(self):
+        self.preload()
+        if self.connect:
+            self._step("connect_openai", lambda: _connect_openai(self.timeout_sec))
+            self._step("connect_search", lambda: _connect_search(self.timeout_sec))
+        self._finish()
+
+    def _finish(self):
+        self._finished_at = time.monotonic()
+        self._ready.set()
+        elapsed = self._finished_at - self._started_at
+        logger.info("warm-up finished in %.2fs", elapsed,
+                    extra={"fields": {"event": "warm_up", "seconds": round(elapsed, 3), "steps": dict(self._steps)}})
+
+    def ready(self) -> bool:
+        return self._pid == os.getpid() and self._ready.is_set()
+
+    def status(self) -> Dict:
+        ready = self.ready()
+        elapsed = None
+        if self._started_at is not None and self._pid == os.getpid():
+            elapsed = round((self._finished_at or time.monotonic()) - self._started_at, 3)
+        return {
+            "ready": ready,
+            "enabled": self.enabled,
+            "pid": os.getpid(),
+            "preloaded": self._preloaded,
+            "warmUpSec": elapsed,
+            "steps": dict(self._steps),
+        }
+
+
+warmup = WarmUp()
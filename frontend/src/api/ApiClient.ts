@@ -12,9 +12,12 @@ export async function login(userId: string, password: string) {
   return resp.data  // {sessionId: "..."} など
 }
 
-export async function getUsers() {
-  const resp = await axios.get(`${BASE_URL}/api/users`)
-  return resp.data // { users: [ ... ] }
+// ユーザ一覧 (q: userId / 氏名 / 会社名の前方一致, offset/limit: ページング)
+export async function getUsers(q = '', offset = 0, limit = 50) {
+  const resp = await axios.get(`${BASE_URL}/api/users`, {
+    params: { q, offset, limit },
+  })
+  return resp.data // { users: [ ... ], total: N, offset: N, limit: N }
 }
 
 export async function selectUser(sessionId: string, userId: string) {
@@ -30,7 +33,88 @@ export async function postChatMessage(sessionId: string, message: string) {
     sessionId,
     message,
   })
-  return resp.data  // { reply: "...", conversation: [...] }
+  return resp.data  // { reply: "...", messages: [今回の2件], index: 次のメッセージ番号 }
+}
+
+// 履歴の取得 (since 以降のみ。全履歴が必要なときは since を省略)
+export async function getChatHistory(sessionId: string, since = 0) {
+  const resp = await axios.get(`${BASE_URL}/api/chat/history`, {
+    params: { sessionId, since },
+  })
+  return resp.data  // { messages: [...], since: N, index: M }
+}
+
+// ストリーミング版 (/api/chat/stream, Server-Sent Events)
+// トークンが届くたびに onDelta を呼び、最後に done イベントの内容を返す
+export async function postChatMessageStream(
+  sessionId: string,
+  message: string,
+  onDelta: (content: string) => void,
+) {
+  const resp = await fetch(`${BASE_URL}/api/chat/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ sessionId, message }),
+  })
+  if (!resp.ok || !resp.body) {
+    throw new Error(`status=${resp.status}`)
+  }
+
+  const reader = resp.body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+  let done: { reply: string; messages: { role: string; content: string }[]; index: number } | null = null
+
+  for (;;) {
+    const { value, done: finished } = await reader.read()
+    if (finished) break
+    buffer += decoder.decode(value, { stream: true })
+
+    // イベントは空行区切り
+    let sep = buffer.indexOf('\n\n')
+    while (sep >= 0) {
+      const raw = buffer.slice(0, sep)
+      buffer = buffer.slice(sep + 2)
+      let event = 'message'
+      let data = ''
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7)
+        else if (line.startsWith('data: ')) data += line.slice(6)
+      }
+      if (data) {
+        const payload = JSON.parse(data)
+        if (event === 'delta') onDelta(payload.content)
+        else if (event === 'done') done = payload
+      }
+      sep = buffer.indexOf('\n\n')
+    }
+  }
+  return done  // { reply: "...", messages: [今回の2件], index: 次のメッセージ番号 }
+}
+
+// ジョブ版 (/api/chat/jobs)。受け付け後に long-poll で結果を待つ
+// 混雑時 (429) は Retry-After 秒待ってから送り直す
+export async function postChatMessageJob(sessionId: string, message: string) {
+  let jobId = ''
+  for (;;) {
+    const resp = await axios.post(`${BASE_URL}/api/chat/jobs`, { sessionId, message }, {
+      validateStatus: (status) => status === 202 || status === 429,
+    })
+    if (resp.status === 202) {
+      jobId = resp.data.jobId
+      break
+    }
+    const retryAfter = Number(resp.headers['retry-after'] || 1)
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000))
+  }
+
+  for (;;) {
+    const resp = await axios.get(`${BASE_URL}/api/chat/jobs/${jobId}`, {
+      params: { sessionId, wait: 25 },
+    })
+    if (resp.data.status === 'done') return resp.data.result  // /api/chat と同じ形
+    if (resp.data.status === 'failed') throw new Error(resp.data.error)
+  }
 }
 
 export async function resetChat(sessionId: string) {
@@ -1,6 +1,6 @@
 import { useEffect, useState } from 'react'
 import { useNavigate } from 'react-router-dom'
-import { postChatMessage, resetChat, finishChat } from '../api/ApiClient'
+import { postChatMessageStream, resetChat, finishChat } from '../api/ApiClient'
 
 interface Message {
   role: string
@@ -27,11 +27,19 @@ export default function ChatPage() {
   const handleSend = async () => {
     if (!sessionId) return
     setError('')
+    const userText = inputText
+    setInputText('')
+    // 送信直後にユーザ発言と空のassistant発言を表示し、トークンが届くたびに追記する
+    setMessages(prev => [...prev, { role: 'user', content: userText }, { role: 'assistant', content: '' }])
     try {
-      const data = await postChatMessage(sessionId, inputText) 
-      // data.reply, data.conversation
-      setInputText('')
-      setMessages(data.conversation) 
+      const data = await postChatMessageStream(sessionId, userText, (delta) => {
+        setMessages(prev => {
+          const last = prev[prev.length - 1]
+          return [...prev.slice(0, -1), { ...last, content: last.content + delta }]
+        })
+      })
+      // data.reply, data.messages (今回の2件のみ) -> 仮表示していた2件を置き換える
+      if (data) setMessages(prev => [...prev.slice(0, -2), ...data.messages])
     } catch (err) {
       setError('送信エラー: ' + String(err))
     }
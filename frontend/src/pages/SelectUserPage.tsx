@@ -10,9 +10,14 @@ interface UserItem {
   machineCount: number
 }
 
+const PAGE_SIZE = 50
+
 export default function SelectUserPage() {
   const navigate = useNavigate()
   const [users, setUsers] = useState<UserItem[]>([])
+  const [total, setTotal] = useState(0)
+  const [query, setQuery] = useState('')
+  const [offset, setOffset] = useState(0)
   const [error, setError] = useState('')
 
   const sessionId = sessionStorage.getItem('sessionId')
@@ -25,15 +30,24 @@ export default function SelectUserPage() {
       return
     }
 
-    // ユーザ一覧取得
-    getUsers()
-      .then(data => {
-        setUsers(data.users || [])
-      })
-      .catch(err => {
-        setError('ユーザ一覧取得エラー: ' + String(err))
-      })
-  }, [navigate, sessionId])
+    // ユーザ一覧取得 (検索語が変わったら少し待ってから問い合わせる)
+    let cancelled = false
+    const timer = setTimeout(() => {
+      getUsers(query, offset, PAGE_SIZE)
+        .then(data => {
+          if (cancelled) return
+          setUsers(data.users || [])
+          setTotal(data.total ?? 0)
+        })
+        .catch(err => {
+          if (!cancelled) setError('ユーザ一覧取得エラー: ' + String(err))
+        })
+    }, 200)
+    return () => {
+      cancelled = true
+      clearTimeout(timer)
+    }
+  }, [navigate, sessionId, query, offset])
 
   const handleSelect = async (userId: string) => {
     if (!sessionId) return
@@ -50,6 +64,16 @@ export default function SelectUserPage() {
     <div style={{ maxWidth: 600, margin: '0 auto' }}>
       <h1>ユーザ一覧</h1>
       {error && <p style={{ color: 'red' }}>{error}</p>}
+      <input
+        type="search"
+        placeholder="ユーザID / 氏名 / 会社名で検索"
+        value={query}
+        onChange={e => {
+          setQuery(e.target.value)
+          setOffset(0)
+        }}
+        style={{ width: '100%', marginBottom: 8 }}
+      />
       <table border={1} style={{ width: '100%' }}>
         <thead>
           <tr>
@@ -76,6 +100,13 @@ export default function SelectUserPage() {
           ))}
         </tbody>
       </table>
+      <div style={{ marginTop: 8 }}>
+        <button disabled={offset === 0} onClick={() => setOffset(Math.max(0, offset - PAGE_SIZE))}>前へ</button>
+        <span style={{ margin: '0 8px' }}>
+          {total === 0 ? 0 : offset + 1} - {Math.min(offset + PAGE_SIZE, total)} / {total}件
+        </span>
+        <button disabled={offset + PAGE_SIZE >= total} onClick={() => setOffset(offset + PAGE_SIZE)}>次へ</button>
+      </div>
     </div>
   )
 }